@@ -4,7 +4,7 @@
 
 # COMMAND ----------
 
-# MAGIC %pip install -U -qqqq mlflow-skinny langchain==0.2.16 langgraph-checkpoint==1.0.12 langchain_core langchain-community==0.2.16 langgraph==0.2.16 pydantic databricks-sql-connector databricks-vectorsearch geopy meteostat 
+# MAGIC %pip install -U -qqqq mlflow-skinny langchain==0.2.16 langgraph-checkpoint==1.0.12 langchain_core langchain-community==0.2.16 langgraph==0.2.23 pydantic databricks-sql-connector databricks-vectorsearch geopy meteostat numpy aiohttp jinja2 prometheus_client
 # MAGIC dbutils.library.restartPython()
 
 # COMMAND ----------
@@ -14,23 +14,95 @@
 
 # COMMAND ----------
 
-import mlflow
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
-#Vector Search Client
-from databricks.vector_search.client import VectorSearchClient
+import mlflow
 
 from langchain.tools import StructuredTool
 from mlflow.models import ModelConfig
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Startup timings
+# MAGIC
+# MAGIC The endpoint scales to zero, so cold starts are user visible. Import time steps and lazily built objects (`Lazy`) record how long they took in `startup_timings`. `report_startup_timings()` prints the breakdown at the end of the notebook and after `warm_up()`.
 
-#For debug in traces.
-# mlflow.set_experiment(experiment_id="527359e5b4784ed5a80f36c10fdeffc0")
+# COMMAND ----------
+
+startup_started = time.perf_counter()
+startup_timings = OrderedDict()
+
+
+@contextmanager
+def startup_step(name):
+    """Record the wall time of one startup step under name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = startup_timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def report_startup_timings(title="Startup"):
+    total = time.perf_counter() - startup_started
+    print(f"{title}: {total:.2f}s since import")
+    for name, seconds in startup_timings.items():
+        print(f"  {name}: {seconds:.3f}s")
+    return dict(startup_timings)
+
+
+class Lazy:
+    """Builds an object with factory on first use and keeps it. Attribute access is forwarded, so most call sites use it as the object itself.
+    Use get() where the real object is needed (e.g. pydantic validated arguments, graph builders)."""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    with startup_step(self.name):
+                        self._value = self._factory()
+                    self._built = True
+        return self._value
+
+    @property
+    def built(self):
+        return self._built
+
+    def set(self, value):
+        """Use value instead of building one, e.g. a stand-in for offline runs."""
+        with self._lock:
+            self._value = value
+            self._built = True
+
+    def reset(self):
+        """Build again on next use."""
+        with self._lock:
+            self._value = None
+            self._built = False
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+# COMMAND ----------
 
-mlflow.langchain.autolog()
 
+#For debug in traces.
+# mlflow.set_experiment(experiment_id="527359e5b4784ed5a80f36c10fdeffc0")
 
+#mlflow.langchain.autolog() patches langchain on import and is slow. It now runs with the first graph build (see enable_autolog), which warm_up() triggers.
 
 
 # COMMAND ----------
@@ -40,7 +112,23 @@ mlflow.langchain.autolog()
 
 # COMMAND ----------
 
-config = ModelConfig(development_config="config.yml")
+#config.yml is loaded once here. Every other cell reads it through config / get_config.
+with startup_step("config"):
+    config = ModelConfig(development_config="config.yml")
+
+
+def get_config(key, default=None):
+    """Read an optional key from config.yml. Returns default when the key is missing or empty."""
+    try:
+        value = config.get(key)
+    except KeyError:
+        return default
+    return default if value is None else value
+
+
+def enable_autolog():
+    if get_config("mlflow_autolog", True):
+        mlflow.langchain.autolog()
 
 # COMMAND ----------
 
@@ -51,11 +139,549 @@ os.environ["WORKSPACE_URL"]= config.get("WORKSPACE_URL")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Metrics
+# MAGIC
+# MAGIC Prometheus metrics for every tool call, LLM call, vector search and warehouse query, plus cache hits and per turn totals. Tool and LLM metrics are labeled by tool name and stage, so dashboards can show p95 per tool and LLM calls per turn.
+# MAGIC - Tools: `instrument_tool` wraps the func/coroutine of every tool in `all_tools`.
+# MAGIC - LLM: `llm_metrics_handler` is a callback on the llm, so it sees agent calls, calls made inside tools and the SQL agents' calls.
+# MAGIC - Warehouse: SQLAlchemy cursor events on the shared engine.
+# MAGIC - Caches: `SemanticCache.stats()` of the named caches, read on scrape.
+# MAGIC
+# MAGIC Metrics live in their own `metrics_registry` and are served on `metrics_port` (see the Metrics endpoint cell). Set `metrics_port: 0` to turn the endpoint off.
+
+# COMMAND ----------
+
+import functools
+from contextvars import ContextVar
+from typing import Optional
+from prometheus_client import CollectorRegistry, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from langchain_core.callbacks import BaseCallbackHandler
+
+metrics_registry = CollectorRegistry()
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)
+
+tool_latency = Histogram("grocer_tool_latency_seconds", "Tool call latency.", ["tool", "stage"],
+                         buckets=LATENCY_BUCKETS, registry=metrics_registry)
+tool_errors = Counter("grocer_tool_errors_total", "Tool calls that raised.", ["tool", "stage"], registry=metrics_registry)
+llm_latency = Histogram("grocer_llm_latency_seconds", "LLM call latency.", ["stage", "caller"],
+                        buckets=LATENCY_BUCKETS, registry=metrics_registry)
+llm_errors = Counter("grocer_llm_errors_total", "LLM calls that raised.", ["stage", "caller"], registry=metrics_registry)
+llm_tokens = Counter("grocer_llm_tokens_total", "LLM token usage.", ["stage", "caller", "type"], registry=metrics_registry)
+vector_search_latency = Histogram("grocer_vector_search_latency_seconds", "Vector search latency.", ["index"],
+                                  buckets=LATENCY_BUCKETS, registry=metrics_registry)
+vector_search_errors = Counter("grocer_vector_search_errors_total", "Vector searches that raised.", ["index"], registry=metrics_registry)
+warehouse_query_latency = Histogram("grocer_warehouse_query_latency_seconds", "Warehouse query latency.", ["statement"],
+                                    buckets=LATENCY_BUCKETS, registry=metrics_registry)
+warehouse_query_errors = Counter("grocer_warehouse_query_errors_total", "Warehouse queries that raised.", ["statement"], registry=metrics_registry)
+turn_latency = Histogram("grocer_turn_latency_seconds", "Latency of one conversation turn.", buckets=LATENCY_BUCKETS, registry=metrics_registry)
+turn_llm_calls = Histogram("grocer_turn_llm_calls", "LLM calls per conversation turn.", buckets=COUNT_BUCKETS, registry=metrics_registry)
+turn_tool_calls = Histogram("grocer_turn_tool_calls", "Tool calls per conversation turn.", buckets=COUNT_BUCKETS, registry=metrics_registry)
+
+#Stage of the graph the current tool call belongs to. Set by the tool node.
+current_stage: ContextVar[Optional[str]] = ContextVar("current_stage", default=None)
+#Per turn counters. Tool threads and tasks copy the context, so they all update the same dict.
+current_turn: ContextVar[Optional[dict]] = ContextVar("current_turn", default=None)
+
+
+def metric_stage() -> str:
+    return current_stage.get() or "none"
+
+
+def count_in_turn(key):
+    turn = current_turn.get()
+    if turn is not None:
+        turn[key] += 1
+
+
+@contextmanager
+def observe(histogram, errors, *labels):
+    """Time the block into histogram and count it in errors when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.labels(*labels).inc()
+        raise
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+def start_turn() -> dict:
+    turn = {"started": time.perf_counter(), "llm_calls": 0, "tool_calls": 0}
+    current_turn.set(turn)
+    return turn
+
+
+def finish_turn(turn):
+    turn_latency.observe(time.perf_counter() - turn["started"])
+    turn_llm_calls.observe(turn["llm_calls"])
+    turn_tool_calls.observe(turn["tool_calls"])
+
+
+def instrument_tool(tool):
+    """Record latency and errors of every call of tool under its name and the current stage. Wraps func and coroutine in place."""
+    def labels():
+        return tool.name, metric_stage()
+
+    if getattr(tool, "func", None) is not None:
+        func = tool.func
+
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            count_in_turn("tool_calls")
+            with observe(tool_latency, tool_errors, *labels()):
+                return func(*args, **kwargs)
+
+        tool.func = timed_func
+    if getattr(tool, "coroutine", None) is not None:
+        coroutine = tool.coroutine
+
+        @functools.wraps(coroutine)
+        async def timed_coroutine(*args, **kwargs):
+            count_in_turn("tool_calls")
+            with observe(tool_latency, tool_errors, *labels()):
+                return await coroutine(*args, **kwargs)
+
+        tool.coroutine = timed_coroutine
+    return tool
+
+
+def token_usage(response):
+    """(prompt tokens, completion tokens) of an LLMResult. ChatDatabricks reports usage in llm_output, newer models on the message."""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = response.llm_output or {}
+    usage = usage.get("token_usage") or usage.get("usage") or usage
+    return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Latency, errors and token usage of every call of the model it is attached to, labeled by stage and caller."""
+
+    #Runs in the caller's context, so current_stage and current_turn are visible on the async path too.
+    run_inline = True
+
+    def __init__(self):
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def _labels(self, metadata):
+        metadata = metadata or {}
+        node = metadata.get("langgraph_node")
+        if metadata.get(INTERNAL_LLM_CALL):
+            caller = "history_summary"
+        elif node and node != "tools":
+            caller = "agent"
+        else:
+            caller = "tool"
+        stage = node if caller != "tool" else metric_stage()
+        return stage or "none", caller
+
+    def _start(self, run_id, metadata):
+        count_in_turn("llm_calls")
+        with self._lock:
+            self._started[run_id] = (time.perf_counter(), self._labels(metadata))
+
+    def _finish(self, run_id):
+        with self._lock:
+            return self._started.pop(run_id, (None, None))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start, labels = self._finish(run_id)
+        if start is None:
+            return
+        llm_latency.labels(*labels).observe(time.perf_counter() - start)
+        prompt_tokens, completion_tokens = token_usage(response)
+        llm_tokens.labels(*labels, "prompt").inc(prompt_tokens)
+        llm_tokens.labels(*labels, "completion").inc(completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start, labels = self._finish(run_id)
+        if start is not None:
+            llm_latency.labels(*labels).observe(time.perf_counter() - start)
+            llm_errors.labels(*labels).inc()
+
+
+llm_metrics_handler = LLMMetricsHandler()
+
+
+def statement_kind(statement) -> str:
+    words = str(statement or "").split(None, 1)
+    return words[0].upper() if words and words[0].isalpha() else "OTHER"
+
+
+def instrument_engine(engine):
+    """Time every query run on engine, including the SQL agents' queries."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info.get("query_started")
+        if started:
+            warehouse_query_latency.labels(statement_kind(statement)).observe(time.perf_counter() - started.pop())
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            warehouse_query_latency.labels(statement_kind(context.statement)).observe(time.perf_counter() - started.pop())
+        warehouse_query_errors.labels(statement_kind(context.statement)).inc()
+
+    return engine
+
+
+class CacheStatsCollector:
+    """Exposes SemanticCache.stats() as metrics. caches maps a label to the name of a global cache, looked up on every scrape."""
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    def collect(self):
+        requests = CounterMetricFamily("grocer_cache_requests", "Cache lookups by result.", labels=["cache", "result"])
+        entries = GaugeMetricFamily("grocer_cache_entries", "Entries held by the cache.", labels=["cache"])
+        for label, name in self.caches.items():
+            cache = globals().get(name)
+            if cache is None:
+                continue
+            stats = cache.stats()
+            requests.add_metric([label, "exact_hit"], stats["exact_hits"])
+            requests.add_metric([label, "similar_hit"], stats["similar_hits"])
+            requests.add_metric([label, "miss"], stats["misses"])
+            entries.add_metric([label], stats["entries"])
+        yield requests
+        yield entries
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Turn budget
+# MAGIC
+# MAGIC Every user turn gets a `TurnBudget`: at most `turn_max_llm_calls` LLM calls and `turn_max_tokens` prompt + completion tokens, within `turn_deadline_seconds`. `llm_budget_handler` is a callback on the llm, so the outer agent, the LLM calls inside tools and the nested SQL agents all draw from the same budget. Once it is spent, the next LLM call raises `BudgetExceeded` and the turn ends with the partial answer and a short note to the user (see Token streaming).
+
+# COMMAND ----------
+
+class BudgetExceeded(Exception):
+    """Raised on the first LLM call after the turn budget is spent."""
+
+
+class TurnBudget:
+    """LLM calls, tokens and wall time one user turn may use. A limit of 0 or None means no limit."""
+
+    def __init__(self, max_llm_calls=None, max_tokens=None, deadline_seconds=None):
+        self.max_llm_calls = max_llm_calls
+        self.max_tokens = max_tokens
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+        self.llm_calls = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def remaining_seconds(self) -> Optional[float]:
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def exhausted(self) -> Optional[str]:
+        """Why the budget is spent, or None."""
+        if self.max_llm_calls and self.llm_calls >= self.max_llm_calls:
+            return f"it used the {self.max_llm_calls} model calls allowed per message"
+        if self.max_tokens and self.tokens >= self.max_tokens:
+            return f"it used the {self.max_tokens} tokens allowed per message"
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return "it ran out of time for this message"
+        return None
+
+    def charge_call(self):
+        with self._lock:
+            reason = self.exhausted()
+            if reason:
+                raise BudgetExceeded(reason)
+            self.llm_calls += 1
+
+    def charge_tokens(self, tokens):
+        with self._lock:
+            self.tokens += tokens
+
+
+#Budget of the current turn. Tool threads and tasks copy the context, so nested calls charge the same budget.
+current_budget: ContextVar[Optional[TurnBudget]] = ContextVar("current_budget", default=None)
+
+
+def start_budget() -> TurnBudget:
+    budget = TurnBudget(max_llm_calls=get_config("turn_max_llm_calls", 24),
+                        max_tokens=get_config("turn_max_tokens", 60000),
+                        deadline_seconds=get_config("turn_deadline_seconds", 120))
+    current_budget.set(budget)
+    return budget
+
+
+class BudgetCallbackHandler(BaseCallbackHandler):
+    """Charges every LLM call to the turn budget and stops the call once the budget is spent."""
+
+    raise_error = True
+    run_inline = True
+
+    def _charge(self):
+        budget = current_budget.get()
+        if budget is not None:
+            budget.charge_call()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._charge()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._charge()
+
+    def on_llm_end(self, response, **kwargs):
+        budget = current_budget.get()
+        if budget is not None:
+            budget.charge_tokens(sum(token_usage(response)))
+
+
+llm_budget_handler = BudgetCallbackHandler()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Resilient endpoint calls
+# MAGIC
+# MAGIC Every LLM call and vector search goes through the `CallPolicy` of its endpoint:
+# MAGIC - a timeout per attempt, capped by what is left of the turn deadline (`TurnBudget`), so nested calls never outlive the user turn
+# MAGIC - retries with full-jitter exponential backoff on 429s, 5xx, timeouts and connection errors
+# MAGIC - a process-wide `AdaptiveLimiter` per endpoint: at most `*_max_concurrency` calls in flight, halved on every 429 and grown back by one after a run of successful calls
+# MAGIC
+# MAGIC The llm is a `ChatDatabricks` subclass routing `_generate` and `_stream` through the policy. mlflow's own HTTP retries are turned off so retries aren't multiplied.
+# MAGIC
+# MAGIC Retries and limit changes aren't printed. They show up in `grocer_endpoint_retries_total` and `grocer_endpoint_concurrency_limit`.
+
+# COMMAND ----------
+
+import contextvars
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from prometheus_client import Gauge
+
+#Retries happen in CallPolicy. The mlflow client would otherwise retry each attempt up to 7 times.
+os.environ.setdefault("MLFLOW_HTTP_REQUEST_MAX_RETRIES", "0")
+os.environ.setdefault("MLFLOW_HTTP_REQUEST_TIMEOUT", str(get_config("llm_timeout_seconds", 60)))
+
+endpoint_retries = Counter("grocer_endpoint_retries_total", "Retried endpoint calls by reason.", ["endpoint", "reason"], registry=metrics_registry)
+endpoint_concurrency_limit = Gauge("grocer_endpoint_concurrency_limit", "Current adaptive concurrency limit.", ["endpoint"], registry=metrics_registry)
+
+#Attempts run here, so a timed out call doesn't block its caller.
+endpoint_call_pool = ThreadPoolExecutor(max_workers=get_config("endpoint_call_max_workers", 64), thread_name_prefix="endpoint-call")
+
+RETRYABLE_ERROR_PATTERN = re.compile(r"\b(429|500|502|503|504)\b|timed? ?out|temporarily unavailable|connection (reset|aborted|refused)", re.IGNORECASE)
+THROTTLED_ERROR_PATTERN = re.compile(r"\b429\b|rate limit|too many requests|request_limit_exceeded", re.IGNORECASE)
+
+
+def is_throttled_error(error) -> bool:
+    return bool(THROTTLED_ERROR_PATTERN.search(str(error)))
+
+
+def is_retryable_error(error) -> bool:
+    """429s, 5xx, timeouts and connection errors. Endpoint SDKs raise plain exceptions carrying the HTTP status, so match on the message too."""
+    if isinstance(error, BudgetExceeded):
+        return False
+    return isinstance(error, (TimeoutError, ConnectionError)) or bool(RETRYABLE_ERROR_PATTERN.search(str(error)))
+
+
+class AdaptiveLimiter:
+    """Concurrency limit for one endpoint. Halves on a 429 and grows by one after increase_after successful calls in a row (AIMD)."""
+
+    def __init__(self, endpoint, max_limit=16, min_limit=1, increase_after=10):
+        self.endpoint = endpoint
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase_after = increase_after
+        self.limit = max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self._condition = threading.Condition()
+        endpoint_concurrency_limit.labels(endpoint).set(self.limit)
+
+    def _take(self) -> bool:
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self, timeout=None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(self._take, timeout)
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.increase_after and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            endpoint_concurrency_limit.labels(self.endpoint).set(self.limit)
+            self._condition.notify_all()
+
+
+class CallPolicy:
+    """Timeout per attempt, retries with full-jitter exponential backoff and the endpoint's AdaptiveLimiter. The turn deadline caps every wait."""
+
+    def __init__(self, endpoint, limiter, timeout_seconds=60, max_retries=3, backoff_seconds=0.5, max_backoff_seconds=8.0):
+        self.endpoint = endpoint
+        self.limiter = limiter
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    @staticmethod
+    def _turn_remaining() -> Optional[float]:
+        budget = current_budget.get()
+        return None if budget is None else budget.remaining_seconds()
+
+    def _attempt_timeout(self) -> float:
+        remaining = self._turn_remaining()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"{self.endpoint}: the turn deadline has passed")
+        return self.timeout_seconds if remaining is None else min(self.timeout_seconds, remaining)
+
+    def _retry(self, attempt, error):
+        """Sleep before the next attempt, or raise error when there is none or the turn deadline comes first."""
+        if attempt >= self.max_retries or not is_retryable_error(error):
+            raise error
+        reason = "throttled" if is_throttled_error(error) else "timeout" if isinstance(error, TimeoutError) else "error"
+        delay = random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+        remaining = self._turn_remaining()
+        if remaining is not None and delay >= remaining:
+            raise error
+        #Counted, not printed: a burst of 429s would print from every session thread.
+        endpoint_retries.labels(self.endpoint, reason).inc()
+        time.sleep(delay)
+
+    def _release_when_done(self, future):
+        def release(done):
+            error = None if done.cancelled() else done.exception()
+            self.limiter.release(throttled=error is not None and is_throttled_error(error))
+        future.add_done_callback(release)
+
+    def _close_when_done(self, future, iterator):
+        """Close an abandoned stream once its read in flight returns, then release the slot. The endpoint is still streaming until then."""
+        def close(done):
+            try:
+                if hasattr(iterator, "close"):
+                    iterator.close()
+            finally:
+                error = None if done.cancelled() else done.exception()
+                self.limiter.release(throttled=error is not None and is_throttled_error(error))
+        future.add_done_callback(close)
+
+    def call(self, func, *args, **kwargs):
+        """func(*args, **kwargs) under this policy."""
+        for attempt in range(self.max_retries + 1):
+            timeout = self._attempt_timeout()
+            if not self.limiter.acquire(timeout):
+                self._retry(attempt, TimeoutError(f"{self.endpoint}: no free slot within {timeout:.1f}s"))
+                continue
+            #The slot is held until the attempt really finishes, even after the caller stopped waiting for it.
+            future = endpoint_call_pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
+            self._release_when_done(future)
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                self._retry(attempt, TimeoutError(f"{self.endpoint}: no answer within {timeout:.1f}s"))
+            except Exception as e:
+                self._retry(attempt, e)
+
+    def stream(self, func, *args, **kwargs):
+        """Iterate func(*args, **kwargs) under this policy. Retries only until the first chunk, which must arrive within the attempt timeout.
+        The slot is held until the stream finishes or is closed, like call() holds it until the attempt finishes."""
+        for attempt in range(self.max_retries + 1):
+            timeout = self._attempt_timeout()
+            if not self.limiter.acquire(timeout):
+                self._retry(attempt, TimeoutError(f"{self.endpoint}: no free slot within {timeout:.1f}s"))
+                continue
+            iterator = iter(func(*args, **kwargs))
+            first = endpoint_call_pool.submit(contextvars.copy_context().run, next, iterator, None)
+            try:
+                chunk = first.result(timeout=timeout)
+            except FutureTimeoutError:
+                first.cancel()
+                self._close_when_done(first, iterator)
+                self._retry(attempt, TimeoutError(f"{self.endpoint}: no first chunk within {timeout:.1f}s"))
+                continue
+            except Exception as e:
+                self.limiter.release(throttled=is_throttled_error(e))
+                self._retry(attempt, e)
+                continue
+            try:
+                if chunk is not None:
+                    yield chunk
+                    yield from iterator
+            finally:
+                try:
+                    if hasattr(iterator, "close"):
+                        iterator.close()
+                finally:
+                    self.limiter.release()
+            return
+
+
+call_policies = {}
+call_policies_lock = threading.Lock()
+
+
+def endpoint_policy(kind, endpoint) -> CallPolicy:
+    """Shared policy for one endpoint. kind ("llm" or "vector_search") selects the *_timeout_seconds, *_max_retries and *_max_concurrency keys."""
+    key = (kind, endpoint)
+    with call_policies_lock:
+        if key not in call_policies:
+            name = f"{kind}:{endpoint}"
+            call_policies[key] = CallPolicy(name, AdaptiveLimiter(name, max_limit=get_config(f"{kind}_max_concurrency", 16)),
+                                            timeout_seconds=get_config(f"{kind}_timeout_seconds", 60),
+                                            max_retries=get_config(f"{kind}_max_retries", 2),
+                                            backoff_seconds=get_config("call_retry_backoff_seconds", 0.5),
+                                            max_backoff_seconds=get_config("call_retry_max_backoff_seconds", 8.0))
+        return call_policies[key]
+
+# COMMAND ----------
+
 
-from langchain_community.chat_models import ChatDatabricks
-# Create the llm
+def build_llm():
+    #Deferred import. langchain_community.chat_models is slow to import and not needed until the first call.
+    from langchain_community.chat_models import ChatDatabricks
 
-llm = ChatDatabricks(endpoint=config.get("llm_endpoint"),temperature=0)
+    class ResilientChatDatabricks(ChatDatabricks):
+        """ChatDatabricks calling its endpoint through the endpoint's CallPolicy."""
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            return endpoint_policy("llm", self.endpoint).call(super()._generate, messages, stop=stop, run_manager=run_manager, **kwargs)
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            yield from endpoint_policy("llm", self.endpoint).stream(super()._stream, messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    #The budget handler goes first, so a refused call isn't recorded as started by the metrics handler.
+    return ResilientChatDatabricks(endpoint=config.get("llm_endpoint"),temperature=0, callbacks=[llm_budget_handler, llm_metrics_handler])
+
+# Create the llm on first use
+llm = Lazy("llm", build_llm)
 
 # COMMAND ----------
 
@@ -67,18 +693,986 @@ llm = ChatDatabricks(endpoint=config.get("llm_endpoint"),temperature=0)
 
 # COMMAND ----------
 
-from langchain_community.tools.databricks import UCFunctionToolkit
-
 uc_functions = config.get("uc_functions")
 
-uc_function_tools = (
-    UCFunctionToolkit(warehouse_id=config.get("warehouse_id"))
-    .include(*uc_functions)
-    .get_tools()
-)
+
+def build_uc_function_tools():
+    #get_tools() is a warehouse round trip, so it runs with the first graph build instead of on import.
+    from langchain_community.tools.databricks import UCFunctionToolkit
+    return (
+        UCFunctionToolkit(warehouse_id=config.get("warehouse_id"))
+        .include(*uc_functions)
+        .get_tools()
+    )
+
+
+uc_function_tools = Lazy("uc_function_tools", build_uc_function_tools)
+
+
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Local sample data
+# MAGIC
+# MAGIC Same rows as the data prep notebook. Used to seed the local stand-ins (vector indexes, SQL tables) for offline runs.
+
+# COMMAND ----------
+
+LOCAL_SAMPLE_DATA = {
+    "users": [
+        {"LoyaltyID": "L001", "UserName": "Canadian", "UserEmail": "redacted@mails", "UserHomeStoreAddress": "150 Carlton, Toronto, Ontario, Canada", "StoreID": "5"},
+        {"LoyaltyID": "L002", "UserName": "Indian", "UserEmail": "redacted@mails", "UserHomeStoreAddress": "Vihar, Delhi, India", "StoreID": "11"},
+        {"LoyaltyID": "L003", "UserName": "Arab", "UserEmail": "redacted@mails", "UserHomeStoreAddress": "Financial Center Rd, Downtown Dubai, Dubai, United Arab Emirates", "StoreID": "21"},
+        {"LoyaltyID": "L004", "UserName": "Mexican", "UserEmail": "redacted@mails", "UserHomeStoreAddress": "104, Parliament, Mexico City, Mexico", "StoreID": "2"},
+    ],
+    "grocery_products": [
+        {"ProductID": "G001", "ProductName": "Milk", "Units": 1, "UnitOfMeasurement": "Liter", "UnitPrice": 1.99},
+        {"ProductID": "G002", "ProductName": "Bread Loaf", "Units": 1, "UnitOfMeasurement": "Pack", "UnitPrice": 2.49},
+        {"ProductID": "G003", "ProductName": "Apples", "Units": 1, "UnitOfMeasurement": "Kg", "UnitPrice": 3.49},
+        {"ProductID": "G004", "ProductName": "Bananas", "Units": 1, "UnitOfMeasurement": "Kg", "UnitPrice": 0.99},
+    ],
+    "transactions": [
+        {"TransactionID": "T001", "LoyaltyID": "L001", "ProductID": "G001", "QuantityPurchased": 2, "ProductPurchaseDate": "2023-09-01", "ProductExpiryDate": "2023-09-10"},
+        {"TransactionID": "T002", "LoyaltyID": "L002", "ProductID": "G002", "QuantityPurchased": 1, "ProductPurchaseDate": "2023-09-02", "ProductExpiryDate": "2023-09-09"},
+        {"TransactionID": "T003", "LoyaltyID": "L003", "ProductID": "G003", "QuantityPurchased": 3, "ProductPurchaseDate": "2023-09-03", "ProductExpiryDate": "2023-09-12"},
+        {"TransactionID": "T004", "LoyaltyID": "L004", "ProductID": "G004", "QuantityPurchased": 2, "ProductPurchaseDate": "2023-09-04", "ProductExpiryDate": "2023-09-11"},
+    ],
+    "offered_products": {"L001": ["G001", "G002"], "L003": ["G001", "G002"], "L002": ["G003", "G004"], "L004": ["G003", "G004"]},
+    "recipes": [
+        {"RecipeName": "Milkshake", "Ingredients": ["Milk", "Bananas", "Sugar", "Ice cubes"],
+         "Steps": ["Pour milk into a blender.", "Add sliced bananas and sugar.", "Blend until smooth.", "Serve with ice cubes."]},
+        {"RecipeName": "Fruit Salad", "Ingredients": ["Apples", "Bananas", "Oranges", "Lemon juice"],
+         "Steps": ["Chop all fruits into small pieces.", "Mix them in a large bowl.", "Drizzle with lemon juice.", "Serve chilled."]},
+        {"RecipeName": "Banana Bread", "Ingredients": ["Bananas", "Flour", "Eggs", "Sugar", "Baking powder"],
+         "Steps": ["Preheat oven to 175°C.", "Mash bananas.", "Mix all ingredients until well combined.", "Pour into a loaf pan and bake for 60 minutes."]},
+    ],
+}
+
+
+def local_product_rows():
+    """Rows of genai.data.products: one row per ProductID x StoreID."""
+    store_ids = sorted({user["StoreID"] for user in LOCAL_SAMPLE_DATA["users"]}, key=int)
+    return [dict(product, StoreID=store_id, ProductIDStoreId=f"{product['ProductID']}_{store_id}")
+            for product in LOCAL_SAMPLE_DATA["grocery_products"] for store_id in store_ids]
+
+
+def local_recipe_rows():
+    """Rows of genai.data.recipe, including the `content` column the recipe index is built on."""
+    rows = []
+    for recipie_id, recipe in enumerate(LOCAL_SAMPLE_DATA["recipes"]):
+        content = f"""Recipe: {recipe['RecipeName']}. Ingredients: {', '.join(recipe['Ingredients'])}. Steps: {' '.join(recipe['Steps'])}"""
+        rows.append(dict(recipe, RecipieID=recipie_id, content=content))
+    return rows
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Vector Search Index Registry
+# MAGIC
+# MAGIC One shared, thread-safe handle per (endpoint, index name), reused by every tool call. The index handle is health checked periodically and rebuilt, along with the client, when the workspace token expires.
+# MAGIC
+# MAGIC Set `use_local_vector_indexes: true` in config.yml to serve both indexes from `LocalFakeIndex` seeded with the sample data, so the tools can run offline.
+
+# COMMAND ----------
+
+PRODUCT_VS_ENDPOINT = "product_vs_endpoint"
+PRODUCT_VS_INDEX = "genai.llm.product_vsindex"
+RECIPIE_VS_ENDPOINT = "recipie_vs_endpoint"
+RECIPIE_VS_INDEX = "genai.llm.recipie_vsindex"
+
+
+def is_auth_error(error) -> bool:
+    """Vector Search raises plain exceptions carrying the HTTP status, so match on the message."""
+    message = str(error).lower()
+    return any(marker in message for marker in ("401", "403", "unauthorized", "unauthenticated", "expired", "invalid access token"))
+
+
+class LocalFakeIndex:
+    """
+    In-memory stand-in for a Databricks Vector Search index.
+    Scores rows by character trigram overlap between query_text and text_column and returns results in the same shape as `similarity_search`.
+    """
+
+    def __init__(self, rows, text_column):
+        self.rows = list(rows)
+        self.text_column = text_column
+
+    @staticmethod
+    def _trigrams(text):
+        text = f"  {str(text).lower()} "
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def _matches(value, expected):
+        if isinstance(expected, (list, tuple, set)):
+            return str(value) in {str(item) for item in expected}
+        return str(value) == str(expected)
+
+    def describe(self):
+        return {"status": {"ready": True}, "num_rows": len(self.rows)}
+
+    def similarity_search(self, query_text, columns, num_results=10, filters=None, **kwargs):
+        query = self._trigrams(query_text)
+        scored = []
+        for row in self.rows:
+            if filters and not all(self._matches(row.get(key), value) for key, value in filters.items()):
+                continue
+            candidate = self._trigrams(row[self.text_column])
+            score = len(query & candidate) / len(query | candidate)
+            scored.append((score, row))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        data_array = [[row.get(column) for column in columns] + [score] for score, row in scored[:num_results]]
+        return {"manifest": {"columns": [{"name": column} for column in columns] + [{"name": "score"}]},
+                "result": {"row_count": len(data_array), "data_array": data_array}}
+
+
+def local_index_factory(endpoint_name, index_name):
+    """index_factory for VectorIndexRegistry serving the sample data instead of the workspace indexes."""
+    if index_name == PRODUCT_VS_INDEX:
+        return LocalFakeIndex(local_product_rows(), "ProductName")
+    if index_name == RECIPIE_VS_INDEX:
+        return LocalFakeIndex(local_recipe_rows(), "content")
+    raise KeyError(f"No local index for {endpoint_name}/{index_name}")
+
+
+class VectorIndexRegistry:
+    """
+    Process-wide registry of Vector Search index handles keyed by (endpoint name, index name).
+    A single VectorSearchClient is shared by all handles. Pass index_factory to serve indexes from somewhere else (e.g. local_index_factory).
+    """
+
+    def __init__(self, workspace_url=None, index_factory=None, health_check_interval=300):
+        self.workspace_url = workspace_url
+        self.index_factory = index_factory or self._remote_index
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._client = None
+        self._handles = {}
+        self._key_locks = {}
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                from databricks.vector_search.client import VectorSearchClient
+                self._client = VectorSearchClient(
+                    workspace_url=self.workspace_url or os.environ.get("WORKSPACE_URL"), disable_notice=True)
+            return self._client
+
+    def _remote_index(self, endpoint_name, index_name):
+        return self._get_client().get_index(endpoint_name=endpoint_name, index_name=index_name)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def invalidate(self, endpoint_name=None, index_name=None, reset_client=False):
+        """Drop one handle (or all of them when no key is given) so it is rebuilt on next use."""
+        with self._lock:
+            if endpoint_name is None:
+                self._handles.clear()
+            else:
+                self._handles.pop((endpoint_name, index_name), None)
+            if reset_client:
+                self._client = None
+
+    def get_index(self, endpoint_name, index_name):
+        key = (endpoint_name, index_name)
+        #Per key lock, so concurrent first calls for the same index wait on a single get_index round trip.
+        with self._key_lock(key):
+            handle = self._handles.get(key)
+            if handle is not None and time.monotonic() - handle["checked_at"] > self.health_check_interval:
+                try:
+                    handle["index"].describe()
+                    handle["checked_at"] = time.monotonic()
+                except Exception as e:
+                    print(f"Vector index {index_name} failed health check, rebuilding: {e}")
+                    self.invalidate(endpoint_name, index_name, reset_client=is_auth_error(e))
+                    handle = None
+            if handle is None:
+                handle = {"index": self.index_factory(endpoint_name, index_name), "checked_at": time.monotonic()}
+                with self._lock:
+                    self._handles[key] = handle
+            return handle["index"]
+
+    def similarity_search(self, endpoint_name, index_name, **search_kwargs):
+        """similarity_search on a shared handle, under the endpoint's CallPolicy. Retries once with a fresh client when the token has expired."""
+        with observe(vector_search_latency, vector_search_errors, index_name):
+            return endpoint_policy("vector_search", endpoint_name).call(self._similarity_search, endpoint_name, index_name, **search_kwargs)
+
+    def _similarity_search(self, endpoint_name, index_name, **search_kwargs):
+        try:
+            return self.get_index(endpoint_name, index_name).similarity_search(**search_kwargs)
+        except Exception as e:
+            if not is_auth_error(e):
+                raise
+            self.invalidate(endpoint_name, index_name, reset_client=True)
+            return self.get_index(endpoint_name, index_name).similarity_search(**search_kwargs)
+
+
+vector_indexes = VectorIndexRegistry(
+    index_factory=local_index_factory if get_config("use_local_vector_indexes", False) else None,
+    health_check_interval=get_config("vector_search_health_check_seconds", 300))
 
 
 
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### SQL Agent Registry
+# MAGIC
+# MAGIC SQL agents are built once per table set and reused across turns and sessions. All of them share a single SQLAlchemy engine with a bounded connection pool to the warehouse. Reflected schema metadata (and the table info the agent reads) is cached and rebuilt after `sql_schema_ttl_seconds`.
+# MAGIC
+# MAGIC Set `use_local_sql_database: true` in config.yml to run the same code path against a local SQLite copy of the `genai.data` tables.
+
+# COMMAND ----------
+
+import json
+import sqlite3
+from datetime import date, timedelta
+
+
+def build_local_grocer_database(path):
+    """Create (or recreate) a SQLite stand-in for the genai.data tables, seeded with the sample data."""
+    users = {user["LoyaltyID"]: user for user in LOCAL_SAMPLE_DATA["users"]}
+    products = {product["ProductID"]: product for product in LOCAL_SAMPLE_DATA["grocery_products"]}
+    today = date.today()
+
+    connection = sqlite3.connect(path)
+    with connection:
+        for table_name in ("users", "products", "transactions", "recipe", "offers"):
+            connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+        connection.execute("CREATE TABLE users (LoyaltyID TEXT, UserName TEXT, UserEmail TEXT, UserHomeStoreAddress TEXT, StoreID TEXT)")
+        connection.executemany("INSERT INTO users VALUES (:LoyaltyID, :UserName, :UserEmail, :UserHomeStoreAddress, :StoreID)",
+                               LOCAL_SAMPLE_DATA["users"])
+        connection.execute("CREATE TABLE products (ProductID TEXT, ProductName TEXT, Units INTEGER, UnitOfMeasurement TEXT, UnitPrice REAL, StoreID TEXT, ProductIDStoreId TEXT)")
+        connection.executemany("INSERT INTO products VALUES (:ProductID, :ProductName, :Units, :UnitOfMeasurement, :UnitPrice, :StoreID, :ProductIDStoreId)",
+                               local_product_rows())
+        connection.execute("CREATE TABLE transactions (LoyaltyID TEXT, TransactionID TEXT, ProductID TEXT, ProductName TEXT, QuantityPurchased INTEGER, ProductPurchaseDate DATE, ProductExpiryDate DATE, UnitPrice REAL, TotalPrice REAL, StoreID TEXT)")
+        connection.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (row["LoyaltyID"], row["TransactionID"], row["ProductID"], products[row["ProductID"]]["ProductName"], row["QuantityPurchased"],
+             row["ProductPurchaseDate"], row["ProductExpiryDate"], products[row["ProductID"]]["UnitPrice"],
+             row["QuantityPurchased"] * products[row["ProductID"]]["UnitPrice"], users[row["LoyaltyID"]]["StoreID"])
+            for row in LOCAL_SAMPLE_DATA["transactions"]])
+        connection.execute("CREATE TABLE recipe (RecipieID INTEGER, RecipeName TEXT, Ingredients TEXT, Steps TEXT, content TEXT)")
+        connection.executemany("INSERT INTO recipe VALUES (?, ?, ?, ?, ?)", [
+            (row["RecipieID"], row["RecipeName"], json.dumps(row["Ingredients"]), json.dumps(row["Steps"]), row["content"])
+            for row in local_recipe_rows()])
+        connection.execute("CREATE TABLE offers (LoyaltyID TEXT, OfferedProductID TEXT, OfferLoyaltyPoints REAL, OfferStartDate DATE, OfferEndDate DATE, ProductName TEXT)")
+        connection.executemany("INSERT INTO offers VALUES (?, ?, ?, ?, ?, ?)", [
+            (loyalty_id, product_id, 150.0, today.isoformat(), (today + timedelta(days=7)).isoformat(), products[product_id]["ProductName"])
+            for loyalty_id, product_ids in LOCAL_SAMPLE_DATA["offered_products"].items() for product_id in product_ids])
+    connection.close()
+    return f"sqlite:///{path}"
+
+
+class SQLAgentRegistry:
+    """
+    Builds SQL agents once per table set and hands out the same AgentExecutor on every call.
+    The engine (and its connection pool) is shared by all table sets. Databases and agents are rebuilt once their reflected schema is older than schema_ttl_seconds.
+    """
+
+    def __init__(self, database_uri=None, schema_ttl_seconds=3600, pool_size=5, max_overflow=5):
+        self.database_uri = database_uri
+        self.schema_ttl_seconds = schema_ttl_seconds
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self._lock = threading.Lock()
+        self._engine = None
+        self._entries = {}
+
+    def get_engine(self):
+        from sqlalchemy import create_engine
+        from langchain.sql_database import SQLDatabase
+
+        with self._lock:
+            if self._engine is None:
+                if self.database_uri and self.database_uri.startswith("sqlite"):
+                    self._engine = create_engine(self.database_uri, connect_args={"check_same_thread": False})
+                elif self.database_uri:
+                    self._engine = create_engine(self.database_uri, pool_size=self.pool_size,
+                                                 max_overflow=self.max_overflow, pool_pre_ping=True)
+                else:
+                    db = SQLDatabase.from_databricks(catalog="genai", schema="data", host=config.get("DATABRICKS_HOST"),
+                                                     warehouse_id=config.get("warehouse_id"),
+                                                     engine_args={"pool_size": self.pool_size, "max_overflow": self.max_overflow,
+                                                                  "pool_pre_ping": True})
+                    self._engine = db._engine
+                instrument_engine(self._engine)
+            return self._engine
+
+    def _build_database(self, include_tables):
+        from langchain.sql_database import SQLDatabase
+
+        engine = self.get_engine()
+        db = SQLDatabase(engine, include_tables=include_tables)
+        #Sample rows are read once here, instead of every time the agent asks for the schema.
+        #Set on the same instance, as a second SQLDatabase would reflect every table again.
+        db._custom_table_info = {table: db.get_table_info([table]) for table in db.get_usable_table_names()}
+        return db
+
+    def get_database(self, include_tables=None):
+        return self._get_entry(include_tables)["db"]
+
+    def get_agent(self, include_tables=None, **agent_kwargs):
+        """Return the shared SQL agent for include_tables. agent_kwargs are passed to create_sql_agent on (re)build."""
+        from langchain.agents import create_sql_agent
+        from langchain.agents.agent_toolkits import SQLDatabaseToolkit
+
+        entry = self._get_entry(include_tables)
+        agent_key = repr(sorted(agent_kwargs.items()))
+        with entry["lock"]:
+            if agent_key not in entry["agents"]:
+                toolkit = SQLDatabaseToolkit(db=entry["db"], llm=llm.get())
+                entry["agents"][agent_key] = create_sql_agent(llm=llm.get(), toolkit=toolkit, **agent_kwargs)
+            return entry["agents"][agent_key]
+
+    def _get_entry(self, include_tables):
+        key = tuple(sorted(include_tables)) if include_tables else None
+        with self._lock:
+            entry = self._entries.setdefault(key, {"lock": threading.Lock(), "db": None, "agents": {}, "built_at": 0.0})
+        with entry["lock"]:
+            if entry["db"] is None or time.monotonic() - entry["built_at"] > self.schema_ttl_seconds:
+                entry["db"] = self._build_database(list(key) if key else None)
+                entry["agents"] = {}
+                entry["built_at"] = time.monotonic()
+        return entry
+
+    def refresh(self):
+        """Force re-reflection of every table set on next use."""
+        with self._lock:
+            self._entries.clear()
+
+
+if get_config("use_local_sql_database", False):
+    with startup_step("local_sql_database"):
+        sql_database_uri = build_local_grocer_database(get_config("local_sql_database_path", "/tmp/grocer_local.sqlite"))
+else:
+    sql_database_uri = get_config("sql_database_uri", None)
+
+sql_agents = SQLAgentRegistry(database_uri=sql_database_uri,
+                              schema_ttl_seconds=get_config("sql_schema_ttl_seconds", 3600),
+                              pool_size=get_config("sql_pool_size", 5),
+                              max_overflow=get_config("sql_max_overflow", 5))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### LoyaltyID query templates
+# MAGIC
+# MAGIC Most user, offer and expiry questions are "fetch rows for LoyaltyID Lxxx". These are answered with one prepared, parameterized query on the shared engine. Anything else (no or several LoyaltyIDs, aggregates, comparisons) falls back to the SQL agent.
+
+# COMMAND ----------
+
+import re
+from sqlalchemy import text
+
+LOYALTY_ID_PATTERN = re.compile(r"\bL\d{3,}\b", re.IGNORECASE)
+
+#Questions needing more than a row lookup go to the SQL agent.
+COMPLEX_QUESTION_PATTERN = re.compile(
+    r"\b(how many|count|total|sum|average|avg|most|least|top|compare|between|cheapest|highest|lowest|other users|all users|every user|group by)\b",
+    re.IGNORECASE)
+
+QUERY_TEMPLATES = {
+    "users": text("""SELECT LoyaltyID, UserName, UserEmail, UserHomeStoreAddress, StoreID
+                     FROM users WHERE LoyaltyID = :loyalty_id"""),
+    "offers": text("""SELECT o.LoyaltyID, o.OfferedProductID, o.ProductName, p.UnitPrice, o.OfferLoyaltyPoints, o.OfferStartDate, o.OfferEndDate
+                      FROM offers o
+                      LEFT JOIN users u ON u.LoyaltyID = o.LoyaltyID
+                      LEFT JOIN products p ON p.ProductID = o.OfferedProductID AND p.StoreID = u.StoreID
+                      WHERE o.LoyaltyID = :loyalty_id
+                      ORDER BY o.OfferedProductID"""),
+    "transactions": text("""SELECT LoyaltyID, TransactionID, ProductID, ProductName, QuantityPurchased, ProductPurchaseDate, ProductExpiryDate,
+                            UnitPrice, TotalPrice, StoreID,
+                            CASE WHEN ProductExpiryDate < CURRENT_DATE THEN 'Expired' ELSE 'Not expired yet' END AS ExpiryStatus
+                            FROM transactions WHERE LoyaltyID = :loyalty_id
+                            ORDER BY ProductExpiryDate"""),
+}
+
+
+def match_loyalty_id_lookup(question: str):
+    """Return the LoyaltyID if question is a plain lookup for exactly one LoyaltyID, else None."""
+    loyalty_ids = {match.upper() for match in LOYALTY_ID_PATTERN.findall(question)}
+    if len(loyalty_ids) != 1 or COMPLEX_QUESTION_PATTERN.search(question):
+        return None
+    return loyalty_ids.pop()
+
+
+def run_query_template(template_name: str, loyalty_id: str) -> str:
+    with sql_agents.get_engine().connect() as connection:
+        result = connection.execute(QUERY_TEMPLATES[template_name], {"loyalty_id": loyalty_id})
+        columns = list(result.keys())
+        rows = result.fetchall()
+
+    if not rows:
+        return f"No rows found in {template_name} for LoyaltyID {loyalty_id}."
+    lines = [f"Found {len(rows)} row(s) in {template_name} for LoyaltyID {loyalty_id}:"]
+    for number, row in enumerate(rows, start=1):
+        lines.append(f"{number}. " + ", ".join(f"{column}: {value}" for column, value in zip(columns, row)))
+    return "\n".join(lines)
+
+
+def answer_with_query_template(template_name: str, question: str):
+    """Answer question with a prepared query. Returns None when the SQL agent should handle it instead."""
+    if not get_config("sql_query_templates", True):
+        return None
+    loyalty_id = match_loyalty_id_lookup(question)
+    if loyalty_id is None:
+        return None
+    try:
+        return run_query_template(template_name, loyalty_id)
+    except Exception as e:
+        print(f"Query template {template_name} failed, falling back to SQL agent: {e}")
+        return None
+
+
+def sql_agent_kwargs() -> dict:
+    """create_sql_agent settings shared by the tools. The caps stop a confused agent from looping through sql_db_query or pulling whole tables."""
+    return {"verbose": True, "top_k": get_config("sql_top_k", 100),
+            "max_iterations": get_config("sql_agent_max_iterations", 8),
+            "max_execution_time": get_config("sql_agent_max_execution_seconds", 30),
+            "agent_executor_kwargs": {"handle_parsing_errors": True}}
+
+
+def answer_from_tables(template_name: str, include_tables: list, question: str) -> str:
+    """Query template when the question matches one, else the shared SQL agent for include_tables."""
+    response=answer_with_query_template(template_name, question)
+    if response is None:
+        agent = sql_agents.get_agent(include_tables, **sql_agent_kwargs())
+        response=agent.run(question)
+    return response
+
+
+async def aanswer_from_tables(template_name: str, include_tables: list, question: str) -> str:
+    """Async answer_from_tables."""
+    response=await run_blocking(answer_with_query_template, template_name, question)
+    if response is None:
+        agent = await run_blocking(functools.partial(sql_agents.get_agent, include_tables, **sql_agent_kwargs()))
+        response=(await agent.ainvoke({"input": question}))["output"]
+    return response
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Structured output
+# MAGIC
+# MAGIC Single LLM call returning JSON validated against a pydantic schema. Uses the endpoint's JSON mode (`response_format`) when it supports it, and only retries when the output fails validation.
+
+# COMMAND ----------
+
+from typing import List
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+
+def extract_json_object(content: str) -> dict:
+    """Parse the first JSON object in an LLM reply, tolerating code fences and text around it."""
+    start = content.find("{")
+    end = content.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("No JSON object found in model output")
+    return json.loads(content[start:end + 1])
+
+
+def _schema_prompt(prompt: str, schema) -> str:
+    return f"""{prompt}
+    Return only a JSON object matching this JSON schema, with no other text: {json.dumps(schema.model_json_schema())}"""
+
+
+def _retry_prompt(schema_prompt: str, content: str, error) -> str:
+    return f"""{schema_prompt}
+    Your previous output was invalid ({error}). Previous output: {content}"""
+
+
+def _json_mode_rejected(error) -> bool:
+    """True when the endpoint rejected response_format, so the call should be repeated without it."""
+    return "response_format" in str(error)
+
+
+def _structured_exchange(prompt: str, schema, max_retries=None):
+    """Request/validate/retry loop shared by invoke_structured and ainvoke_structured.
+
+    Yields each request and is sent back the reply content. Returns the validated schema instance.
+    """
+    if max_retries is None:
+        max_retries = get_config("structured_output_retries", 2)
+
+    schema_prompt = _schema_prompt(prompt, schema)
+    request = schema_prompt
+    last_error = None
+    for attempt in range(max_retries + 1):
+        content = yield request
+        try:
+            return schema.model_validate(extract_json_object(content))
+        except (ValueError, ValidationError) as e:
+            last_error = e
+            request = _retry_prompt(schema_prompt, content, e)
+    raise ValueError(f"Model output did not match {schema.__name__} after {max_retries + 1} attempts: {last_error}")
+
+
+def invoke_structured(prompt: str, schema, max_retries=None, json_mode=None):
+    """Invoke the llm once and validate the reply against schema. Retries only on schema failure.
+
+    json_mode defaults to llm_json_mode. If the endpoint rejects response_format, the rest of this call runs without it.
+    """
+    json_mode = get_config("llm_json_mode", True) if json_mode is None else json_mode
+    exchange = _structured_exchange(prompt, schema, max_retries)
+    request = next(exchange)
+    while True:
+        if json_mode:
+            try:
+                response = llm.bind(response_format=JSON_RESPONSE_FORMAT).invoke(request)
+            except Exception as e:
+                if not _json_mode_rejected(e):
+                    raise
+                json_mode = False
+                response = llm.invoke(request)
+        else:
+            response = llm.invoke(request)
+        try:
+            request = exchange.send(response.content)
+        except StopIteration as done:
+            return done.value
+
+
+async def ainvoke_structured(prompt: str, schema, max_retries=None, json_mode=None):
+    """Async invoke_structured."""
+    json_mode = get_config("llm_json_mode", True) if json_mode is None else json_mode
+    exchange = _structured_exchange(prompt, schema, max_retries)
+    request = next(exchange)
+    while True:
+        if json_mode:
+            try:
+                response = await llm.bind(response_format=JSON_RESPONSE_FORMAT).ainvoke(request)
+            except Exception as e:
+                if not _json_mode_rejected(e):
+                    raise
+                json_mode = False
+                response = await llm.ainvoke(request)
+        else:
+            response = await llm.ainvoke(request)
+        try:
+            request = exchange.send(response.content)
+        except StopIteration as done:
+            return done.value
+
+
+class InventoryRequest(BaseModel):
+    """Products and store IDs to check, extracted from the inventory tool input."""
+    products: List[str] = Field(description="Product names mentioned in the message. Never invent products.")
+    stores: List[str] = Field(description="Store IDs mentioned in the message, e.g. ['1','2'].")
+
+    @field_validator("products", "stores", mode="before")
+    @classmethod
+    def _as_strings(cls, values):
+        return [str(value).strip() for value in values] if isinstance(values, list) else values
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Semantic cache
+# MAGIC
+# MAGIC LRU cache with a TTL and hit/miss counters. The exact tier matches normalized query text. The optional similarity tier matches query embeddings above `similarity_threshold`, so "milkshake recipe" can reuse "how to make milkshake".
+# MAGIC
+# MAGIC `TableChangeWatcher` polls the latest Delta commit version of a table in the background and calls back when it moves. Failed checks back off and retry, so a warehouse timeout doesn't stop invalidation.
+
+# COMMAND ----------
+
+import string
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticCache:
+    """Thread-safe LRU + TTL cache keyed on normalized text, with an optional embedding similarity tier."""
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, embed_fn=None, similarity_threshold=0.9, normalize_keys=True):
+        self.max_entries = max_entries
+        self.normalize_keys = normalize_keys
+        self.ttl_seconds = ttl_seconds
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query) -> str:
+        query = str(query).lower().translate(str.maketrans("", "", string.punctuation))
+        return " ".join(query.split())
+
+    def _embed(self, key):
+        vector = np.asarray(self.embed_fn([key]), dtype=np.float32)[0]
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, query):
+        """Return the cached value for query, or None on a miss."""
+        key = self.normalize(query) if self.normalize_keys else str(query)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["stored_at"] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry["value"]
+            if entry is not None:
+                del self._entries[key]
+            candidates = [(cached_key, cached["vector"]) for cached_key, cached in self._entries.items()
+                          if cached["vector"] is not None and now - cached["stored_at"] <= self.ttl_seconds]
+
+        if self.embed_fn is not None and candidates:
+            scores = np.stack([vector for _, vector in candidates]) @ self._embed(key)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity_threshold:
+                with self._lock:
+                    entry = self._entries.get(candidates[best][0])
+                    if entry is not None:
+                        self._entries.move_to_end(candidates[best][0])
+                        self.similar_hits += 1
+                        return entry["value"]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query, value):
+        key = self.normalize(query) if self.normalize_keys else str(query)
+        vector = self._embed(key) if self.embed_fn is not None else None
+        with self._lock:
+            self._entries[key] = {"value": value, "vector": vector, "stored_at": time.monotonic()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "exact_hits": self.exact_hits,
+                    "similar_hits": self.similar_hits, "misses": self.misses}
+
+
+def latest_table_version(table_name):
+    """Latest Delta commit version of table_name, read through the shared SQL engine."""
+    with sql_agents.get_engine().connect() as connection:
+        return connection.execute(text(f"DESCRIBE HISTORY {table_name} LIMIT 1")).first()._mapping["version"]
+
+
+class TableChangeWatcher:
+    """Background poller calling on_change whenever the latest commit version of table_name moves.
+
+    Failed checks are retried with exponential backoff, capped at max_backoff_seconds. The last known version is kept meanwhile, so a change made during an outage still calls on_change.
+    """
+
+    def __init__(self, table_name, on_change, check_interval=60, get_version=latest_table_version, max_backoff_seconds=900, enabled=True):
+        self.table_name = table_name
+        self.on_change = on_change
+        self.check_interval = check_interval
+        self.get_version = get_version
+        self.max_backoff_seconds = max_backoff_seconds
+        self.enabled = enabled
+        self.version = None
+        self.failures = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def check(self):
+        version = self.get_version(self.table_name)
+        if self.version is not None and version != self.version:
+            print(f"{self.table_name} changed (version {self.version} -> {version})")
+            self.on_change()
+        elif self.version is None and self.failures:
+            #No version was known before the failures, so entries cached meanwhile can't be checked against one.
+            self.on_change()
+        self.version = version
+        self.failures = 0
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.check()
+                delay = self.check_interval
+            except Exception as e:
+                self.failures += 1
+                delay = min(self.max_backoff_seconds, self.check_interval * 2 ** self.failures)
+                print(f"Checking {self.table_name} for changes failed ({e}), retrying in {delay:.0f}s")
+            self._stopped.wait(delay)
+
+    def start(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"watch-{self.table_name}", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Persistent cache
+# MAGIC
+# MAGIC Small on-disk key/value cache in a local SQLite file, shared by every worker process on the host. Values are stored as JSON with an expiry time, one namespace per kind of value.
+# MAGIC
+# MAGIC `RateLimiter` spaces out calls to an external API process-wide. `SingleFlight` makes concurrent misses for the same key wait on a single computation.
+
+# COMMAND ----------
+
+class SQLiteKVCache:
+    """JSON values in a SQLite table keyed by (namespace, key), with per entry expiry."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS kv_cache (
+                namespace TEXT, key TEXT, value TEXT, expires_at REAL, PRIMARY KEY (namespace, key))""")
+
+    def get(self, namespace, key):
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires_at FROM kv_cache WHERE namespace = ? AND key = ?",
+                                           (namespace, key)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def put(self, namespace, key, value, ttl_seconds):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO kv_cache VALUES (?, ?, ?, ?)",
+                                     (namespace, key, json.dumps(value), time.time() + ttl_seconds))
+
+    def clear(self, namespace):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM kv_cache WHERE namespace = ?", (namespace,))
+
+
+class RateLimiter:
+    """Allows at most one call every min_interval seconds across all threads."""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def _reserve(self) -> float:
+        """Book the next free slot. Returns how long the caller has to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+        return slot - now
+
+    def wait(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SingleFlight:
+    """Runs compute once per key at a time. Concurrent callers for the same key wait and share the result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, compute):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "value": None, "error": None}
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["value"]
+        try:
+            call["value"] = compute()
+            return call["value"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+
+def cached_lookup(memory_cache, disk_cache, single_flight, namespace, key, compute, ttl_seconds):
+    """Memory, then disk, then compute (once per key across threads). None results are not cached."""
+    value = memory_cache.get(key)
+    if value is not None:
+        return value
+
+    def load():
+        value = disk_cache.get(namespace, key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                disk_cache.put(namespace, key, value, ttl_seconds)
+        return value
+
+    value = single_flight.do((namespace, key), load)
+    if value is not None:
+        memory_cache.put(key, value)
+    return value
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Async helpers
+# MAGIC
+# MAGIC Every tool also has a native async implementation, registered with `coroutine=`, so one serving worker can multiplex many conversations on an event loop. LLM calls and agents use langchain's `ainvoke` and geocoding uses geopy's aiohttp adapter. The Vector Search SDK, SQL connector and meteostat have no async client, so those calls run on one bounded thread pool via `run_blocking`. Email goes through the background outbox.
+
+# COMMAND ----------
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+blocking_io_pool = ThreadPoolExecutor(max_workers=get_config("blocking_io_max_workers", 32), thread_name_prefix="blocking-io")
+
+
+async def run_blocking(func, *args, executor=None):
+    """Run a blocking call off the event loop, on executor (default blocking_io_pool), keeping context variables."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor or blocking_io_pool, functools.partial(context.run, func, *args))
+
+
+_async_inflight = {}
+
+
+async def acached_lookup(memory_cache, disk_cache, namespace, key, acompute, ttl_seconds):
+    """Async cached_lookup. Concurrent misses for the same key on an event loop await one acompute()."""
+    value = memory_cache.get(key)
+    if value is not None:
+        return value
+
+    async def load():
+        value = await run_blocking(disk_cache.get, namespace, key)
+        if value is None:
+            value = await acompute()
+            if value is not None:
+                await run_blocking(disk_cache.put, namespace, key, value, ttl_seconds)
+        return value
+
+    inflight_key = (id(asyncio.get_running_loop()), namespace, key)
+    task = _async_inflight.get(inflight_key)
+    if task is None:
+        task = _async_inflight[inflight_key] = asyncio.ensure_future(load())
+        task.add_done_callback(lambda _: _async_inflight.pop(inflight_key, None))
+    value = await asyncio.shield(task)
+    if value is not None:
+        memory_cache.put(key, value)
+    return value
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### User profile
+# MAGIC
+# MAGIC The `users` row is fetched once, when a LoyaltyID first shows up in the conversation. It is kept as typed fields in the graph state (`user_profile`). For each tool call, the tool node puts the profile in the `current_user_profile` context variable. Tools read the StoreID, address and email from the profile instead of parsing them out of the model's input. Stateless turns reuse profiles from a small in-process cache.
+
+# COMMAND ----------
+
+from contextvars import ContextVar
+from typing import Annotated, Optional
+from langchain_core.messages import HumanMessage
+from langgraph.managed.is_last_step import IsLastStepManager
+from langgraph.prebuilt.chat_agent_executor import AgentState
+
+
+class UserProfile(BaseModel):
+    """One row of the users table."""
+    loyalty_id: str
+    name: Optional[str] = None
+    email: Optional[str] = None
+    home_store_address: Optional[str] = None
+    store_id: Optional[str] = None
+
+    def describe(self) -> str:
+        return (f"LoyaltyID: {self.loyalty_id}, UserName: {self.name}, UserEmail: {self.email}, "
+                f"UserHomeStoreAddress: {self.home_store_address}, StoreID: {self.store_id}")
+
+
+class TurnLastStepManager(IsLastStepManager):
+    """is_last_step counted from the first step of the current turn (turn_start_step in configurable, set by conversation_call).
+
+    langgraph counts it from the first step of the thread, while the recursion limit itself is per invocation. On a checkpointed thread, a turn past step recursion_limit - 1 would otherwise have its tool calls replaced with "need more steps".
+    """
+
+    def __call__(self, step: int) -> bool:
+        #-1 is where a fresh thread starts, which gives langgraph's own step == recursion_limit - 1.
+        start = self.config.get("configurable", {}).get("turn_start_step", -1)
+        return step - start == self.config.get("recursion_limit", 0)
+
+
+class UserProfileState(AgentState):
+    is_last_step: Annotated[bool, TurnLastStepManager]
+    #UserProfile.model_dump(), so checkpoints stay plain JSON.
+    user_profile: Optional[dict]
+
+
+current_user_profile: ContextVar[Optional[UserProfile]] = ContextVar("current_user_profile", default=None)
+user_profile_cache = SemanticCache(max_entries=get_config("user_profile_cache_entries", 4096),
+                                   ttl_seconds=get_config("user_profile_ttl_seconds", 300))
+
+
+def fetch_user_profile(loyalty_id: str) -> Optional[UserProfile]:
+    cached = user_profile_cache.get(loyalty_id)
+    if cached is not None:
+        return cached
+    with sql_agents.get_engine().connect() as connection:
+        row = connection.execute(QUERY_TEMPLATES["users"], {"loyalty_id": loyalty_id}).mappings().first()
+    if row is None:
+        return None
+    profile = UserProfile(loyalty_id=str(row["LoyaltyID"]), name=row["UserName"], email=row["UserEmail"],
+                          home_store_address=row["UserHomeStoreAddress"],
+                          store_id=None if row["StoreID"] is None else str(row["StoreID"]))
+    user_profile_cache.put(loyalty_id, profile)
+    return profile
+
+
+def latest_loyalty_id(messages) -> Optional[str]:
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage) and isinstance(message.content, str):
+            loyalty_ids = LOYALTY_ID_PATTERN.findall(message.content)
+            if loyalty_ids:
+                return loyalty_ids[-1].upper()
+    return None
+
+
+def resolve_user_profile(state) -> Optional[UserProfile]:
+    """Profile for the LoyaltyID the user gave last. Only queries the users table when that LoyaltyID changes."""
+    profile = state.get("user_profile")
+    profile = UserProfile.model_validate(profile) if profile else None
+    loyalty_id = latest_loyalty_id(state["messages"])
+    if loyalty_id is None or (profile is not None and profile.loyalty_id == loyalty_id):
+        return profile
+    try:
+        return fetch_user_profile(loyalty_id) or profile
+    except Exception as e:
+        print(f"Could not fetch the user profile for {loyalty_id}: {e}")
+        return profile
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -87,14 +1681,7 @@ uc_function_tools = (
 # COMMAND ----------
 
 def search_database(query_str: str) -> str:
-    from langchain.agents import create_sql_agent
-    from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-    from langchain.sql_database import SQLDatabase
-
-    db = SQLDatabase.from_databricks(catalog="genai", schema="data",host=config.get("DATABRICKS_HOST"),
-                                         warehouse_id=config.get("warehouse_id"))
-    toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-    agent = create_sql_agent(llm=llm, toolkit=toolkit, verbose=True,top_k=100000)
+    agent = sql_agents.get_agent(**sql_agent_kwargs())
 
     response=agent.run(query_str)
     return response
@@ -103,84 +1690,302 @@ def search_database(query_str: str) -> str:
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Local product replica
+# MAGIC
+# MAGIC Optional in-memory copy of `genai.data.products` for the inventory hot path. Product name embeddings live in one contiguous float32 matrix with a per store row index and are searched by vectorized cosine similarity. The replica reloads from the table every `product_replica_refresh_seconds`, in the background.
+# MAGIC
+# MAGIC The remote `genai.llm.product_vsindex` stays as the fallback, and as the reference for `compare_replica_with_remote`. The embedding function is pluggable: `hashing_embedder` is deterministic and needs no endpoint.
+
+# COMMAND ----------
+
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+
+def hashing_embedder(texts, dim=256):
+    """Deterministic local embedder. Hashes character trigrams of each text into a dim sized vector."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        padded = f"  {str(text).lower()} "
+        for j in range(len(padded) - 2):
+            vectors[i, zlib.crc32(padded[j:j + 3].encode()) % dim] += 1.0
+    return vectors
+
+
+def build_product_embeddings():
+    #Deferred import, like the llm.
+    from langchain_community.embeddings import DatabricksEmbeddings
+    return DatabricksEmbeddings(endpoint=get_config("product_embedding_endpoint", "databricks-bge-large-en"))
+
+
+# Create the embeddings client on first use, then reuse it for every call
+product_embeddings = Lazy("product_embeddings", build_product_embeddings)
+
+
+def databricks_embedder(texts):
+    """Embeds with the Databricks embedding endpoint the product index uses."""
+    return product_embeddings.embed_documents(list(texts))
+
+
+def load_product_rows():
+    """Read the catalog through the shared SQL engine."""
+    with sql_agents.get_engine().connect() as connection:
+        result = connection.execute(text("SELECT ProductID, UnitPrice, StoreID, ProductName FROM products"))
+        return [dict(row._mapping) for row in result]
+
+
+class LocalProductReplica:
+    """
+    In-memory vector replica of the product catalog with the same similarity_search interface as a Vector Search index.
+    embed_fn maps a list of texts to a (n, dim) array. load_rows returns product rows with INVENTORY_COLUMNS.
+    """
+
+    def __init__(self, embed_fn, load_rows, refresh_seconds=900, query_cache_size=4096):
+        self.embed_fn = embed_fn
+        self.load_rows = load_rows
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+        self._snapshot = None
+        self._embed_query = lru_cache(maxsize=query_cache_size)(self._embed_query_uncached)
+
+    def _embed_query_uncached(self, query_text):
+        vector = np.asarray(self.embed_fn([query_text]), dtype=np.float32)[0]
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def refresh(self):
+        """Reload rows and rebuild the matrix. The old snapshot keeps serving until the new one is swapped in."""
+        rows = self.load_rows()
+        matrix = np.ascontiguousarray(self.embed_fn([row["ProductName"] for row in rows]), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        store_rows = {}
+        for i, row in enumerate(rows):
+            store_rows.setdefault(str(row["StoreID"]), []).append(i)
+        snapshot = {"rows": rows, "matrix": matrix, "loaded_at": time.monotonic(),
+                    "all_rows": np.arange(len(rows)),
+                    "store_rows": {store: np.asarray(indices) for store, indices in store_rows.items()}}
+        with self._lock:
+            self._snapshot = snapshot
+        return len(rows)
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Product replica refresh failed, keeping previous snapshot: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _get_snapshot(self):
+        if self._snapshot is None:
+            #First use loads synchronously, once.
+            with self._load_lock:
+                if self._snapshot is None:
+                    self.refresh()
+        elif time.monotonic() - self._snapshot["loaded_at"] > self.refresh_seconds:
+            #One refresh at a time. Each one re-embeds the whole catalog.
+            with self._lock:
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            if start_refresh:
+                threading.Thread(target=self._background_refresh, name="product-replica-refresh", daemon=True).start()
+        return self._snapshot
+
+    def describe(self):
+        snapshot = self._get_snapshot()
+        return {"status": {"ready": True}, "num_rows": len(snapshot["rows"])}
+
+    def similarity_search(self, query_text, columns, num_results=10, filters=None, **kwargs):
+        snapshot = self._get_snapshot()
+        candidates = snapshot["all_rows"]
+        store_filter = (filters or {}).get("StoreID")
+        if store_filter is not None:
+            stores = store_filter if isinstance(store_filter, (list, tuple, set)) else [store_filter]
+            indices = [snapshot["store_rows"][str(store)] for store in stores if str(store) in snapshot["store_rows"]]
+            candidates = np.concatenate(indices) if indices else np.empty(0, dtype=np.int64)
+
+        scores = snapshot["matrix"][candidates] @ self._embed_query(query_text)
+        top = np.argsort(-scores, kind="stable")[:num_results]
+        data_array = [[snapshot["rows"][candidates[i]].get(column) for column in columns] + [float(scores[i])] for i in top]
+        return {"manifest": {"columns": [{"name": column} for column in columns] + [{"name": "score"}]},
+                "result": {"row_count": len(data_array), "data_array": data_array}}
+
+
+def compare_replica_with_remote(queries, store_ids):
+    """Top-1 ProductID agreement between the local replica and the remote index, per (query, store)."""
+    agreements = []
+    for query in queries:
+        for store_id in store_ids:
+            kwargs = dict(query_text=query, columns=INVENTORY_COLUMNS, num_results=1, filters={"StoreID": str(store_id)})
+            local = product_replica.similarity_search(**kwargs)["result"]["data_array"]
+            remote = vector_indexes.similarity_search(PRODUCT_VS_ENDPOINT, PRODUCT_VS_INDEX, **kwargs)["result"]["data_array"]
+            agreements.append(bool(local) == bool(remote) and (not local or local[0][0] == remote[0][0]))
+    return sum(agreements) / len(agreements) if agreements else 1.0
+
+
+def search_products(**search_kwargs):
+    """Product similarity search, from the local replica when enabled and from the remote index otherwise."""
+    if product_replica is not None:
+        try:
+            return product_replica.similarity_search(**search_kwargs)
+        except Exception as e:
+            print(f"Local product replica failed, using remote index: {e}")
+    return vector_indexes.similarity_search(PRODUCT_VS_ENDPOINT, PRODUCT_VS_INDEX, **search_kwargs)
+
+
+INVENTORY_COLUMNS = ["ProductID", "UnitPrice", "StoreID", "ProductName"]
+
+product_replica = None
+if get_config("local_product_replica", False):
+    product_replica = LocalProductReplica(
+        embed_fn=hashing_embedder if get_config("product_replica_embedder", "databricks") == "hashing" else databricks_embedder,
+        load_rows=load_product_rows,
+        refresh_seconds=get_config("product_replica_refresh_seconds", 900))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Inventory Tool
 
 # COMMAND ----------
 
+#Shared by all sessions, so concurrent inventory checks can't flood the vector search endpoint.
+inventory_search_pool = ThreadPoolExecutor(max_workers=get_config("inventory_search_max_workers", 8),
+                                           thread_name_prefix="inventory-search")
+
+
+def inventory_record(store, product, row):
+    """Per (store, product) record handed to the LLM. row is a similarity_search data_array row, or None."""
+    if row is None:
+        return {"store":store,"product":product,"found_product_name":"No Same or similiar product found","found_product_id":f"""No product found for {store}""","similiarity_score":0}
+    return {"store":store,
+            "product":product,
+            "found_product_name":row[-2],
+            "found_product_id":row[0],
+            "found_product_price":row[1],
+            "product_id":row[0],
+            "similiarity_score":row[-1]}
+
+
+def get_product_details(product_details: str,store_id: str) -> str:
+    results = search_products(
+            query_text=product_details,
+            columns=INVENTORY_COLUMNS,
+            num_results=1,
+            filters={"StoreID": store_id}
+            )
+    content=results#['result']['data_array'][0][1]    
+    return content
+
+
+def get_product_details_for_stores(product_details: str, store_list: list) -> dict:
+    """One search covering every store in store_list. Returns the best row per store."""
+    num_results = len(store_list) * get_config("inventory_results_per_store", 3)
+    results = search_products(
+            query_text=product_details,
+            columns=INVENTORY_COLUMNS,
+            num_results=num_results,
+            filters={"StoreID": [str(store) for store in store_list]}
+            )
+    best_rows = {}
+    #Rows come back ordered by score, so the first row seen for a store is its best match.
+    for row in results['result']['data_array']:
+        best_rows.setdefault(str(row[2]), row)
+
+    #A full page of results may have crowded out some stores. Only then ask those stores directly.
+    if results['result']['row_count'] >= num_results:
+        for store in store_list:
+            if str(store) not in best_rows:
+                result = get_product_details(product_details, str(store))
+                if result['result']['row_count'] > 0:
+                    best_rows[str(store)] = result['result']['data_array'][0]
+    return best_rows
+
+
+def merge_inventory_records(product_list, store_list, rows_by_product):
+    return [inventory_record(store, product, rows_by_product[product].get(str(store)))
+            for store in store_list for product in product_list]
+
+
+def collect_inventory_records(product_list, store_list):
+    results=[]
+    if get_config("inventory_batched_search", True):
+        #One query per product for all stores, run concurrently, then merged back into per (store, product) records.
+        #Each search runs in a copy of the caller's context, so it keeps the turn budget and stage label, as run_blocking does.
+        futures = [inventory_search_pool.submit(contextvars.copy_context().run, get_product_details_for_stores, product, store_list)
+                   for product in product_list]
+        rows_by_product = dict(zip(product_list, (future.result() for future in futures)))
+        results = merge_inventory_records(product_list, store_list, rows_by_product)
+    else:
+        for store in store_list:
+            for product in product_list:
+                result=get_product_details(product,store)
+                row_count=result['result']['row_count']
+                results.append(inventory_record(store, product, result['result']['data_array'][0] if row_count>0 else None))
+    return results
+
+
+async def acollect_inventory_records(product_list, store_list):
+    """Async collect_inventory_records. The searches still run on inventory_search_pool, as the Vector Search SDK is blocking."""
+    if not get_config("inventory_batched_search", True):
+        return await run_blocking(collect_inventory_records, product_list, store_list)
+    rows = await asyncio.gather(*(run_blocking(get_product_details_for_stores, product, store_list, executor=inventory_search_pool)
+                                  for product in product_list))
+    return merge_inventory_records(product_list, store_list, dict(zip(product_list, rows)))
+
+
+def inventory_extraction_prompt(message: str) -> str:
+    #One extraction call for both lists.
+    return f"""You will extract the list of products and the list of store ids from the message. You will not generate any product name or store id which is not recieved by you. Here is the message: {message}."""
+
+
+def inventory_stores(inventory_request) -> list:
+    """Store IDs from the request, else the user's home store from the session profile."""
+    profile = current_user_profile.get()
+    if not inventory_request.stores and profile is not None and profile.store_id:
+        return [profile.store_id]
+    return inventory_request.stores
+
+
+def inventory_analysis_prompt(results) -> str:
+    inventory_check_info=str(results)
+    return f"""You will do comparision between product name and found product name recieved. Your decisons are not impacted by similiarity scores. Then you will decide if we can conclusively say that product is available or not. Provide only summarized inventory check in a single sentence, store wise. You will use the product field to mention if a product is available or not. You will only mention the found product name, found product id and found product price as recieved by you only against products you concluded as available. You will not generate any non factual details which is not in the input to you. {inventory_check_info}"""
+
+
 def get_availabiility_price():
     
     def get_product_availability_and_price(products_user_store_details: str)-> str:
 
-        def get_product_details(product_details: str,store_id: str) -> str:
-            import os
-            workspace_url = os.environ.get("WORKSPACE_URL")
-
-
-            client = VectorSearchClient(
-            workspace_url=workspace_url,disable_notice=True)
+        try:
+            inventory_request=invoke_structured(inventory_extraction_prompt(products_user_store_details), InventoryRequest)
+            results=collect_inventory_records(inventory_request.products, inventory_stores(inventory_request))
+            response=llm.invoke(inventory_analysis_prompt(results))
+            inventory_analysis=response.content
+        except Exception as e:
+            inventory_analysis=f"""Unable to check inventory. Following error: {e}"""
+        return inventory_analysis
 
-            index = client.get_index(endpoint_name='product_vs_endpoint', index_name="genai.llm.product_vsindex")
-            results = index.similarity_search( query_text=product_details,
-                    columns=["ProductID", "UnitPrice","StoreID","ProductName"],
-                    num_results=1,
-                    filters={"StoreID": store_id}
-                    )
-            content=results#['result']['data_array'][0][1]    
-            return content
+    async def aget_product_availability_and_price(products_user_store_details: str)-> str:
 
         try:
-            message=products_user_store_details
-
-            product_list_prompt=f"""You will only output list of products from the message. You will not generate any other text. You will not output anything other than a list. You will not generate any product name which is not recieved by you. Here is the message: {message}. Example of output is: ['grapes','juice']."""
-            product_list_response=llm.invoke(product_list_prompt)
-            product_list_content=product_list_response.content
-            import ast
-            product_list=ast.literal_eval(product_list_content)
-
-            store_list_prompt=f"""You will only output list of store id from the message. You will not generate any other text. You will not output anything other than a list. You will not generate any product name which is not recieved by you. Here is the message: {message}. Example of output is: ['1','2']."""
-            store_list_response=llm.invoke(store_list_prompt)
-            store_list_content=store_list_response.content
-            import ast
-            store_list=ast.literal_eval(store_list_content)
-
-            # print (product_list,store_list)
-
-            results=[]
-            for store in store_list:
-                for product in product_list:
-                    result=get_product_details(product,store)
-                    row_count=result['result']['row_count']
-                    if row_count>0:
-                        score=result['result']['data_array'][0][-1]
-                        found_product_name=result['result']['data_array'][0][-2]
-                        found_product_id=result['result']['data_array'][0][0]
-                        found_product_price=result['result']['data_array'][0][1]
-                        results.append(
-                            {"store":store,
-                             "product":product,
-                             "found_product_name":found_product_name,
-                             "found_product_id":found_product_id,
-                             "found_product_price":found_product_price,
-                             "product_id":found_product_id,
-                             "similiarity_score":score})
-                    else:
-                        results.append({"store":store,"product":product,"found_product_name":"No Same or similiar product found","found_product_id":f"""No product found for {store}""","similiarity_score":0})
-
-            # print (results)
-
-            inventory_check_info=str(results)
-
-            prompt=f"""You will do comparision between product name and found product name recieved. Your decisons are not impacted by similiarity scores. Then you will decide if we can conclusively say that product is available or not. Provide only summarized inventory check in a single sentence, store wise. You will use the product field to mention if a product is available or not. You will only mention the found product name, found product id and found product price as recieved by you only against products you concluded as available. You will not generate any non factual details which is not in the input to you. {inventory_check_info}"""
-            response=llm.invoke(prompt)
+            inventory_request=await ainvoke_structured(inventory_extraction_prompt(products_user_store_details), InventoryRequest)
+            results=await acollect_inventory_records(inventory_request.products, inventory_stores(inventory_request))
+            response=await llm.ainvoke(inventory_analysis_prompt(results))
             inventory_analysis=response.content
         except Exception as e:
             inventory_analysis=f"""Unable to check inventory. Following error: {e}"""
         return inventory_analysis
     
     get_product_availability_and_price_tool = StructuredTool.from_function(func=get_product_availability_and_price,
+                                              coroutine=aget_product_availability_and_price,
                                               name='get_product_availability_and_price',
-                                              description='Use this tool to check for the product availability and product price, given list of Product Names and List of User Store ID. Never pass User ID. It will return its analysis.')
+                                              description='Use this tool to check for the product availability and product price, given list of Product Names and List of User Store ID. The user home store is used when no Store ID is given. Never pass User ID. It will return its analysis.')
 
     return get_product_availability_and_price_tool
 
@@ -197,25 +2002,25 @@ def get_user_info():
     Input to this tool is user Loyalty ID and related question This tool will help you get details from user data.
     :return: results fetched from data.
     """
-    def get_user_details(user_question_with_loyalty_id: str) -> str:
-
-        from langchain.agents import create_sql_agent
-        from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-        from langchain.sql_database import SQLDatabase
+    def profile_answer(user_question_with_loyalty_id: str):
+        #The session profile already holds the row a plain lookup would return.
+        profile = current_user_profile.get()
+        if profile is not None and match_loyalty_id_lookup(user_question_with_loyalty_id) == profile.loyalty_id:
+            return f"Found 1 row(s) in users for LoyaltyID {profile.loyalty_id}:\n1. {profile.describe()}"
+        return None
 
-        db = SQLDatabase.from_databricks(catalog="genai", schema="data",host=config.get("DATABRICKS_HOST"),
-                                         warehouse_id=config.get("warehouse_id"),include_tables=["users"])
-        toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-        agent = create_sql_agent(llm=llm, toolkit=toolkit, verbose=True,top_k=100000,
-                                 agent_executor_kwargs={"handle_parsing_errors": True}
-                                 )
+    def get_user_details(user_question_with_loyalty_id: str) -> str:
 
-        response=agent.run(user_question_with_loyalty_id)
+        response=profile_answer(user_question_with_loyalty_id) or answer_from_tables("users", ["users"], user_question_with_loyalty_id)
         
         
         return response
 
+    async def aget_user_details(user_question_with_loyalty_id: str) -> str:
+        return profile_answer(user_question_with_loyalty_id) or await aanswer_from_tables("users", ["users"], user_question_with_loyalty_id)
+
     get_user_details_tool = StructuredTool.from_function(func=get_user_details,
+                                              coroutine=aget_user_details,
                                               name='get_user_details',
                                               description='Input to this tool is user Loyalty ID and related question. This tool will help you get details from user data.')
 
@@ -233,25 +2038,19 @@ def get_offers():
     """
     Get offered products and offered points for user if user purchases the offered products.
     :return: results fetched from data.
-    """
-    def get_offers_details(user_input: str) -> str:
-
-        from langchain.agents import create_sql_agent
-        from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-        from langchain.sql_database import SQLDatabase
-
-        db = SQLDatabase.from_databricks(catalog="genai", schema="data",host=config.get("DATABRICKS_HOST"),
-                                         warehouse_id=config.get("warehouse_id"),include_tables=["offers","products"])
-        toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-        agent = create_sql_agent(llm=llm, toolkit=toolkit, verbose=True,top_k=100000,
-                                 agent_executor_kwargs={"handle_parsing_errors": True})
+    """
+    def get_offers_details(user_input: str) -> str:
 
-        response=agent.run(user_input)
+        response=answer_from_tables("offers", ["offers","products"], user_input)
         
         
         return response
 
+    async def aget_offers_details(user_input: str) -> str:
+        return await aanswer_from_tables("offers", ["offers","products"], user_input)
+
     get_offers_details_tool = StructuredTool.from_function(func=get_offers_details,
+                                              coroutine=aget_offers_details,
                                               name='get_offers_details',
                                               description='Use this tool to get every details of offers from offer table by passing user Loyalty ID.')
 
@@ -261,6 +2060,70 @@ def get_offers():
 
 # MAGIC %md
 # MAGIC ## Festival Tool
+# MAGIC
+# MAGIC Suggestions only depend on the user's region and the current date, so they are cached per (normalized region, ISO year-week) in memory and on disk. `prewarm_festival_cache()` fills the cache for every region in the `users` table; run it from a scheduled job with `festival_cache_path` on shared storage so serving replicas pick the results up.
+
+# COMMAND ----------
+
+festival_memory_cache = SemanticCache(max_entries=1024, ttl_seconds=get_config("festival_cache_ttl_seconds", 604800), normalize_keys=False)
+festival_disk_cache = SQLiteKVCache(get_config("festival_cache_path", "/tmp/grocer_festival_cache.sqlite"))
+festival_single_flight = SingleFlight()
+
+
+def profile_address(user_details: str) -> str:
+    """Home store address from the session profile, else the address details passed by the model."""
+    profile = current_user_profile.get()
+    return profile.home_store_address if profile is not None and profile.home_store_address else user_details
+
+
+def festival_region(user_details: str) -> str:
+    """Normalized region/country from an address or user details string, e.g. "ontario canada"."""
+    return SemanticCache.normalize(",".join(user_details.split(",")[-2:]))
+
+
+def festival_prompt(region: str, today) -> str:
+    return f"""Based on user location and current date information you have, you will provide the festival which will be coming soon within couple of weeks from current date. You will provide list of 3 festival names (don't give details of festival) and one famous recipie, and ingredients prepared for each of festivals based on your knowledge. Don't give cooking instructions. Don't give date on when will be the festivals. Mention that these are AI generated, not from database in disclaimer. User Location: {region}. Current date: {today.strftime('%Y-%b-%d')}."""
+
+
+def festival_cache_key(region: str, today) -> str:
+    iso_year, iso_week, _ = today.isocalendar()
+    return f"{region}|{iso_year}-W{iso_week:02d}"
+
+
+def festival_suggestions(region: str, today=None) -> str:
+    """Cached festival suggestions for region in the ISO week of today."""
+    from datetime import datetime
+
+    today = today or datetime.today()
+
+    def compute():
+        return llm.invoke(festival_prompt(region, today)).content
+
+    return cached_lookup(festival_memory_cache, festival_disk_cache, festival_single_flight, "festivals",
+                         festival_cache_key(region, today), compute, get_config("festival_cache_ttl_seconds", 604800))
+
+
+async def afestival_suggestions(region: str, today=None) -> str:
+    """Async festival_suggestions."""
+    from datetime import datetime
+
+    today = today or datetime.today()
+
+    async def compute():
+        return (await llm.ainvoke(festival_prompt(region, today))).content
+
+    return await acached_lookup(festival_memory_cache, festival_disk_cache, "festivals",
+                                festival_cache_key(region, today), compute, get_config("festival_cache_ttl_seconds", 604800))
+
+
+def prewarm_festival_cache(max_workers=4):
+    """Generate this week's suggestions for every distinct region in the users table. Returns the regions warmed."""
+    with sql_agents.get_engine().connect() as connection:
+        addresses = [row[0] for row in connection.execute(text("SELECT DISTINCT UserHomeStoreAddress FROM users"))]
+    regions = sorted({festival_region(address) for address in addresses if address})
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(festival_suggestions, regions))
+    return regions
 
 # COMMAND ----------
 
@@ -271,15 +2134,16 @@ def get_festivals():
     """
     def suggest_for_upcoming_festivals(user_details: str) -> str:
 
-        from datetime import datetime
-        today=datetime.today().strftime('%Y-%b-%d')
-        prompt=f"""Based on user details and current date information you have, you will provide the festival which will be coming soon within couple of weeks from current date. You will provide list of 3 festival names (don't give details of festival) and one famous recipie, and ingredients prepared for each of festivals based on your knowledge. Don't give cooking instructions. Don't give date on when will be the festivals. Mention that these are AI generated, not from database in disclaimer. User Details: {user_details}. Current date: {today}."""
-        response=llm.invoke(prompt)
+        response=festival_suggestions(festival_region(profile_address(user_details)))
         
         
         return response
 
+    async def asuggest_for_upcoming_festivals(user_details: str) -> str:
+        return await afestival_suggestions(festival_region(profile_address(user_details)))
+
     suggest_for_festivals_tool = StructuredTool.from_function(func=suggest_for_upcoming_festivals,
+                                              coroutine=asuggest_for_upcoming_festivals,
                                               name='suggest_for_upcoming_festivals',
                                               description='This tool will take in user location and other details. Post that based on the festivals around current date it will return list recipies and products.')
 
@@ -302,22 +2166,16 @@ def get_expired_products():
     """
     def get_expired_products_details(product_id_and_loyalty_id_details: str) -> str:
 
-        from langchain.agents import create_sql_agent
-        from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-        from langchain.sql_database import SQLDatabase
-
-        db = SQLDatabase.from_databricks(catalog="genai", schema="data",host=config.get("DATABRICKS_HOST"),
-                                         warehouse_id=config.get("warehouse_id"),include_tables=["transactions"])
-        toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-        agent = create_sql_agent(llm=llm, toolkit=toolkit, verbose=True,top_k=100000,
-                                 agent_executor_kwargs={"handle_parsing_errors": True})
-
-        response=agent.run(product_id_and_loyalty_id_details)
+        response=answer_from_tables("transactions", ["transactions"], product_id_and_loyalty_id_details)
         
         
         return response
 
+    async def aget_expired_products_details(product_id_and_loyalty_id_details: str) -> str:
+        return await aanswer_from_tables("transactions", ["transactions"], product_id_and_loyalty_id_details)
+
     get_expired_products_details_tool = StructuredTool.from_function(func=get_expired_products_details,
+                                              coroutine=aget_expired_products_details,
                                               name='get_expired_products_details',
                                               description='This tool can be used to to get expired products details by looking in to Product Expiry Date in transactions table. Input to this tool will be Loyalty ID of user.')
 
@@ -339,21 +2197,19 @@ def search_in_all_data():
     """
     def search_in_all_grocery_data(user_input: str) -> str:
 
-        from langchain.agents import create_sql_agent
-        from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-        from langchain.sql_database import SQLDatabase
-
-        db = SQLDatabase.from_databricks(catalog="genai", schema="data",host=config.get("DATABRICKS_HOST"),
-                                         warehouse_id=config.get("warehouse_id"))
-        toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-        agent = create_sql_agent(llm=llm, toolkit=toolkit, verbose=True)
+        agent = sql_agents.get_agent(verbose=True)
 
         response=agent.run(user_input)
         
         
         return response
 
+    async def asearch_in_all_grocery_data(user_input: str) -> str:
+        agent = await run_blocking(functools.partial(sql_agents.get_agent, verbose=True))
+        return (await agent.ainvoke({"input": user_input}))["output"]
+
     search_in_all_data_tool = StructuredTool.from_function(func=search_in_all_grocery_data,
+                                              coroutine=asearch_in_all_grocery_data,
                                               name='search_in_all_grocery_data',
                                               description='Input to this tool is user question. This tool will help you get answers for user questions from backend stored data.')
 
@@ -361,6 +2217,26 @@ def search_in_all_data():
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Recipe cache
+# MAGIC
+# MAGIC Cache in front of the recipe index. The recipe table has Change Data Feed enabled in the data prep notebook, so every change to it lands as a new version and clears the cache.
+
+# COMMAND ----------
+
+recipe_cache_embedders = {"none": None, "hashing": hashing_embedder, "databricks": databricks_embedder}
+recipe_cache = SemanticCache(max_entries=get_config("recipe_cache_max_entries", 1024),
+                             ttl_seconds=get_config("recipe_cache_ttl_seconds", 86400),
+                             embed_fn=recipe_cache_embedders[get_config("recipe_cache_embedder", "none")],
+                             similarity_threshold=get_config("recipe_cache_similarity_threshold", 0.9))
+#DESCRIBE HISTORY needs Delta tables, so only the Databricks warehouse has versions to watch. e.g. not the local SQLite copy.
+recipe_table_watcher = TableChangeWatcher("genai.data.recipe", recipe_cache.invalidate,
+                                          check_interval=get_config("recipe_change_check_seconds", 60),
+                                          max_backoff_seconds=get_config("recipe_change_max_backoff_seconds", 900),
+                                          enabled=sql_database_uri is None or sql_database_uri.startswith("databricks"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Recipie Tool Vector Search Database
 
@@ -372,25 +2248,28 @@ def get_recipie():
     :return: the recipie
     """
     def get_stored_recipie(user_input: str) -> str:
-        
-        import os
-        workspace_url = os.environ.get("WORKSPACE_URL")
-
 
-        client = VectorSearchClient(
-            workspace_url=workspace_url,disable_notice=True)
+        recipe_table_watcher.start()
+        content=recipe_cache.get(user_input)
+        if content is not None:
+            return content
 
-        index = client.get_index(endpoint_name='recipie_vs_endpoint', index_name="genai.llm.recipie_vsindex")
-        results = index.similarity_search(
+        results = vector_indexes.similarity_search(RECIPIE_VS_ENDPOINT, RECIPIE_VS_INDEX,
             query_text=user_input,
             columns=["RecipieID", "content"],
             num_results=1
             )
         content=results['result']['data_array'][0][1]
+        recipe_cache.put(user_input, content)
         
         return content
 
+    async def aget_stored_recipie(user_input: str) -> str:
+        #The Vector Search SDK is blocking, so the lookup runs on the blocking I/O pool.
+        return await run_blocking(get_stored_recipie, user_input)
+
     recipie_tool = StructuredTool.from_function(func=get_stored_recipie,
+                                              coroutine=aget_stored_recipie,
                                               name='get_stored_recipie',
                                               description='This tool will help you to search for recipie for user input.')
 
@@ -398,11 +2277,125 @@ def get_recipie():
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Geocode and climate cache
+# MAGIC
+# MAGIC In-process LRU in front of the on-disk cache. Keys are normalized city/country for lat/lon, and (lat/lon bucket, ISO week) for the average temperature. Nominatim allows about one request per second, so every geocode goes through one process-wide rate limiter.
+
+# COMMAND ----------
+
+weather_disk_cache = SQLiteKVCache(get_config("weather_cache_path", "/tmp/grocer_weather_cache.sqlite"))
+geocode_memory_cache = SemanticCache(max_entries=4096, ttl_seconds=get_config("geocode_cache_ttl_seconds", 2592000))
+climate_memory_cache = SemanticCache(max_entries=4096, ttl_seconds=get_config("climate_cache_ttl_seconds", 604800), normalize_keys=False)
+geocode_rate_limiter = RateLimiter(get_config("nominatim_min_interval_seconds", 1.0))
+weather_single_flight = SingleFlight()
+geolocator = None
+
+
+def geocode_city(city_country: str):
+    """[latitude, longitude] for a "city, country" string, or None if Nominatim doesn't know it."""
+    def compute():
+        global geolocator
+        from geopy.geocoders import Nominatim
+
+        if geolocator is None:
+            geolocator = Nominatim(user_agent=get_config("nominatim_user_agent", "grocer"))
+        geocode_rate_limiter.wait()
+        location = geolocator.geocode(city_country)
+        return None if location is None else [location.latitude, location.longitude]
+
+    return cached_lookup(geocode_memory_cache, weather_disk_cache, weather_single_flight, "geocode",
+                         SemanticCache.normalize(city_country), compute, get_config("geocode_cache_ttl_seconds", 2592000))
+
+
+async def ageocode_city(city_country: str):
+    """Async geocode_city, using geopy's aiohttp adapter."""
+    async def compute():
+        from geopy.adapters import AioHTTPAdapter
+        from geopy.geocoders import Nominatim
+
+        await geocode_rate_limiter.wait_async()
+        async with Nominatim(user_agent=get_config("nominatim_user_agent", "grocer"), adapter_factory=AioHTTPAdapter) as async_geolocator:
+            location = await async_geolocator.geocode(city_country)
+        return None if location is None else [location.latitude, location.longitude]
+
+    return await acached_lookup(geocode_memory_cache, weather_disk_cache, "geocode",
+                                SemanticCache.normalize(city_country), compute, get_config("geocode_cache_ttl_seconds", 2592000))
+
+
+def fetch_average_temperature(latitude: float, longitude: float, start, end):
+    from meteostat import Point, Daily
+
+    data = Daily(Point(latitude, longitude, 70), start, end).fetch()
+    temperature = data['tavg'].mean()
+    return None if temperature != temperature else float(temperature)
+
+
+def climate_cache_key(latitude: float, longitude: float, start) -> str:
+    iso_week = start.isocalendar()[1]
+    return f"{round(latitude, 1)}|{round(longitude, 1)}|{iso_week}"
+
+
+def average_temperature(latitude: float, longitude: float, start, end):
+    """Mean daily temperature between start and end, cached per 0.1 degree lat/lon bucket and ISO week of start."""
+    return cached_lookup(climate_memory_cache, weather_disk_cache, weather_single_flight, "climate",
+                         climate_cache_key(latitude, longitude, start),
+                         lambda: fetch_average_temperature(latitude, longitude, start, end),
+                         get_config("climate_cache_ttl_seconds", 604800))
+
+
+async def aaverage_temperature(latitude: float, longitude: float, start, end):
+    """Async average_temperature. meteostat is blocking, so the fetch runs on the blocking I/O pool."""
+    return await acached_lookup(climate_memory_cache, weather_disk_cache, "climate",
+                                climate_cache_key(latitude, longitude, start),
+                                lambda: run_blocking(fetch_average_temperature, latitude, longitude, start, end),
+                                get_config("climate_cache_ttl_seconds", 604800))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Weather Forecast Tool
 
 # COMMAND ----------
 
+from datetime import datetime, timedelta
+
+
+def weather_city_country(address: str) -> str:
+    city_country=address.split(',')[-2:]
+    return ','.join(city_country)
+
+
+def weather_window():
+    #Approximate the forecast to last year one week weather at the same time.
+    today = datetime.today()
+    start=today+ timedelta(days=-365)
+    end=start+ timedelta(days=7)
+    return start, end
+
+
+def weather_indicator_for(temperature: int) -> str:
+    if temperature >= 28:
+        weather_indicator = "Hot"
+    elif 22 <= temperature <= 27:
+        weather_indicator = "Warm"
+    elif 18 <= temperature <= 21:
+        weather_indicator = "Mild"
+    elif 12 <= temperature <= 17:
+        weather_indicator = "Cool"
+    elif 6 <= temperature <= 11:
+        weather_indicator = "Cold"
+    elif temperature < 0:
+        weather_indicator = "Freezing"
+    else:
+        weather_indicator = "Very Cold"
+    return weather_indicator
+
+
+def weather_fallback_prompt(address: str) -> str:
+    current_month = datetime.today().strftime('%Y-%b-%d')
+    return f"""You are a weather. You are provided with user address and current month. Based on your knowledge on weather, in a single word you will mention if weather is Hot,Warm,Mild,Cold,Freezing or Very Cold. If you are not able to determine user location from given detail, say "Not able to determine the weather". You will not output other sentnce or word.User Details are: {address}. Current date is {current_month}"""
+
 
 def get_weather():
     """
@@ -412,57 +2405,38 @@ def get_weather():
 
     def get_weather_forecast(address: str) -> str:
         
-        import datetime
-        from datetime import datetime, timedelta
+        address=profile_address(address)
         try:
             #This uses open source metostat and openmap API to get the weather
-            city_country=address.split(',')[-2:]
-            city_country=','.join(city_country)
-            from geopy.geocoders import Nominatim
-            from meteostat import Point, Daily
-            geolocator = Nominatim(user_agent="test")
-            location = geolocator.geocode(city_country)
-
-
-            #Approximate the forecast to last year one week weather at the same time.
-            today = datetime.today()
-            start=today+ timedelta(days=-365)
-            end=start+ timedelta(days=7)
-        
-            point = Point(location.latitude, location.longitude, 70)
-            data = Daily(point, start, end)
-            data = data.fetch()
-            temperature=data['tavg'].mean()
-            temperature=int(temperature)
-            
-            if temperature >= 28:
-                weather_indicator = "Hot"
-            elif 22 <= temperature <= 27:
-                weather_indicator = "Warm"
-            elif 18 <= temperature <= 21:
-                weather_indicator = "Mild"
-            elif 12 <= temperature <= 17:
-                weather_indicator = "Cool"
-            elif 6 <= temperature <= 11:
-                weather_indicator = "Cold"
-            elif temperature < 0:
-                weather_indicator = "Freezing"
-            else:
-                weather_indicator = "Very Cold"
+            latitude, longitude = geocode_city(weather_city_country(address))
+            start, end = weather_window()
+            temperature=average_temperature(latitude, longitude, start, end)
+            weather_indicator=weather_indicator_for(int(temperature))
 
         except:
             #If above API call fails, a generic fail proof based on month. Not without factual error though.
-
-            from datetime import datetime, timedelta
-            current_month = datetime.today().strftime('%Y-%b-%d')
-            weather_prompt=f"""You are a weather. You are provided with user address and current month. Based on your knowledge on weather, in a single word you will mention if weather is Hot,Warm,Mild,Cold,Freezing or Very Cold. If you are not able to determine user location from given detail, say "Not able to determine the weather". You will not output other sentnce or word.User Details are: {address}. Current date is {current_month}"""
-            weather_indicator=llm.invoke(weather_prompt)
+            weather_indicator=llm.invoke(weather_fallback_prompt(address))
             weather_indicator=weather_indicator.content
 
         return weather_indicator
 
+    async def aget_weather_forecast(address: str) -> str:
+
+        address=profile_address(address)
+        try:
+            latitude, longitude = await ageocode_city(weather_city_country(address))
+            start, end = weather_window()
+            temperature=await aaverage_temperature(latitude, longitude, start, end)
+            weather_indicator=weather_indicator_for(int(temperature))
+
+        except Exception:
+            weather_indicator=(await llm.ainvoke(weather_fallback_prompt(address))).content
+
+        return weather_indicator
+
 
     get_weather_forecast_tool = StructuredTool.from_function(func=get_weather_forecast,
+                                              coroutine=aget_weather_forecast,
                                               name='get_weather_forecast',
                                               description="""This tool will get the weather forecast, for provided user address details so that agent can suggest the grocery suited for user weather.""")
 
@@ -470,105 +2444,403 @@ def get_weather():
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Email outbox
+# MAGIC
+# MAGIC The email tool queues a rendered message and returns right away. One background worker sends the queue over a reused, logged-in SMTP connection. It reconnects when the connection drops, retries temporary failures with exponential backoff, and closes the connection after `smtp_idle_seconds` without mail. Delivery status is kept per message ID and can be queried with the `get_email_delivery_status` tool. `enqueue_many` queues bulk mail such as weekly digests.
+# MAGIC
+# MAGIC SMTP settings are read once, here. For a local SMTP sink, set `smtp_host: "localhost"`, `smtp_port: 1025` and `smtp_use_ssl: false`, and leave the password empty to skip login.
+
+# COMMAND ----------
+
+import queue
+import random
+import smtplib
+import uuid
+from email.message import EmailMessage
+
+#Rejected recipient or sender, failed login or other 5xx replies. Retrying won't help.
+PERMANENT_SMTP_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPAuthenticationError)
+
+
+class EmailOutbox:
+    """Email queue sent by one background worker over a reused SMTP connection, with retries and per message status."""
+
+    def __init__(self, host, port, sender, password="", use_ssl=True, starttls=False, max_retries=3,
+                 backoff_seconds=2.0, idle_seconds=60, timeout=30, status_entries=1000):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.use_ssl = use_ssl
+        self.starttls = starttls
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        self.status_entries = status_entries
+        self._queue = queue.Queue()
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._thread = None
+
+    def _set_status(self, message_id, **fields):
+        with self._lock:
+            status = self._statuses.setdefault(message_id, {"message_id": message_id})
+            status.update(fields, updated_at=time.time())
+            self._statuses.move_to_end(message_id)
+            while len(self._statuses) > self.status_entries:
+                self._statuses.popitem(last=False)
+
+    def status(self, message_id):
+        with self._lock:
+            status = self._statuses.get(message_id)
+            return dict(status) if status else None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, recipient, subject, html) -> str:
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = self.sender
+        message["To"] = recipient
+        message.set_content(html, subtype="html")
+        message_id = uuid.uuid4().hex[:12]
+        self._set_status(message_id, status="queued", recipient=recipient, attempts=0, error=None)
+        self._queue.put((message_id, message))
+        self.start()
+        return message_id
+
+    def enqueue_many(self, messages) -> list:
+        """Queue (recipient, subject, html) tuples, e.g. a weekly digest. Returns their message IDs."""
+        return [self.enqueue(recipient, subject, html) for recipient, subject, html in messages]
+
+    def flush(self, timeout=None) -> bool:
+        """Wait until the queue is sent or failed. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _connect(self):
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                connection.starttls()
+        if self.password:
+            connection.login(self.sender, self.password)
+        return connection
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _send(self, message_id, message):
+        for attempt in range(1, self.max_retries + 2):
+            self._set_status(message_id, status="sending", attempts=attempt)
+            try:
+                if self._connection is None:
+                    self._connection = self._connect()
+                self._connection.send_message(message)
+                return
+            except PERMANENT_SMTP_ERRORS:
+                self._close()
+                raise
+            except smtplib.SMTPResponseException as e:
+                self._close()
+                if e.smtp_code >= 500:
+                    raise
+                error = e
+            except (smtplib.SMTPException, OSError) as e:
+                #Dropped or stale connection, network error. Reconnect on the next attempt.
+                self._close()
+                error = e
+            if attempt > self.max_retries:
+                raise error
+            self._set_status(message_id, status="retrying", error=str(error))
+            time.sleep(self.backoff_seconds * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def _run(self):
+        while True:
+            try:
+                message_id, message = self._queue.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                self._close()
+                continue
+            try:
+                self._send(message_id, message)
+                self._set_status(message_id, status="sent", error=None)
+            except Exception as e:
+                print(f"Email {message_id} to {message['To']} failed: {e}")
+                self._set_status(message_id, status="failed", error=str(e))
+            finally:
+                self._queue.task_done()
+
+
+email_outbox = EmailOutbox(get_config("smtp_host", "smtp.gmail.com"), get_config("smtp_port", 465),
+                           sender=get_config("sender_email_id", ""),
+                           password=get_config("sender_email_id_password", ""),
+                           use_ssl=get_config("smtp_use_ssl", True),
+                           starttls=get_config("smtp_starttls", False),
+                           max_retries=get_config("email_max_retries", 3),
+                           backoff_seconds=get_config("email_retry_backoff_seconds", 2.0),
+                           idle_seconds=get_config("smtp_idle_seconds", 60))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Send Email
 
 # COMMAND ----------
 
+from typing import Dict
+from jinja2 import Environment
+
+GROCERY_CATEGORIES = ["Fruits & Vegetables", "Dairy & Eggs", "Bakery", "Meat & Seafood", "Pantry", "Spices & Condiments",
+                      "Beverages", "Snacks", "Frozen", "Household", "Other"]
+
+
+class EmailItem(BaseModel):
+    name: str = Field(description="Product name as in the grocery list.")
+    quantity: Optional[str] = Field(default=None, description="Quantity, e.g. '2 Liter', if known.")
+    price: Optional[float] = Field(default=None, description="Price from the price or inventory tool. Never invent it.")
+    category: Optional[str] = Field(default=None, description=f"One of: {', '.join(GROCERY_CATEGORIES)}.")
+    reason: Optional[str] = Field(default=None, description="Factor behind the suggestion, e.g. Offer, Recipe, Weather, Festival, Expiring.")
+
+
+class EmailOffer(BaseModel):
+    product_name: str
+    loyalty_points: Optional[float] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+
+
+class EmailRecipe(BaseModel):
+    name: str
+    ingredients: List[str] = Field(default_factory=list)
+    steps: List[str] = Field(default_factory=list)
+
+
+class EmailSummary(BaseModel):
+    """Structured grocery list summary the email is rendered from."""
+    items: List[EmailItem] = Field(description="Every product in the final grocery list.")
+    offers: List[EmailOffer] = Field(default_factory=list, description="Offers shown to the user, with loyalty points and dates as received from the offer tool.")
+    recipes: List[EmailRecipe] = Field(default_factory=list, description="Recipes chosen in the conversation.")
+    total_price: Optional[float] = Field(default=None, description="Total price, only if received from a tool.")
+    notes: Optional[str] = Field(default=None, description="Any other short note for the user.")
+    email: Optional[str] = Field(default=None, description="User email, only if the user gave one in the conversation.")
+
+
+class ItemCategories(BaseModel):
+    categories: Dict[str, str] = Field(description=f"Category for each product name. One of: {', '.join(GROCERY_CATEGORIES)}.")
+
+
+def categories_prompt(names) -> str:
+    return f"""You will assign a grocery category to each product name. Use the product names exactly as given. Products: {json.dumps(names)}"""
+
+
+def missing_categories(items) -> list:
+    return [item.name for item in items if not item.category]
+
+
+def apply_categories(items, categories) -> list:
+    categories = {name.lower(): category for name, category in categories.items()}
+    return [item if item.category else item.model_copy(update={"category": categories.get(item.name.lower(), "Other")})
+            for item in items]
+
+
+def categorize_items(items) -> list:
+    """Items with a category. Only the ones the model left without a category cost one extraction call."""
+    names = missing_categories(items)
+    categories = {}
+    if names and get_config("email_categorize_with_llm", True):
+        try:
+            categories = invoke_structured(categories_prompt(names), ItemCategories).categories
+        except Exception as e:
+            print(f"Item categorization failed, using Other: {e}")
+    return apply_categories(items, categories)
+
+
+async def acategorize_items(items) -> list:
+    """Async categorize_items."""
+    names = missing_categories(items)
+    categories = {}
+    if names and get_config("email_categorize_with_llm", True):
+        try:
+            categories = (await ainvoke_structured(categories_prompt(names), ItemCategories)).categories
+        except Exception as e:
+            print(f"Item categorization failed, using Other: {e}")
+    return apply_categories(items, categories)
+
+
+EMAIL_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <link rel="stylesheet" type="text/css" hs-webfonts="true" href="https://fonts.googleapis.com/css?family=Lato|Lato:i,b,bi">
+    <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style type="text/css">
+    h1{font-size:56px}
+    h2{font-size:28px;font-weight:900}
+    p{font-weight:100}
+    td,th{vertical-align:top;text-align:left;padding:4px 12px 4px 0}
+    #email{margin:auto;width:600px;background-color:#fff}
+    </style>
+</head>
+<body bgcolor="#F5F8FA" style="width: 100%; font-family:Lato, sans-serif; font-size:18px;">
+<div id="email">
+    <table role="presentation" width="100%">
+        <tr>
+            <td bgcolor="#00A4BD" align="center" style="color: white;">
+                <h1>Your Grocery List</h1>
+            </td>
+        </tr>
+    </table>
+    <div style="padding: 30px 30px 30px 60px;">
+        <p>Hi {{ user_name or "there" }}, here is the grocery list we prepared together.</p>
+        {% for category, items in categories %}
+        <h2>{{ category }}</h2>
+        <table role="presentation">
+            <tr><th>Product</th><th>Quantity</th><th>Price</th></tr>
+            {% for item in items %}
+            <tr>
+                <td>{{ item.name }}{% if item.reason %}<br><small>{{ item.reason }}</small>{% endif %}</td>
+                <td>{{ item.quantity or "" }}</td>
+                <td>{{ item.price | money }}</td>
+            </tr>
+            {% endfor %}
+        </table>
+        {% endfor %}
+        {% if total_price is not none %}<p><b>Total: {{ total_price | money }}</b></p>{% endif %}
+        {% if offers %}
+        <h2>Your Offers</h2>
+        <table role="presentation">
+            <tr><th>Product</th><th>Loyalty Points</th><th>Valid</th></tr>
+            {% for offer in offers %}
+            <tr>
+                <td>{{ offer.product_name }}</td>
+                <td>{{ offer.loyalty_points | number }}</td>
+                <td>{{ offer.start_date or "" }}{% if offer.end_date %} to {{ offer.end_date }}{% endif %}</td>
+            </tr>
+            {% endfor %}
+        </table>
+        {% endif %}
+        {% for recipe in recipes %}
+        {% if loop.first %}<h2>Recipes</h2>{% endif %}
+        <h3>{{ recipe.name }}</h3>
+        {% if recipe.ingredients %}<p>Ingredients: {{ recipe.ingredients | join(", ") }}</p>{% endif %}
+        {% if recipe.steps %}<ol>{% for step in recipe.steps %}<li>{{ step }}</li>{% endfor %}</ol>{% endif %}
+        {% endfor %}
+        {% if notes %}<p>{{ notes }}</p>{% endif %}
+    </div>
+</div>
+</body>
+</html>
+"""
+
+email_environment = Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True)
+email_environment.filters["money"] = lambda price: "" if price is None else f"{price:.2f}"
+email_environment.filters["number"] = lambda value: "" if value is None else f"{value:g}"
+email_template = email_environment.from_string(EMAIL_TEMPLATE)
+
+
+def render_grocery_email(summary: EmailSummary, user_name=None) -> str:
+    """HTML email for a summary whose items are already categorized. Categories follow GROCERY_CATEGORIES order."""
+    grouped = OrderedDict()
+    for item in summary.items:
+        grouped.setdefault(item.category or "Other", []).append(item)
+    order = {category: index for index, category in enumerate(GROCERY_CATEGORIES)}
+    categories = sorted(grouped.items(), key=lambda entry: order.get(entry[0], len(GROCERY_CATEGORIES) - 1))
+    return email_template.render(user_name=user_name, categories=categories, total_price=summary.total_price,
+                                 offers=summary.offers, recipes=summary.recipes, notes=summary.notes)
+
+
+def profile_user_name():
+    profile = current_user_profile.get()
+    return profile.name if profile is not None else None
+
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)*")
+
+
+def receiver_email(user_details_and_conversation_summary: str) -> str:
+    """Email from the session profile, else the first address in the given text. None when there is neither."""
+    profile = current_user_profile.get()
+    if profile is not None and profile.email:
+        return profile.email
+    match = EMAIL_PATTERN.search(user_details_and_conversation_summary)
+    return match.group(0) if match else None
+
+
+def deliver_email(html_message: str, receiver_email_id) -> str:
+    if not receiver_email_id:
+        return "Message sending failed as there was no email ID found for user"
+    #Overwriting reciever email ID for demo.
+    receiver_email_id=email_outbox.sender
+    message_id=email_outbox.enqueue(receiver_email_id, "Grocery List", html_message)
+    return f"""Message queued for: {receiver_email_id}. Message ID: {message_id}. It is sent in the background and its delivery status can be checked with this ID."""
+
+
+def email_delivery_status(message_id: str) -> str:
+    status=email_outbox.status(message_id.strip())
+    if status is None:
+        return f"No email found with message ID {message_id}."
+    if status["status"] == "failed":
+        return f"Email {message_id} to {status['recipient']} failed after {status['attempts']} attempt(s): {status['error']}"
+    return f"Email {message_id} to {status['recipient']} is {status['status']} (attempts: {status['attempts']})."
+
+
 def send_email():
     #Extremely dangerous function. use cautiosly in chatbot.
 
-    def send_email_function(user_details_and_conversation_summary: str) -> str:
-
-        prompt=f""" You will return only html code like below. You will not return any text other than HTML code. You will greet the user in the message at the begining. You will extract the grocery list and will place it in a table, by categorizing each product in the list. You will place rest of the information is different tables. Don't mention anything about next steps. You will then create a personalized HTML page. Here is the input details: {user_details_and_conversation_summary}..
-        Example of HTML output expected is below:
-        <!DOCTYPE html>
-            <html>
-            <head>
-                <link rel="stylesheet" type="text/css" hs-webfonts="true" href="https://fonts.googleapis.com/css?family=Lato|Lato:i,b,bi">
-                <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <style type="text/css">
-                h1{{font-size:56px}}
-                h2{{font-size:28px;font-weight:900}}
-                p{{font-weight:100}}
-                td{{vertical-align:top}}
-                #email{{margin:auto;width:600px;background-color:#fff}}
-                </style>
-            </head>
-            <body bgcolor="#F5F8FA" style="width: 100%; font-family:Lato, sans-serif; font-size:18px;">
-            <div id="email">
-                <table role="presentation" width="100%">
-                    <tr>
-                        <td bgcolor="#00A4BD" align="center" style="color: white;">
-                            <h1> Your Grocery List</h1>
-                        </td>
-                </table>
-                <table role="presentation" border="0" cellpadding="0" cellspacing="10px" style="padding: 30px 30px 30px 60px;">
-                    <tr>
-                        <td>
-                            <h2>Grocery List</h2>
-                            <p>
-                                {user_details_and_conversation_summary}
-                            </p>
-                        </td>
-                    </tr>
-                </table>
-            </div>
-            </body>
-            </html>
-        """
-
-        response=llm.invoke(prompt)
-
-        prompt=f""" You will only return the email id in dictionary like below. You will not return any text other than dictionary. You will look for user email ID in recieved content and extract user email id. You will return a dictionary like following. You will never generate email, if not found in the content recieved. You will return 'no email found' in the place of email key value, if there is no email found in recieved content. {{"email":"user@example.com"}} Here is the recieved content: {user_details_and_conversation_summary}"""
-
-        email_extractor=llm.invoke(prompt)
-
-        import ast
-        user_email=ast.literal_eval(email_extractor.content)['email']
-        receiver_email_id=user_email
-
-
-        import smtplib
-        from email.message import EmailMessage
-        from mlflow.models import ModelConfig
-        
-        config = ModelConfig(development_config="config.yml")
+    def send_email_function(**email_summary) -> str:
 
-        sender_email_id=config.get("sender_email_id") 
-        sender_email_id_password=config.get("sender_email_id_password")
-        
-        
+        summary=EmailSummary.model_validate(email_summary)
+        summary=summary.model_copy(update={"items": categorize_items(summary.items)})
+        return deliver_email(render_grocery_email(summary, profile_user_name()), receiver_email(summary.email or ""))
 
-        if 'no email' in receiver_email_id:
-            return_value="Message sending failed as there was no email ID found for user"
-        else:
-            #Overwriting reciever email ID for demo.
-            receiver_email_id=sender_email_id
-            msg = EmailMessage()
-            msg['Subject'] = 'Grocery List'
-            msg['From'] = sender_email_id
-            msg['To'] = receiver_email_id
-            html_message=response.content
-            msg.set_content(html_message, subtype='html')
-
-            # #Use this with caution. Do all security test.
-            with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-                smtp.login(sender_email_id, sender_email_id_password)
-                smtp.send_message(msg)
-            return_value=f"""Message sent to: {receiver_email_id}"""
-        return return_value
+    async def asend_email_function(**email_summary) -> str:
+
+        summary=EmailSummary.model_validate(email_summary)
+        summary=summary.model_copy(update={"items": await acategorize_items(summary.items)})
+        return deliver_email(render_grocery_email(summary, profile_user_name()), receiver_email(summary.email or ""))
 
         
     
     send_mail_tool = StructuredTool.from_function(func=send_email_function,
+                                              coroutine=asend_email_function,
                                               name='send_email_function',
-                                              description="""This tool takes user email details and chatbot conversation summary as recieved by the agent to send email to user.""")
+                                              args_schema=EmailSummary,
+                                              description="""This tool emails the final grocery list to the user. Pass every product of the list with its category and price if known, the offers with loyalty points and dates, and the recipes, exactly as received earlier in the conversation.""")
 
     return send_mail_tool
 
 
+def get_email_status():
+
+    def get_email_delivery_status(message_id: str) -> str:
+        return email_delivery_status(message_id)
+
+    email_status_tool = StructuredTool.from_function(func=get_email_delivery_status,
+                                              name='get_email_delivery_status',
+                                              description="""Use this tool to check whether an email was sent, given the Message ID returned when it was queued.""")
+
+    return email_status_tool
+
+
 
 # COMMAND ----------
 
@@ -579,7 +2851,7 @@ def send_email():
 
 # COMMAND ----------
 
-from typing import Iterator, Dict, Any
+from typing import AsyncIterator, Iterator, Dict, Any
 from langchain_core.messages import (
     AIMessage,
     HumanMessage,
@@ -650,27 +2922,850 @@ def parse_message(msg) -> str:
         return str(msg)
 
 
-def wrap_output(stream: Iterator[MessageLikeRepresentation]) -> Iterator[str]:
+def format_event(event) -> Iterator[str]:
     """
-    Process and yield formatted outputs from the message stream.
+    Format one event of the message stream.
     The invoke and stream langchain functions produce different output formats.
     This function handles both cases.
     """
+    # the agent was called with invoke()
+    if "messages" in event:
+        for msg in event["messages"]:
+            yield parse_message(msg) + "\n\n"
+    # the agent was called with stream()
+    else:
+        for node in event:
+            for key, messages in event[node].items():
+                if isinstance(messages, list):
+                    for msg in messages:
+                        yield parse_message(msg) + "\n\n"
+                else:
+                    print("Unexpected value {messages} for key {key}. Expected a list of `MessageLikeRepresentation`'s")
+                    yield str(messages)
+
+
+def wrap_output(stream: Iterator[MessageLikeRepresentation]) -> Iterator[str]:
+    """
+    Process and yield formatted outputs from the message stream.
+    """
     for event in stream:
-        # the agent was called with invoke()
-        if "messages" in event:
-            for msg in event["messages"]:
-                yield parse_message(msg) + "\n\n"
-        # the agent was called with stream()
-        else:
-            for node in event:
-                for key, messages in event[node].items():
-                    if isinstance(messages, list):
-                        for msg in messages:
-                            yield parse_message(msg) + "\n\n"
-                    else:
-                        print("Unexpected value {messages} for key {key}. Expected a list of `MessageLikeRepresentation`'s")
-                        yield str(messages)
+        yield from format_event(event)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Token streaming
+# MAGIC
+# MAGIC With `output_stream_mode: "tokens"` the agent streams the graph with `stream_mode="messages"` and forwards the model's answer tokens as they are generated. Tool calls, tool results and LLM calls made inside tools are dropped instead of being sent as blank filler chunks, so time-to-first-token no longer waits for the whole turn. `output_stream_mode: "messages"` yields each new message whole instead.
+# MAGIC
+# MAGIC Both modes run every turn through `conversation_call`, with the same conversation memory, step limit, turn budget and turn metrics.
+# MAGIC
+# MAGIC `stream_progress_events: true` adds one short progress line (e.g. "_Checking inventory..._") when the model calls a tool.
+
+# COMMAND ----------
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.errors import GraphRecursionError
+
+TOOL_PROGRESS_MESSAGES = {
+    "get_user_details": "Looking up your details...",
+    "get_offers_details": "Checking your offers...",
+    "get_product_availability_and_price": "Checking inventory...",
+    "get_expired_products_details": "Checking your recent purchases...",
+    "get_stored_recipie": "Looking for a recipe...",
+    "get_weather_forecast": "Checking the weather...",
+    "suggest_for_upcoming_festivals": "Looking up upcoming festivals...",
+    "send_email_function": "Preparing your email...",
+    "get_email_delivery_status": "Checking your email...",
+}
+
+
+class AnswerTokenFilter:
+    """Turns (message, metadata) pairs from stream_mode="messages" into answer tokens and optional progress events."""
+
+    def __init__(self, answer_nodes=("agent",), progress_events=False):
+        self.answer_nodes = set(answer_nodes)
+        self.progress_events = progress_events
+        self.announced_calls = set()
+
+    def __call__(self, message, metadata) -> Iterator[str]:
+        #Only the model nodes answer the user. LLM calls made inside tools run under the tools node.
+        if metadata.get("langgraph_node") not in self.answer_nodes or not isinstance(message, AIMessage):
+            return
+        #e.g. the history summary, made by the model node before it answers.
+        if metadata.get(INTERNAL_LLM_CALL):
+            return
+        tool_calls = getattr(message, "tool_call_chunks", None) or message.tool_calls
+        if tool_calls:
+            if self.progress_events:
+                for call in tool_calls:
+                    key = (call.get("id") or call.get("index"), call.get("name"))
+                    if call.get("name") and key not in self.announced_calls:
+                        self.announced_calls.add(key)
+                        yield f"_{TOOL_PROGRESS_MESSAGES.get(call['name'], 'Working on it...')}_\n\n"
+            return
+        if isinstance(message.content, str) and message.content:
+            yield message.content
+
+
+def budget_exhausted_answer(error, answered: bool, tool_results) -> str:
+    """Closing text for a turn stopped by the turn budget or the step limit. Without an answer so far, the latest tool results are the partial answer."""
+    reason = str(error) if isinstance(error, BudgetExceeded) else "it took more steps than allowed for one message"
+    partial = ""
+    if not answered and tool_results:
+        max_chars = get_config("budget_partial_result_chars", 1500)
+        partial = "Here is what I found so far:\n\n" + "\n\n".join(str(message.content)[:max_chars] for message in tool_results[-2:])
+    return f"{partial}\n\n_I stopped working on this message because {reason}. Please ask again, or ask for a smaller part of it._"
+
+
+class TurnOutput:
+    """Formats one turn's graph stream for the client, per output_stream_mode.
+
+    "tokens" streams the graph with stream_mode="messages" and yields the answer tokens. "messages" streams node updates and yields each new message whole, through format_event.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.stream_mode = "messages" if mode == "tokens" else "updates"
+        self.token_filter = AnswerTokenFilter(answer_nodes, progress_events=get_config("stream_progress_events", False))
+        self.answered = False
+        self.tool_results = []
+        self.streamed = []
+
+    def _tokens(self, item):
+        message, metadata = item
+        #langgraph's messages stream skips a chunk whose id() matches an earlier chunk's, which happens once that chunk is freed. Keeping them until the turn ends stops answer tokens going missing.
+        self.streamed.append(message)
+        if isinstance(message, ToolMessage):
+            self.tool_results.append(message)
+        for token in self.token_filter(message, metadata):
+            self.answered = self.answered or not token.startswith("_")
+            yield token
+
+    def _messages(self, item):
+        #Only message updates go to the client. e.g. the staged graph's route node updates the stage and profile.
+        event = {node: {"messages": update["messages"]} for node, update in item.items()
+                 if isinstance(update, dict) and update.get("messages")}
+        for update in event.values():
+            self.tool_results.extend(message for message in update["messages"] if isinstance(message, ToolMessage))
+        for chunk in format_event(event):
+            self.answered = self.answered or bool(chunk.strip())
+            yield chunk
+
+    def __call__(self, item) -> Iterator[str]:
+        return self._tokens(item) if self.stream_mode == "messages" else self._messages(item)
+
+    def stopped(self, error) -> str:
+        print(f"Turn stopped early: {error}")
+        return budget_exhausted_answer(error, self.answered, self.tool_results)
+
+
+def stream_agent_output(inputs: Iterator[Dict[str, Any]], config: RunnableConfig) -> Iterator[str]:
+    """Runs each input as one turn: conversation memory, step limit, turn budget and turn metrics, in either output mode."""
+    for agent_input in inputs:
+        output = TurnOutput(get_config("output_stream_mode", "tokens"))
+        graph, graph_input, graph_config = conversation_call(agent_input, config)
+        turn = start_turn()
+        start_budget()
+        try:
+            for item in graph.stream(graph_input, graph_config, stream_mode=output.stream_mode):
+                yield from output(item)
+        except (BudgetExceeded, GraphRecursionError) as e:
+            yield output.stopped(e)
+        finally:
+            finish_turn(turn)
+
+
+async def astream_agent_output(inputs: AsyncIterator[Dict[str, Any]], config: RunnableConfig) -> AsyncIterator[str]:
+    """Async stream_agent_output."""
+    async for agent_input in inputs:
+        output = TurnOutput(get_config("output_stream_mode", "tokens"))
+        graph, graph_input, graph_config = conversation_call(agent_input, config)
+        turn = start_turn()
+        start_budget()
+        try:
+            async for item in graph.astream(graph_input, graph_config, stream_mode=output.stream_mode):
+                for chunk in output(item):
+                    yield chunk
+        except (BudgetExceeded, GraphRecursionError) as e:
+            yield output.stopped(e)
+        finally:
+            finish_turn(turn)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Conversation memory
+# MAGIC
+# MAGIC Multi-turn memory for requests that carry a `thread_id`, either in `custom_inputs` or in the run config's `configurable`. Checkpoints go to a local SQLite file instead of the in-process `MemorySaver`, so serving memory stays flat however many threads are active.
+# MAGIC
+# MAGIC The default `conversation_memory_path` is under `/tmp`, which is local to the serving container: conversations are lost on restart, redeploy and scale to zero. Point it at persistent storage (e.g. a mounted volume) to keep them.
+# MAGIC
+# MAGIC Each thread keeps only its last `conversation_checkpoints_per_thread` checkpoints, stored zlib compressed, and at most `conversation_max_thread_bytes` of them in total. A checkpoint over its share of that budget has its oldest turns dropped from the stored messages (whole turns, starting on a user message) until it fits. Threads idle for `conversation_idle_seconds`, or beyond the `conversation_max_threads` most recently used, are evicted.
+
+# COMMAND ----------
+
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple
+
+
+class BoundedSQLiteSaver(BaseCheckpointSaver):
+    """LangGraph checkpointer in a local SQLite file, with a per thread checkpoint and size cap and idle thread eviction."""
+
+    def __init__(self, path, checkpoints_per_thread=2, max_thread_bytes=524288, idle_seconds=604800, max_threads=10000,
+                 eviction_interval=600, compression_level=6, serde=None):
+        super().__init__(serde=serde)
+        self.path = path
+        self.checkpoints_per_thread = checkpoints_per_thread
+        #Compressed bytes per stored checkpoint, so a thread's checkpoints stay within max_thread_bytes. None disables the cap.
+        self.max_checkpoint_bytes = max_thread_bytes // max(checkpoints_per_thread, 1) if max_thread_bytes else None
+        self.idle_seconds = idle_seconds
+        self.max_threads = max_threads
+        self.eviction_interval = eviction_interval
+        self.compression_level = compression_level
+        self._last_eviction = time.monotonic()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            #auto_vacuum only applies to a new file. It lets evictions hand disk space back.
+            self._connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, parent_checkpoint_id TEXT,
+                type TEXT, checkpoint BLOB, metadata_type TEXT, metadata BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id))""")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, task_id TEXT, idx INTEGER,
+                channel TEXT, type TEXT, value BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))""")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS threads (thread_id TEXT PRIMARY KEY, last_used REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS threads_last_used ON threads (last_used)")
+
+    def _dumps(self, value):
+        type_, data = self.serde.dumps_typed(value)
+        return type_, zlib.compress(data, self.compression_level)
+
+    def _loads(self, type_, blob):
+        return self.serde.loads_typed((type_, zlib.decompress(blob)))
+
+    def _dumps_checkpoint(self, checkpoint):
+        """Serialized checkpoint within max_checkpoint_bytes, dropping the oldest turns of its messages if needed."""
+        type_, blob = self._dumps(checkpoint)
+        messages = checkpoint.get("channel_values", {}).get("messages")
+        if self.max_checkpoint_bytes is None or len(blob) <= self.max_checkpoint_bytes or not messages:
+            return type_, blob
+        #Cut at user messages, so no tool result loses its call. The current turn is always kept.
+        turn_starts = [index for index, message in enumerate(messages) if isinstance(message, HumanMessage) and index > 0]
+        if not turn_starts:
+            return type_, blob
+        dumps_from = lambda start: self._dumps({**checkpoint, "channel_values": {**checkpoint["channel_values"], "messages": messages[start:]}})
+        #Trim to 3/4 of the cap, so the next few turns store without trimming again.
+        target_bytes = self.max_checkpoint_bytes * 3 // 4
+        #Binary search for the earliest cut that fits. Size only shrinks as the cut moves later.
+        low, high, fitted = 0, len(turn_starts) - 1, None
+        while low <= high:
+            middle = (low + high) // 2
+            candidate = dumps_from(turn_starts[middle])
+            if len(candidate[1]) <= target_bytes:
+                fitted, high = (turn_starts[middle], candidate), middle - 1
+            else:
+                low = middle + 1
+        start, (type_, blob) = fitted or (turn_starts[-1], dumps_from(turn_starts[-1]))
+        print(f"Checkpoint of {len(messages)} messages over {self.max_checkpoint_bytes} bytes, stored the newest {len(messages) - start}")
+        return type_, blob
+
+    def _pending_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT task_id, channel, type, value FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+                (thread_id, checkpoint_ns, checkpoint_id)).fetchall()
+        return [(task_id, channel, self._loads(type_, value)) for task_id, channel, type_, value in rows]
+
+    def _checkpoint_tuple(self, row):
+        thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self._loads(type_, checkpoint),
+            metadata=self._loads(metadata_type, metadata),
+            parent_config=({"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                           if parent_checkpoint_id else None),
+            pending_writes=self._pending_writes(thread_id, checkpoint_ns, checkpoint_id),
+        )
+
+    def get_tuple(self, config):
+        configurable = config["configurable"]
+        query = "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+        params = [str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")]
+        if configurable.get("checkpoint_id"):
+            query += " AND checkpoint_id = ?"
+            params.append(configurable["checkpoint_id"])
+        with self._lock:
+            row = self._connection.execute(query + " ORDER BY checkpoint_id DESC LIMIT 1", params).fetchone()
+        return self._checkpoint_tuple(row) if row else None
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        clauses, params = [], []
+        if config is not None:
+            clauses.append("thread_id = ?")
+            params.append(str(config["configurable"]["thread_id"]))
+            if config["configurable"].get("checkpoint_ns") is not None:
+                clauses.append("checkpoint_ns = ?")
+                params.append(config["configurable"]["checkpoint_ns"])
+        if before is not None:
+            clauses.append("checkpoint_id < ?")
+            params.append(before["configurable"]["checkpoint_id"])
+        query = "SELECT * FROM checkpoints" + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY checkpoint_id DESC"
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        returned = 0
+        for row in rows:
+            if limit is not None and returned >= limit:
+                return
+            checkpoint_tuple = self._checkpoint_tuple(row)
+            if filter and any(checkpoint_tuple.metadata.get(key) != value for key, value in filter.items()):
+                continue
+            returned += 1
+            yield checkpoint_tuple
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, checkpoint_blob = self._dumps_checkpoint(checkpoint)
+        metadata_type, metadata_blob = self._dumps(metadata)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                                      type_, checkpoint_blob, metadata_type, metadata_blob))
+            self._connection.execute("INSERT OR REPLACE INTO threads VALUES (?, ?)", (thread_id, time.time()))
+            #Only the latest checkpoints are needed to resume a conversation.
+            keep = "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT ?"
+            for table in ("checkpoints", "writes"):
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({keep})",
+                    (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.checkpoints_per_thread))
+        if time.monotonic() - self._last_eviction > self.eviction_interval:
+            self._last_eviction = time.monotonic()
+            self.evict()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id):
+        configurable = config["configurable"]
+        rows = [(str(configurable["thread_id"]), configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"],
+                 task_id, idx, channel, *self._dumps(value))
+                for idx, (channel, value) in enumerate(writes)]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_thread(self, thread_id):
+        with self._lock, self._connection:
+            for table in ("checkpoints", "writes", "threads"):
+                self._connection.execute(f"DELETE FROM {table} WHERE thread_id = ?", (str(thread_id),))
+
+    def evict(self):
+        """Delete threads idle for idle_seconds, then the least recently used ones beyond max_threads. Returns the number deleted."""
+        with self._lock:
+            cutoff = time.time() - self.idle_seconds
+            stale = [row[0] for row in self._connection.execute(
+                "SELECT thread_id FROM threads WHERE last_used < ?", (cutoff,))]
+            if self.max_threads:
+                stale += [row[0] for row in self._connection.execute(
+                    "SELECT thread_id FROM threads WHERE last_used >= ? ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                    (cutoff, self.max_threads))]
+            if not stale:
+                return 0
+            with self._connection:
+                for table in ("checkpoints", "writes", "threads"):
+                    self._connection.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(thread_id,) for thread_id in stale])
+            self._connection.execute("PRAGMA incremental_vacuum").fetchall()
+        print(f"Evicted {len(stale)} conversation threads from {self.path}")
+        return len(stale)
+
+    async def aget_tuple(self, config):
+        return await run_blocking(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for checkpoint_tuple in await run_blocking(lambda: list(self.list(config, filter=filter, before=before, limit=limit))):
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await run_blocking(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id):
+        return await run_blocking(self.put_writes, config, writes, task_id)
+
+
+conversation_checkpointer = None
+if get_config("conversation_memory", False):
+    conversation_memory_path = get_config("conversation_memory_path", "/tmp/grocer_conversations.sqlite")
+    if conversation_memory_path.startswith("/tmp/"):
+        print(f"Conversation memory in {conversation_memory_path} is lost on restart and scale to zero. Set conversation_memory_path to persistent storage to keep it.")
+    with startup_step("conversation_checkpointer"):
+        conversation_checkpointer = BoundedSQLiteSaver(
+            conversation_memory_path,
+            checkpoints_per_thread=get_config("conversation_checkpoints_per_thread", 2),
+            max_thread_bytes=get_config("conversation_max_thread_bytes", 524288),
+            idle_seconds=get_config("conversation_idle_seconds", 604800),
+            max_threads=get_config("conversation_max_threads", 10000))
+
+
+def conversation_call(agent_input, config):
+    """Graph, input and run config for one turn. Turns with a thread_id go to the checkpointed graph."""
+    agent_input = dict(agent_input)
+    custom_inputs = agent_input.pop("custom_inputs", None) or {}
+    #Step limit of the outer graph. Each model call and each tool round is a step.
+    config = {**(config or {}), "recursion_limit": get_config("agent_recursion_limit", 25)}
+    configurable = dict(config.get("configurable", {}))
+    thread_id = configurable.get("thread_id") or custom_inputs.get("thread_id")
+    agent_with_raw_output, agent_with_memory = agent_graphs.get()
+    if agent_with_memory is None or not thread_id:
+        return agent_with_raw_output, agent_input, config
+    configurable["thread_id"] = str(thread_id)
+    checkpoint = conversation_checkpointer.get_tuple({**config, "configurable": configurable})
+    if checkpoint is not None:
+        #Clients such as the Shiny app resend the whole history. Once the thread has a checkpoint, only the new message is needed.
+        agent_input["messages"] = agent_input["messages"][-1:]
+        #The step limit counts from this turn's first step, not from the start of the thread (see TurnLastStepManager).
+        configurable["turn_start_step"] = checkpoint.metadata.get("step", -2) + 1
+    return agent_with_memory, agent_input, {**config, "configurable": configurable}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Conversation history
+# MAGIC
+# MAGIC The guided flow runs ten or more turns, and the react agent would resend every earlier message and tool output on each model call. `ConversationHistory` sits in front of the model as its state modifier. Once the history passes `history_max_prompt_tokens`, the model sees:
+# MAGIC - the system prompt, with the user profile from `get_user_details` and the latest grocery list shown to the user copied verbatim into it
+# MAGIC - a rolling summary of the older turns
+# MAGIC - the last `history_recent_tokens` of the conversation, starting on a user message
+# MAGIC
+# MAGIC Summaries are cached by a hash of the content of the messages they cover, so each model call only summarizes the messages that left the recent window since the previous call. Stateless clients that resend the history (new message ids on every request) hit the same cache. Every call records the prompt tokens sent against the untrimmed size (`history_report_tokens` also prints them), so the growth curve can be checked per turn. The state keeps the full history. Only the prompt is trimmed.
+
+# COMMAND ----------
+
+import hashlib
+from collections import deque
+from langchain_core.messages import SystemMessage, trim_messages
+from langchain_core.runnables import RunnableLambda
+
+#LLM calls made with this metadata key are internal to a node and are not streamed to the user.
+INTERNAL_LLM_CALL = "grocer_internal_llm_call"
+GROCERY_LIST_PATTERN = re.compile(r"grocery list|shopping list", re.IGNORECASE)
+
+
+def approximate_tokens(messages) -> int:
+    """About 4 characters per token plus a small per message overhead. Good enough to place the cut."""
+    total = 0
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+        total += 4 + len(content) // 4
+        for call in getattr(message, "tool_calls", None) or []:
+            total += 4 + len(json.dumps(call.get("args", {}))) // 4
+    return total
+
+
+def history_summary_prompt(previous_summary, messages, max_message_chars=2000):
+    transcript = "\n".join(f"{message.type}: {str(message.content)[:max_message_chars]}" for message in messages if message.content)
+    return f"""You keep a running summary of a conversation between a grocery assistant and a user. Update the summary with the new messages.
+Keep the LoyaltyID, allergies and preferences, offers shown, recipes chosen, factors the user opted into or declined, products added to or removed from the list and any open question or pending option. Be concise and factual. Leave out greetings.
+
+Current summary:
+{previous_summary or "None"}
+
+New messages:
+{transcript}
+
+Updated summary:"""
+
+
+class ConversationHistory:
+    """State modifier keeping the system prompt, user profile and grocery list verbatim and older turns as a rolling summary."""
+
+    def __init__(self, system_prompt, summary_llm, max_prompt_tokens=6000, recent_tokens=2500,
+                 summary_cache_size=1024, report_tokens=False, profile_tool="get_user_details"):
+        self.system_prompt = system_prompt
+        #Lazy, so passing the shared llm doesn't build its client on import.
+        self.summary_llm = Lazy("history_summary_llm", lambda: summary_llm.with_config(
+            run_name="history_summary", metadata={INTERNAL_LLM_CALL: True}))
+        self.max_prompt_tokens = max_prompt_tokens
+        self.recent_tokens = recent_tokens
+        self.summary_cache_size = summary_cache_size
+        self.report_tokens = report_tokens
+        self.profile_tool = profile_tool
+        self.summaries = OrderedDict()
+        self.token_log = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+    def _system_prompt(self, state):
+        #The staged agent passes a callable, picking the prompt for the current stage.
+        return self.system_prompt(state) if callable(self.system_prompt) else self.system_prompt
+
+    def _with_system_prompt(self, system_prompt, messages, sections=()):
+        sections = [section for section in (system_prompt, *sections) if section]
+        return ([SystemMessage(content="\n\n".join(sections))] if sections else []) + list(messages)
+
+    def _recent_start(self, messages) -> int:
+        """Index where the verbatim window starts. It is always a user message, so no tool result loses its call."""
+        human_turns = [index for index, message in enumerate(messages) if isinstance(message, HumanMessage)]
+        if not human_turns:
+            return 0
+        recent = trim_messages(messages, max_tokens=self.recent_tokens, token_counter=approximate_tokens,
+                               strategy="last", start_on="human")
+        #The current turn is always sent whole, even when it alone is over recent_tokens.
+        return min(len(messages) - len(recent), human_turns[-1])
+
+    def _pinned(self, older):
+        profile = next((message for message in reversed(older)
+                        if isinstance(message, ToolMessage) and message.name == self.profile_tool), None)
+        grocery_list = next((message for message in reversed(older)
+                             if isinstance(message, AIMessage) and not message.tool_calls
+                             and isinstance(message.content, str) and GROCERY_LIST_PATTERN.search(message.content)), None)
+        return profile, grocery_list
+
+    def _prefix_keys(self, messages):
+        """Running hash of each prefix of messages, over type, content and tool calls. Message ids are left out, as resent histories get new ones."""
+        digest = hashlib.sha256()
+        keys = []
+        for message in messages:
+            digest.update(json.dumps([message.type, message.content, getattr(message, "tool_calls", None) or []],
+                                     sort_keys=True, default=str).encode())
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _cached_summary(self, older):
+        """Latest cached summary of a prefix of older, and the messages after that prefix."""
+        keys = self._prefix_keys(older)
+        with self._lock:
+            for index in range(len(older) - 1, -1, -1):
+                summary = self.summaries.get(keys[index])
+                if summary is not None:
+                    self.summaries.move_to_end(keys[index])
+                    return summary, older[index + 1:]
+        return "", older
+
+    def _store_summary(self, older, summary):
+        key = self._prefix_keys(older)[-1]
+        with self._lock:
+            self.summaries[key] = summary
+            while len(self.summaries) > self.summary_cache_size:
+                self.summaries.popitem(last=False)
+
+    def _prompt(self, system_prompt, messages, start, summary):
+        profile, grocery_list = self._pinned(messages[:start])
+        sections = []
+        if profile is not None:
+            sections.append(f"User profile, as returned by {self.profile_tool}:\n{profile.content}")
+        if summary:
+            sections.append(f"Summary of the earlier conversation:\n{summary}")
+        if grocery_list is not None:
+            sections.append(f"Current grocery list, as last shown to the user:\n{grocery_list.content}")
+        return self._with_system_prompt(system_prompt, messages[start:], sections)
+
+    def _report(self, prompt, history_tokens, summarized, config):
+        record = {"thread_id": (config or {}).get("configurable", {}).get("thread_id"),
+                  "history_tokens": history_tokens,
+                  "prompt_tokens": approximate_tokens(prompt),
+                  "summarized_messages": summarized}
+        self.token_log.append(record)
+        if self.report_tokens:
+            print(f"Prompt tokens: {record['prompt_tokens']} (untrimmed {history_tokens}, {summarized} messages summarized)")
+        return prompt
+
+    def modify(self, state, config):
+        messages = state["messages"]
+        system_prompt = self._system_prompt(state)
+        history_tokens = approximate_tokens(self._with_system_prompt(system_prompt, messages))
+        if history_tokens <= self.max_prompt_tokens:
+            return self._report(self._with_system_prompt(system_prompt, messages), history_tokens, 0, config)
+        start = self._recent_start(messages)
+        summary, new_messages = self._cached_summary(messages[:start])
+        if new_messages:
+            try:
+                summary = self.summary_llm.invoke(history_summary_prompt(summary, new_messages)).content
+                self._store_summary(messages[:start], summary)
+            except Exception as e:
+                print(f"History summary failed, using the previous summary: {e}")
+        return self._report(self._prompt(system_prompt, messages, start, summary), history_tokens, start, config)
+
+    async def amodify(self, state, config):
+        messages = state["messages"]
+        system_prompt = self._system_prompt(state)
+        history_tokens = approximate_tokens(self._with_system_prompt(system_prompt, messages))
+        if history_tokens <= self.max_prompt_tokens:
+            return self._report(self._with_system_prompt(system_prompt, messages), history_tokens, 0, config)
+        start = self._recent_start(messages)
+        summary, new_messages = self._cached_summary(messages[:start])
+        if new_messages:
+            try:
+                summary = (await self.summary_llm.ainvoke(history_summary_prompt(summary, new_messages))).content
+                self._store_summary(messages[:start], summary)
+            except Exception as e:
+                print(f"History summary failed, using the previous summary: {e}")
+        return self._report(self._prompt(system_prompt, messages, start, summary), history_tokens, start, config)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Concurrent tool calls
+# MAGIC
+# MAGIC When the model asks for several tools in one message (offers and expiring products for the same LoyaltyID, weather and festivals for the same address), `ConcurrentToolNode` runs them at the same time and returns the `ToolMessage`s in the original order. Like langgraph's `ToolNode`, sync calls run on an executor for this node run only, sized by the run config's `max_concurrency`, with context variables copied in. Async calls are gathered on the event loop.
+# MAGIC
+# MAGIC Every call has its own timeout (`tool_timeouts` per tool name, else `tool_timeout_seconds`), counted from when the call starts running. A call that runs out of time gets a tool message saying so, and the other results are not held back. A timed out sync call finishes on its own thread in the background. It doesn't hold up the node or calls from other sessions.
+
+# COMMAND ----------
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from langchain_core.runnables.config import ContextThreadPoolExecutor, get_config_list
+from langgraph.prebuilt import ToolNode
+
+
+class ConcurrentToolNode(ToolNode):
+    """ToolNode running the tool calls of one model message concurrently, each with its own timeout."""
+
+    def __init__(self, tools, default_timeout=60, timeouts=None, **kwargs):
+        super().__init__(tools, **kwargs)
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+
+    def _timeout(self, call) -> float:
+        return self.timeouts.get(call["name"], self.default_timeout)
+
+    def _timed_out(self, call) -> ToolMessage:
+        print(f"Tool {call['name']} timed out after {self._timeout(call)} seconds")
+        return ToolMessage(content=f"{call['name']} did not answer within {self._timeout(call)} seconds. Tell the user this information is not available right now.",
+                           name=call["name"], tool_call_id=call["id"])
+
+    def _output(self, outputs, output_type, profile):
+        if output_type == "list":
+            return outputs
+        update = {"messages": outputs}
+        if profile is not None:
+            update["user_profile"] = profile.model_dump()
+        return update
+
+    def _func(self, input, config):
+        tool_calls, output_type = self._parse_input(input)
+        profile = resolve_user_profile(input) if isinstance(input, dict) else None
+        started = [threading.Event() for _ in tool_calls]
+        started_at = [None] * len(tool_calls)
+
+        def run_one(index, call, call_config):
+            started_at[index] = time.monotonic()
+            started[index].set()
+            return self._run_one(call, call_config)
+
+        #Same executor get_executor_for_config gives ToolNode. It is shut down without waiting, so a timed out call can't hold up the node.
+        executor = ContextThreadPoolExecutor(max_workers=(config or {}).get("max_concurrency"))
+        #Each call's copied context carries the profile and the stage.
+        token = current_user_profile.set(profile)
+        stage_token = current_stage.set(input.get("stage") if isinstance(input, dict) else None)
+        try:
+            futures = [executor.submit(run_one, index, call, call_config)
+                       for index, (call, call_config) in enumerate(zip(tool_calls, get_config_list(config, len(tool_calls))))]
+        finally:
+            current_stage.reset(stage_token)
+            current_user_profile.reset(token)
+        budget = current_budget.get()
+        outputs = []
+        try:
+            for index, (call, future) in enumerate(zip(tool_calls, futures)):
+                #The timeout starts when the call starts running, not while it waits for a worker. The wait itself is bounded by the turn deadline.
+                if not started[index].wait(budget.remaining_seconds() if budget else None):
+                    future.cancel()
+                    outputs.append(self._timed_out(call))
+                    continue
+                try:
+                    outputs.append(future.result(timeout=max(0, started_at[index] + self._timeout(call) - time.monotonic())))
+                except FutureTimeoutError:
+                    outputs.append(self._timed_out(call))
+        finally:
+            executor.shutdown(wait=False)
+        return self._output(outputs, output_type, profile)
+
+    async def _afunc(self, input, config):
+        tool_calls, output_type = self._parse_input(input)
+        profile = await run_blocking(resolve_user_profile, input) if isinstance(input, dict) else None
+
+        async def run_one(call):
+            try:
+                return await asyncio.wait_for(self._arun_one(call, config), self._timeout(call))
+            except asyncio.TimeoutError:
+                return self._timed_out(call)
+
+        #gather copies the current context into each task.
+        token = current_user_profile.set(profile)
+        stage_token = current_stage.set(input.get("stage") if isinstance(input, dict) else None)
+        try:
+            calls = [asyncio.ensure_future(run_one(call)) for call in tool_calls]
+        finally:
+            current_stage.reset(stage_token)
+            current_user_profile.reset(token)
+        return self._output(list(await asyncio.gather(*calls)), output_type, profile)
+
+
+def create_tool_node(tools):
+    return ConcurrentToolNode(tools,
+                              default_timeout=get_config("tool_timeout_seconds", 60),
+                              timeouts=get_config("tool_timeouts", {}))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Staged agent
+# MAGIC
+# MAGIC With `agent_graph: "stages"` the guided flow from the agent prompt is an explicit graph: Preferences → Offers → Recipe → Weather → Festivals → Expiring → Price → Inventory → Summary → Email. The current stage is kept in the graph state.
+# MAGIC
+# MAGIC A `route` node picks the stage for each user message without an LLM call:
+# MAGIC - keywords in the message pick a stage, and the latest stage in the flow wins ("Check for Availability and Price" goes to inventory)
+# MAGIC - a bare option number follows that option in the last answer
+# MAGIC - a plain yes moves on to the next stage that the last answer offered
+# MAGIC - anything else stays on the current stage
+# MAGIC
+# MAGIC Each stage node only gets its own tools and its slice of `stage_prompts`, added to the common slice.
+
+# COMMAND ----------
+
+from langgraph.graph import StateGraph, END
+
+GROCER_STAGES = ["preferences", "offers", "recipe", "weather", "festivals", "expiring", "price", "inventory", "summary", "email"]
+
+#"uc_functions" stands for the UC function tools from config.yml.
+STAGE_TOOLS = {
+    "preferences": ["get_user_details"],
+    "offers": ["get_offers_details"],
+    "recipe": ["get_stored_recipie"],
+    "weather": ["get_weather_forecast"],
+    "festivals": ["suggest_for_upcoming_festivals"],
+    "expiring": ["get_expired_products_details"],
+    "price": ["get_product_availability_and_price", "uc_functions"],
+    "inventory": ["get_product_availability_and_price"],
+    "summary": ["uc_functions"],
+    "email": ["send_email_function", "get_email_delivery_status"],
+}
+
+STAGE_PATTERNS = {stage: re.compile(pattern, re.IGNORECASE) for stage, pattern in {
+    "preferences": r"\bloyalty\s*id\b|\bL\d{3,}\b|\ball?ergi|\bprefer|\bexclud|\bavoid|\bvegan\b|\bvegetarian\b",
+    "offers": r"\boffer|\bdeals?\b|\bdiscount",
+    "recipe": r"\brecip|\bcook|\bhow to (make|do|prepare)\b|\bingredient",
+    "weather": r"\bweather\b|\bclimate\b|\btemperature\b",
+    "festivals": r"\bfestiv|\bholiday|\bcelebrat",
+    "expiring": r"\bexpir",
+    "price": r"\bprices?\b|\bcost|\bhow much\b",
+    "inventory": r"\binventory\b|\bavailab|\bin stock\b",
+    "summary": r"\bsummar",
+    "email": r"\be-?mail|\bmail\b",
+}.items()}
+
+AFFIRMATIVE_PATTERN = re.compile(r"^\s*(yes|yeah|yep|sure|ok|okay|go ahead|proceed|next|please do|continue)\b", re.IGNORECASE)
+OPTION_PATTERN = re.compile(r"^\s*(\d+)\s*[.)]?\s*$")
+
+
+class GrocerState(UserProfileState):
+    stage: Optional[str]
+
+
+def stages_in(text: str) -> List[str]:
+    return [stage for stage in GROCER_STAGES if STAGE_PATTERNS[stage].search(text)]
+
+
+def next_stage(user_message: str, current: Optional[str], last_answer: str = "") -> str:
+    matched = stages_in(user_message)
+    if matched:
+        return matched[-1]
+    option = OPTION_PATTERN.match(user_message)
+    if option:
+        line = next((line for line in last_answer.splitlines() if re.match(rf"\s*\**{option.group(1)}[.)]", line)), "")
+        matched = stages_in(line)
+        if matched:
+            return matched[-1]
+    elif AFFIRMATIVE_PATTERN.match(user_message) and current in GROCER_STAGES:
+        #The question closing the last answer, e.g. "Would you like to consider the weather?"
+        offered = [stage for stage in stages_in(last_answer[-300:])
+                   if GROCER_STAGES.index(stage) > GROCER_STAGES.index(current)]
+        if offered:
+            return offered[0]
+    return current or GROCER_STAGES[0]
+
+
+def replay_stage(messages) -> Optional[str]:
+    """Stage reached by the earlier messages, for turns without a checkpoint where the client resent the history."""
+    stage, last_answer = None, ""
+    for message in messages:
+        if isinstance(message, HumanMessage) and isinstance(message.content, str):
+            stage = next_stage(message.content, stage, last_answer)
+        elif isinstance(message, AIMessage) and not message.tool_calls and isinstance(message.content, str):
+            last_answer = message.content
+    return stage
+
+
+def route_stage(state: GrocerState):
+    messages = state["messages"]
+    current = state.get("stage") or replay_stage(messages[:-1])
+    update = {"stage": current or GROCER_STAGES[0]}
+    profile = resolve_user_profile(state)
+    if profile is not None:
+        update["user_profile"] = profile.model_dump()
+    if isinstance(messages[-1], HumanMessage) and isinstance(messages[-1].content, str):
+        last_answer = next((message.content for message in reversed(messages[:-1])
+                            if isinstance(message, AIMessage) and not message.tool_calls and isinstance(message.content, str)), "")
+        update["stage"] = next_stage(messages[-1].content, current, last_answer)
+    return update
+
+
+def stage_system_prompt(stage_prompts, stage: str, user_profile=None) -> str:
+    index = GROCER_STAGES.index(stage)
+    following = GROCER_STAGES[index + 1] if index + 1 < len(GROCER_STAGES) else None
+    step = f"Current step: {stage}."
+    if following:
+        step += f" When this step is complete, ask the user whether to go on to the next step: {following}."
+    profile = f"User profile: {UserProfile.model_validate(user_profile).describe()}" if user_profile else None
+    return "\n\n".join(part for part in (stage_prompts.get("common"), stage_prompts.get(stage), profile, step) if part)
+
+
+def stage_tools(stage, tools):
+    by_name = {tool.name: tool for tool in tools}
+    selected = []
+    for name in STAGE_TOOLS[stage]:
+        selected.extend([tool for tool in tools if is_uc_function(tool.name)] if name == "uc_functions" else [by_name[name]])
+    return selected
+
+
+def create_staged_agent(model, tools, state_modifier, checkpointer=None):
+    """Graph of the guided flow. state_modifier turns the state into the model's messages, system prompt for the stage included."""
+
+    def stage_node(stage):
+        selected = stage_tools(stage, tools)
+        model_runnable = state_modifier | (model.bind_tools(selected) if selected else model)
+
+        def finish(state, response):
+            #Same guard as create_react_agent when the recursion limit is about to be hit. is_last_step counts from the start of the turn.
+            if state["is_last_step"] and isinstance(response, AIMessage) and response.tool_calls:
+                response = AIMessage(id=response.id, content="Sorry, need more steps to process this request.")
+            return {"messages": [response]}
+
+        def call_model(state: GrocerState, config: RunnableConfig):
+            return finish(state, model_runnable.invoke(state, config))
+
+        async def acall_model(state: GrocerState, config: RunnableConfig):
+            return finish(state, await model_runnable.ainvoke(state, config))
+
+        return RunnableLambda(call_model, afunc=acall_model, name=stage)
+
+    def should_continue(state: GrocerState):
+        last_message = state["messages"][-1]
+        return "tools" if isinstance(last_message, AIMessage) and last_message.tool_calls else END
+
+    def current_stage(state: GrocerState):
+        return state["stage"]
+
+    graph = StateGraph(GrocerState)
+    graph.add_node("route", route_stage)
+    for stage in GROCER_STAGES:
+        graph.add_node(stage, stage_node(stage))
+        graph.add_conditional_edges(stage, should_continue, ["tools", END])
+    graph.add_node("tools", create_tool_node(tools))
+    graph.set_entry_point("route")
+    graph.add_conditional_edges("route", current_stage, GROCER_STAGES)
+    graph.add_conditional_edges("tools", current_stage, GROCER_STAGES)
+    return graph.compile(checkpointer=checkpointer)
 
 # COMMAND ----------
 
@@ -679,7 +3774,8 @@ def wrap_output(stream: Iterator[MessageLikeRepresentation]) -> Iterator[str]:
 
 # COMMAND ----------
 
-all_tools = [
+def build_all_tools():
+    all_tools = [
             # search_in_all_data(), #Deprecated. Doesn't provide consistent results for complex query. Cal halucinate a lot.
             # get_product_prices(), #Replaced with single vector search to product table.
             #  get_product_info(), #Replaced with single vector search to product table.
@@ -691,27 +3787,138 @@ all_tools = [
             get_recipie(),
             get_weather(),
             get_festivals(),
-            send_email()
+            send_email(),
+            get_email_status()
              ]
-all_tools.extend(uc_function_tools)
+    all_tools.extend(uc_function_tools.get())
+    return [instrument_tool(tool) for tool in all_tools]
 
-# COMMAND ----------
 
-from langchain_core.runnables import RunnableGenerator
+all_tools = Lazy("tools", build_all_tools)
 
+# COMMAND ----------
 
-config = ModelConfig(development_config="config.yml")
+from langchain_core.runnables import RunnableGenerator
 
 from langgraph.prebuilt import create_react_agent
 from langgraph.checkpoint.memory import MemorySaver
 
 try:
     system_message = config.get("agent_prompt")
-    agent_with_raw_output = create_react_agent(llm, all_tools, state_modifier=system_message)
 except KeyError:
-    agent_with_raw_output = create_react_agent(llm, all_tools)
+    system_message = None
+
+#"stages" runs the guided flow as an explicit graph (see Staged agent), "react" a single react agent with every tool.
+agent_graph = get_config("agent_graph", "stages")
+if agent_graph == "stages":
+    stage_prompts = config.get("stage_prompts")
+    system_prompt = lambda state: stage_system_prompt(stage_prompts, state["stage"], state.get("user_profile"))
+    answer_nodes = GROCER_STAGES
+else:
+    system_prompt = system_message
+    answer_nodes = ["agent"]
+
+if get_config("history_trimming", True):
+    conversation_history = ConversationHistory(
+        system_prompt, llm,
+        max_prompt_tokens=get_config("history_max_prompt_tokens", 6000),
+        recent_tokens=get_config("history_recent_tokens", 2500),
+        report_tokens=get_config("history_report_tokens", False))
+    state_modifier = RunnableLambda(conversation_history.modify, afunc=conversation_history.amodify)
+elif agent_graph == "stages":
+    state_modifier = RunnableLambda(lambda state: [SystemMessage(content=system_prompt(state))] + state["messages"])
+else:
+    state_modifier = system_message
+
+
+def build_agent(checkpointer=None):
+    if agent_graph == "stages":
+        return create_staged_agent(llm.get(), all_tools.get(), state_modifier, checkpointer=checkpointer)
+    return create_react_agent(llm.get(), create_tool_node(all_tools.get()), state_schema=UserProfileState,
+                              state_modifier=state_modifier, checkpointer=checkpointer)
+
+
+def build_agent_graphs():
+    """(graph, graph with the conversation checkpointer). The second one is None when conversation memory is off."""
+    enable_autolog()
+    agent_with_raw_output = build_agent()
+    #Same graph with the conversation checkpointer, used by turns that carry a thread_id.
+    agent_with_memory = None
+    if conversation_checkpointer is not None:
+        agent_with_memory = build_agent(conversation_checkpointer)
+    return agent_with_raw_output, agent_with_memory
+
+
+#Built on the first turn, or by warm_up() before the endpoint takes traffic.
+agent_graphs = Lazy("agent_graphs", build_agent_graphs)
+
+#Both output modes run each turn through conversation_call, so the graph stays lazy.
+agent = RunnableGenerator(stream_agent_output, astream_agent_output)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Metrics endpoint
+# MAGIC
+# MAGIC Serves `metrics_registry` on `http://localhost:<metrics_port>/metrics` for Prometheus to scrape. Started once per process by `warm_up()`, so the serving container opens the port on load and notebook runs, model logging and evaluation don't. Call `start_metrics_server()` to serve them from a notebook.
 
-agent = agent_with_raw_output | RunnableGenerator(wrap_output)
+# COMMAND ----------
+
+from prometheus_client import start_http_server
+
+METRICS_CACHES = {"recipe": "recipe_cache", "user_profile": "user_profile_cache", "festival": "festival_memory_cache",
+                  "geocode": "geocode_memory_cache", "climate": "climate_memory_cache"}
+metrics_registry.register(CacheStatsCollector(METRICS_CACHES))
+metrics_server = None
+
+
+def start_metrics_server(port=None):
+    global metrics_server
+    port = get_config("metrics_port", 9464) if port is None else port
+    if metrics_server is not None or not port:
+        return metrics_server
+    try:
+        metrics_server = start_http_server(port, registry=metrics_registry)
+        print(f"Metrics served on port {port}")
+    except OSError as e:
+        #e.g. a second notebook session in the same container already serves them.
+        print(f"Metrics endpoint not started on port {port}: {e}")
+    return metrics_server
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Warm-up
+# MAGIC
+# MAGIC `warm_up()` starts the metrics endpoint and builds everything the first turn would otherwise pay for: the llm client, the UC function tools (warehouse round trip), the tools and graphs, and the product vector index handle. With `llm_call=True` it also sends one short prompt so the serving endpoint connection is open.
+# MAGIC
+# MAGIC The serving container runs it while loading the model, before it takes traffic, when `GROCER_WARM_UP=true` is set in its environment (see the driver) or `warm_up_on_import: true` in config.yml. Notebook runs and model logging stay lazy.
+
+# COMMAND ----------
+
+def warm_up(llm_call=False):
+    """Start the metrics endpoint and build the lazily constructed clients, tools and graphs now. Returns the startup time breakdown."""
+    start_metrics_server()
+    with startup_step("warm_up"):
+        agent_graphs.get()
+        try:
+            with startup_step("vector_index_handle"):
+                vector_indexes.get_index(PRODUCT_VS_ENDPOINT, PRODUCT_VS_INDEX)
+        except Exception as e:
+            print(f"Warm-up: product index handle failed: {e}")
+        if llm_call:
+            try:
+                with startup_step("llm_call"):
+                    llm.invoke("Reply with OK.")
+            except Exception as e:
+                print(f"Warm-up: llm call failed: {e}")
+    return report_startup_timings("Warm-up")
+
+
+if os.environ.get("GROCER_WARM_UP", "").lower() in ("1", "true", "yes") or get_config("warm_up_on_import", False):
+    warm_up(llm_call=get_config("warm_up_llm_call", False))
+else:
+    report_startup_timings("Import")
 
 # COMMAND ----------
 
@@ -785,4 +3992,36 @@ agent = agent_with_raw_output | RunnableGenerator(wrap_output)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Concurrent sessions per worker
+# MAGIC
+# MAGIC Compares a thread-per-conversation worker (sync `invoke` on `worker_threads` threads) with a single event loop multiplexing the same conversations through `ainvoke`. Returns wall time and sessions per second for each.
+
+# COMMAND ----------
+
+def measure_concurrent_sessions(message="Hi, my Loyalty ID is L002. Give me all the details of my offer", sessions=20, worker_threads=4):
+    from concurrent.futures import ThreadPoolExecutor
+
+    input_message={"messages": [{"role": "user", "content": message}]}
+
+    start=time.perf_counter()
+    with ThreadPoolExecutor(max_workers=worker_threads) as executor:
+        list(executor.map(lambda _: agent.invoke(input_message), range(sessions)))
+    sync_seconds=time.perf_counter()-start
+
+    async def run_async():
+        await asyncio.gather(*(agent.ainvoke(input_message) for _ in range(sessions)))
+
+    start=time.perf_counter()
+    asyncio.run(run_async())
+    async_seconds=time.perf_counter()-start
+
+    return {"sessions": sessions,
+            "sync": {"worker_threads": worker_threads, "seconds": sync_seconds, "sessions_per_second": sessions/sync_seconds},
+            "async": {"seconds": async_seconds, "sessions_per_second": sessions/async_seconds}}
+
+# measure_concurrent_sessions()
+
+# COMMAND ----------
+
 mlflow.models.set_model(agent)
\ No newline at end of file
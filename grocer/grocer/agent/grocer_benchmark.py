@@ -0,0 +1,616 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Benchmark notebook
+# MAGIC
+# MAGIC Runs the guided grocery conversation (the `message_list` at the end of the [agent]($./grocer_agent) notebook), and variants of it, fully offline:
+# MAGIC - LLM: `BenchmarkChatModel`, a scripted chat model replying per user message, with a fixed per call latency.
+# MAGIC - Vector Search: `LocalFakeIndex` seeded with the sample data (same rows as the data prep notebook).
+# MAGIC - Warehouse: SQLite copy of `users`, `products`, `transactions`, `offers` and `recipe`.
+# MAGIC - Email: `LocalSMTPSink`, a local SMTP server keeping the messages in memory.
+# MAGIC - Weather: fixed coordinates and temperatures, no Nominatim or meteostat calls.
+# MAGIC
+# MAGIC UC functions are remote and not part of the benchmark.
+# MAGIC
+# MAGIC For each turn it reports latency, time to first token, LLM calls, prompt/completion tokens and tool calls. Every turn must answer, and must call exactly the tools its script entry lists. The totals per scenario are then compared with the reviewed baseline committed next to this notebook (`grocer_benchmark_baseline.json`).
+
+# COMMAND ----------
+
+# MAGIC %run ./grocer_agent
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Settings
+
+# COMMAND ----------
+
+BENCHMARK_BASELINE_PATH = "grocer_benchmark_baseline.json"
+#Set to True to store this run as the new baseline. Review the per turn answers and tool calls in the file before committing it.
+BENCHMARK_UPDATE_BASELINE = False
+#Simulated endpoint latency per LLM call, so latency numbers include the model round trips the agent makes.
+BENCHMARK_CALL_LATENCY_SECONDS = 0.05
+#Allowed latency growth over the baseline before a scenario is flagged. Counts and tokens are deterministic and must match.
+BENCHMARK_LATENCY_TOLERANCE = 0.25
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Scripted conversation
+# MAGIC
+# MAGIC One entry per user message: the tool calls the model makes for it (all in one message) and the answer it gives after the tool results. Messages without an entry get a short generic answer. The scripted tool calls are also what each turn is checked against.
+
+# COMMAND ----------
+
+BENCHMARK_EMAIL_SUMMARY = {
+    "items": [
+        {"name": "Apples", "quantity": "1 Kg", "price": 3.49, "category": "Fruits & Vegetables", "reason": "Offer"},
+        {"name": "Bananas", "quantity": "1 Kg", "price": 0.99, "category": "Fruits & Vegetables", "reason": "Offer"},
+        {"name": "Milk", "quantity": "1 Liter", "price": 1.99, "category": "Dairy & Eggs", "reason": "Recipe"},
+        {"name": "Bread Loaf", "reason": "Expiring"},
+    ],
+    "offers": [
+        {"product_name": "Apples", "loyalty_points": 150, "start_date": "today", "end_date": "in 7 days"},
+        {"product_name": "Bananas", "loyalty_points": 150, "start_date": "today", "end_date": "in 7 days"},
+    ],
+    "recipes": [
+        {"name": "Milkshake", "ingredients": ["Milk", "Bananas", "Sugar", "Ice cubes"],
+         "steps": ["Pour milk into a blender.", "Add sliced bananas and sugar.", "Blend until smooth.", "Serve with ice cubes."]},
+    ],
+    "total_price": 6.47,
+}
+
+BENCHMARK_SCRIPT = {
+    "Hi": {
+        "answer": "Hello! I can help you prepare your grocery list. Please share your Loyalty ID and any preferences."},
+    "My Loyalty ID is L002. I am Alergic to Nuts": {
+        "tools": [("get_user_details", {"user_question_with_loyalty_id": "Details of user with Loyalty ID L002"})],
+        "answer": "Thanks Indian, I will keep nuts out of your list. Shall I check your offers?"},
+    "Give me all the details of my offer": {
+        "tools": [("get_offers_details", {"user_input": "Offers for Loyalty ID L002"})],
+        "answer": "You have 150 loyalty points on Apples and Bananas this week. Would you like to add them?"},
+    "Suggest me a recipie which uses these offers": {
+        "tools": [("get_stored_recipie", {"user_input": "Apples and Bananas"})],
+        "answer": "Fruit Salad uses Apples and Bananas with Oranges and Lemon juice. Shall I add the ingredients?"},
+    "Yes, add all ingredients to my list. Suggest Weather appropriate products.": {
+        "tools": [("get_weather_forecast", {"address": "Vihar, Delhi, India"})],
+        "answer": "Added. It is hot in Delhi, so I suggest Bananas and Milk for cold drinks. Add them?"},
+    " Yes, consider the festivals": {
+        "tools": [("suggest_for_upcoming_festivals", {"user_details": "Vihar, Delhi, India"})],
+        "answer": "Diwali is coming up. Kheer needs Milk, Rice and Sugar. Shall I add them?"},
+    "How to do milkshake? Add ingredients to list.": {
+        "tools": [("get_stored_recipie", {"user_input": "Milkshake"})],
+        "answer": "Milkshake: blend Milk, Bananas and Sugar, serve with ice cubes. Ingredients added."},
+    "Add Expiring Products": {
+        "tools": [("get_expired_products_details", {"product_id_and_loyalty_id_details": "Loyalty ID L002"})],
+        "answer": "Your Bread Loaf has expired. I added it to the list."},
+    "Check for Availability and Price. Keep products even if they are not available.": {
+        "tools": [("get_product_availability_and_price", {"products_user_store_details": "Products: Apples, Bananas, Milk, Bread Loaf"})],
+        "answer": "Apples 3.49, Bananas 0.99, Milk 1.99 and Bread Loaf 2.49 are available in store 11."},
+    "Give me the summary of everything.": {
+        "answer": "Summary: Apples, Bananas (offers, 150 points each), Milk, Sugar (Milkshake), Bread Loaf (expiring). Total 8.96."},
+    "Send details over email": {
+        "tools": [("send_email_function", BENCHMARK_EMAIL_SUMMARY)],
+        "answer": "Your grocery list is queued for email."},
+    "Hi, my Loyalty ID is L001. Give me all the details of my offer": {
+        "tools": [("get_user_details", {"user_question_with_loyalty_id": "Details of user with Loyalty ID L001"}),
+                  ("get_offers_details", {"user_input": "Offers for Loyalty ID L001"})],
+        "answer": "Hello Canadian! You have 150 loyalty points on Milk and Bread Loaf this week."},
+    "Check for Availability and Price of Milk": {
+        "tools": [("get_product_availability_and_price", {"products_user_store_details": "Products: Milk"})],
+        "answer": "Milk is available in store 5 for 1.99."},
+}
+
+#Replies to LLM calls made inside tools and by the history summary, matched on the prompt text.
+BENCHMARK_INTERNAL_REPLIES = [
+    ("festival which will be coming soon", "Diwali, Dussehra, Karva Chauth. Recipe: Kheer with Milk, Rice, Sugar. AI generated, not from database."),
+    ("You are a weather", "Hot"),
+    ("comparision between product name", "Store 11: Apples, Bananas, Milk and Bread Loaf are available at their listed prices."),
+    ("running summary of a conversation", "User L002, allergic to nuts. Offers on Apples and Bananas shown and added. Recipes: Fruit Salad, Milkshake."),
+]
+
+BENCHMARK_CONVERSATION = ["Hi",
+                          "My Loyalty ID is L002. I am Alergic to Nuts",
+                          "Give me all the details of my offer",
+                          "Suggest me a recipie which uses these offers",
+                          "Yes, add all ingredients to my list. Suggest Weather appropriate products.",
+                          " Yes, consider the festivals",
+                          "How to do milkshake? Add ingredients to list.",
+                          "Add Expiring Products",
+                          "Check for Availability and Price. Keep products even if they are not available.",
+                          "Give me the summary of everything.",
+                          "Send details over email"]
+
+#name: (messages, mode). "memory" sends one message per turn with a thread_id, "stateless" resends the whole history like the Shiny app, "async" is "memory" through astream.
+BENCHMARK_SCENARIOS = {
+    "guided_flow": (BENCHMARK_CONVERSATION, "memory"),
+    "guided_flow_stateless": (BENCHMARK_CONVERSATION, "stateless"),
+    "guided_flow_async": (BENCHMARK_CONVERSATION, "async"),
+    "offers_and_price": (["Hi, my Loyalty ID is L001. Give me all the details of my offer",
+                          "Check for Availability and Price of Milk"], "memory"),
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Scripted LLM
+
+# COMMAND ----------
+
+import itertools
+from typing import Dict, List, Optional
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+def structured_reply(prompt: str) -> Optional[str]:
+    """JSON for the invoke_structured schemas the tools use, or None when prompt doesn't ask for one."""
+    if '"title": "InventoryRequest"' in prompt:
+        message = prompt.split("Here is the message:")[-1]
+        products = [product["ProductName"] for product in LOCAL_SAMPLE_DATA["grocery_products"] if product["ProductName"] in message]
+        return json.dumps({"products": products, "stores": re.findall(r"[Ss]tore(?: ID)?:? (\d+)", message)})
+    if '"title": "ItemCategories"' in prompt:
+        names = json.loads(prompt.split("Products:")[-1].split("\n")[0].strip())
+        return json.dumps({"categories": {name: "Other" for name in names}})
+    return None
+
+
+class BenchmarkChatModel(BaseChatModel):
+    """
+    Scripted stand-in for ChatDatabricks. Agent calls (prompts starting with a system message) are answered from script by the last user message:
+    first the scripted tool calls, then the answer once the tool results are in. Other calls are answered from internal_replies.
+    Each call sleeps call_latency_seconds and reports approximate token usage.
+    """
+
+    script: Dict[str, dict]
+    internal_replies: List[tuple] = []
+    call_latency_seconds: float = 0.0
+    default_answer: str = "Sure. Anything else for your list?"
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _reply(self, messages) -> AIMessage:
+        if isinstance(messages[0], SystemMessage):
+            last_human = max(i for i, message in enumerate(messages) if isinstance(message, HumanMessage))
+            turn = self.script.get(messages[last_human].content, {})
+            tool_results = any(isinstance(message, ToolMessage) for message in messages[last_human:])
+            if turn.get("tools") and not tool_results:
+                return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{next(benchmark_call_ids)}"}
+                                                         for name, args in turn["tools"]])
+            return AIMessage(content=turn.get("answer", self.default_answer))
+        prompt = messages[-1].content
+        structured = structured_reply(prompt)
+        if structured is not None:
+            return AIMessage(content=structured)
+        return AIMessage(content=next((reply for marker, reply in self.internal_replies if marker in prompt), "OK"))
+
+    def _usage(self, messages, reply) -> dict:
+        prompt_tokens = approximate_tokens(messages)
+        completion_tokens = approximate_tokens([reply])
+        return {"input_tokens": prompt_tokens, "output_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.call_latency_seconds)
+        reply = self._reply(messages)
+        reply.usage_metadata = self._usage(messages, reply)
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.call_latency_seconds)
+        reply = self._reply(messages)
+        if reply.tool_calls:
+            chunks = [AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": index}
+                for index, call in enumerate(reply.tool_calls)])]
+        else:
+            chunks = [AIMessageChunk(content=word) for word in re.findall(r"\S+\s*", reply.content)] or [AIMessageChunk(content="")]
+        chunks[-1].usage_metadata = self._usage(messages, reply)
+        for chunk in chunks:
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content, chunk=generation)
+            yield generation
+
+
+benchmark_call_ids = itertools.count()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Local SMTP sink
+
+# COMMAND ----------
+
+import socketserver
+
+
+class LocalSMTPSink:
+    """Minimal SMTP server on 127.0.0.1 accepting every message and keeping it in messages. No TLS or auth."""
+
+    def __init__(self):
+        self.messages = []
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(f"{line}\r\n".encode())
+
+            def handle(self):
+                self.reply("220 grocer benchmark sink")
+                while True:
+                    line = self.rfile.readline().decode(errors="replace").strip()
+                    if not line:
+                        return
+                    command = line.split(" ", 1)[0].upper()
+                    if command in ("EHLO", "HELO"):
+                        self.reply("250 grocer-benchmark")
+                    elif command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        for data_line in iter(self.rfile.readline, b""):
+                            if data_line in (b".\r\n", b".\n"):
+                                break
+                            data.append(data_line)
+                        sink.messages.append(b"".join(data))
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        #MAIL, RCPT, RSET, NOOP
+                        self.reply("250 OK")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="smtp-sink", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Local stand-ins
+# MAGIC
+# MAGIC The agent notebook runs in this notebook's namespace, so the tools pick up the globals replaced here. `reset_benchmark_state()` starts every scenario from empty caches and a fresh conversation store, so scenarios don't depend on the order they run in.
+
+# COMMAND ----------
+
+import tempfile
+
+BENCHMARK_COORDINATES = {
+    "ontario, canada": [43.65, -79.38],
+    "delhi, india": [28.61, 77.21],
+    "dubai, united arab emirates": [25.2, 55.27],
+    "mexico city, mexico": [19.43, -99.13],
+}
+
+benchmark_dir = tempfile.mkdtemp(prefix="grocer_benchmark_")
+smtp_sink = LocalSMTPSink()
+
+
+def benchmark_geocode_city(city_country: str):
+    return BENCHMARK_COORDINATES.get(SemanticCache.normalize(city_country))
+
+
+async def abenchmark_geocode_city(city_country: str):
+    return benchmark_geocode_city(city_country)
+
+
+def benchmark_average_temperature(latitude: float, longitude: float, start, end):
+    return 35.0 - abs(latitude) / 2
+
+
+async def abenchmark_average_temperature(latitude: float, longitude: float, start, end):
+    return benchmark_average_temperature(latitude, longitude, start, end)
+
+
+def reset_benchmark_state(scenario):
+    global vector_indexes, sql_agents, product_replica, recipe_cache, recipe_table_watcher, user_profile_cache
+    global festival_memory_cache, festival_disk_cache, email_outbox, conversation_checkpointer
+    global geocode_city, ageocode_city, average_temperature, aaverage_temperature
+    scenario_dir = os.path.join(benchmark_dir, scenario)
+    os.makedirs(scenario_dir, exist_ok=True)
+
+    vector_indexes = VectorIndexRegistry(index_factory=local_index_factory)
+    sql_agents = SQLAgentRegistry(database_uri=build_local_grocer_database(os.path.join(scenario_dir, "grocer.sqlite")))
+    product_replica = None
+    recipe_cache = SemanticCache(max_entries=1024, ttl_seconds=86400)
+    #The SQLite copy has no table history to watch.
+    recipe_table_watcher = TableChangeWatcher("genai.data.recipe", recipe_cache.invalidate, enabled=False)
+    user_profile_cache = SemanticCache(max_entries=4096, ttl_seconds=300)
+    festival_memory_cache = SemanticCache(max_entries=1024, ttl_seconds=604800, normalize_keys=False)
+    festival_disk_cache = SQLiteKVCache(os.path.join(scenario_dir, "festival_cache.sqlite"))
+    geocode_city, ageocode_city = benchmark_geocode_city, abenchmark_geocode_city
+    average_temperature, aaverage_temperature = benchmark_average_temperature, abenchmark_average_temperature
+    email_outbox = EmailOutbox("127.0.0.1", smtp_sink.port, sender="grocer@example.com", use_ssl=False,
+                               max_retries=1, backoff_seconds=0.1)
+    if conversation_checkpointer is not None:
+        conversation_checkpointer = BoundedSQLiteSaver(os.path.join(scenario_dir, "conversations.sqlite"))
+
+    llm.set(BenchmarkChatModel(script=BENCHMARK_SCRIPT, internal_replies=BENCHMARK_INTERNAL_REPLIES,
+                               call_latency_seconds=BENCHMARK_CALL_LATENCY_SECONDS,
+                               callbacks=[llm_budget_handler, llm_metrics_handler]))
+    uc_function_tools.set([])
+    all_tools.reset()
+    agent_graphs.reset()
+    if get_config("history_trimming", True):
+        conversation_history.summary_llm.reset()
+        conversation_history.summaries.clear()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Metrics
+
+# COMMAND ----------
+
+import collections
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class BenchmarkMetrics(BaseCallbackHandler):
+    """Counts LLM calls, token usage and tool calls of one turn, including the calls made inside tools."""
+
+    def __init__(self):
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.tool_calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        with self._lock:
+            self.llm_calls += 1
+
+    def on_llm_end(self, response, **kwargs):
+        usage = {}
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or usage
+        with self._lock:
+            self.prompt_tokens += usage.get("input_tokens", 0)
+            self.completion_tokens += usage.get("output_tokens", 0)
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        with self._lock:
+            self.tool_calls[kwargs.get("name") or serialized.get("name")] += 1
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Run
+
+# COMMAND ----------
+
+import uuid
+
+
+def run_turn(agent_input, run_config, mode):
+    """(answer, latency seconds, time to first token seconds) for one turn."""
+    start = time.perf_counter()
+    first_token = None
+    tokens = []
+
+    if mode == "async":
+        async def consume():
+            nonlocal first_token
+            async for token in agent.astream(agent_input, config=run_config):
+                first_token = first_token or time.perf_counter()
+                tokens.append(token)
+
+        asyncio.run(consume())
+    else:
+        for token in agent.stream(agent_input, config=run_config):
+            first_token = first_token or time.perf_counter()
+            tokens.append(token)
+
+    end = time.perf_counter()
+    answer = "".join(token if isinstance(token, str) else json.dumps(token) for token in tokens)
+    return answer, end - start, (first_token or end) - start
+
+
+def expected_tool_calls(user_message) -> dict:
+    """Tool calls the script makes for user_message, by tool name."""
+    return dict(collections.Counter(name for name, _ in BENCHMARK_SCRIPT.get(user_message, {}).get("tools", [])))
+
+
+def run_scenario(name, messages, mode):
+    """Per turn metrics for one scenario."""
+    reset_benchmark_state(name)
+    thread_id = str(uuid.uuid4())
+    history = []
+    turns = []
+    for number, user_message in enumerate(messages, start=1):
+        metrics = BenchmarkMetrics()
+        run_config = {"callbacks": [metrics]}
+        history.append({"role": "user", "content": user_message})
+        if mode == "stateless":
+            agent_input = {"messages": list(history)}
+        else:
+            agent_input = {"messages": [history[-1]]}
+            run_config["configurable"] = {"thread_id": thread_id}
+        answer, latency, first_token = run_turn(agent_input, run_config, mode)
+        history.append({"role": "assistant", "content": answer})
+        turns.append({"turn": number, "message": user_message.strip(), "answer": answer,
+                      "latency_seconds": round(latency, 4), "first_token_seconds": round(first_token, 4),
+                      "llm_calls": metrics.llm_calls, "prompt_tokens": metrics.prompt_tokens,
+                      "completion_tokens": metrics.completion_tokens, "tool_calls": dict(metrics.tool_calls),
+                      "expected_tool_calls": expected_tool_calls(user_message),
+                      "expected_answer": BENCHMARK_SCRIPT.get(user_message, {}).get("answer")})
+    email_outbox.flush(timeout=30)
+    return turns
+
+
+def scenario_totals(turns) -> dict:
+    tool_calls = collections.Counter()
+    for turn in turns:
+        tool_calls.update(turn["tool_calls"])
+    return {"turns": len(turns),
+            "latency_seconds": round(sum(turn["latency_seconds"] for turn in turns), 4),
+            "max_first_token_seconds": max(turn["first_token_seconds"] for turn in turns),
+            "llm_calls": sum(turn["llm_calls"] for turn in turns),
+            "prompt_tokens": sum(turn["prompt_tokens"] for turn in turns),
+            "completion_tokens": sum(turn["completion_tokens"] for turn in turns),
+            "tool_calls": dict(sorted(tool_calls.items()))}
+
+
+def print_turns(name, turns):
+    print(f"\n{name}")
+    print(f"{'turn':>4} {'latency':>8} {'first':>7} {'llm':>4} {'prompt':>7} {'compl':>6}  tools / message")
+    for turn in turns:
+        tools = ", ".join(f"{tool} x{count}" for tool, count in turn["tool_calls"].items()) or "-"
+        print(f"{turn['turn']:>4} {turn['latency_seconds']:>8.3f} {turn['first_token_seconds']:>7.3f} {turn['llm_calls']:>4} "
+              f"{turn['prompt_tokens']:>7} {turn['completion_tokens']:>6}  {tools} / {turn['message'][:50]}")
+
+
+def run_benchmark(scenarios=None):
+    """Run every scenario. Returns {scenario: {"turns": [...], "totals": {...}}}."""
+    results = {}
+    for name, (messages, mode) in (scenarios or BENCHMARK_SCENARIOS).items():
+        turns = run_scenario(name, messages, mode)
+        results[name] = {"mode": mode, "turns": turns, "totals": scenario_totals(turns)}
+        print_turns(name, turns)
+    print(f"\nEmails delivered to the local sink: {len(smtp_sink.messages)}")
+    return results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Compare with the baseline
+# MAGIC
+# MAGIC `check_turns` fails any turn that answered empty, didn't give its whole scripted answer, or didn't make exactly its scripted tool calls. These are correctness failures, whatever the baseline says.
+# MAGIC
+# MAGIC LLM calls, tokens and tool calls are deterministic with the scripted model, so any change is reported. Latency is flagged when it grows by more than `BENCHMARK_LATENCY_TOLERANCE`.
+
+# COMMAND ----------
+
+def check_turns(results):
+    """Failures (strings) for turns with an empty or partial answer, or tool calls other than the scripted ones."""
+    failures = []
+    for name, result in results.items():
+        for turn in result["turns"]:
+            if not turn["answer"].strip():
+                failures.append(f"{name} turn {turn['turn']}: empty answer ({turn['message'][:50]})")
+            elif turn["expected_answer"] and turn["answer"].strip() != turn["expected_answer"]:
+                failures.append(f"{name} turn {turn['turn']}: answer {turn['answer'].strip()[:60]!r}, expected {turn['expected_answer'][:60]!r}")
+            if turn["tool_calls"] != turn["expected_tool_calls"]:
+                failures.append(f"{name} turn {turn['turn']}: tool calls {turn['tool_calls']}, expected {turn['expected_tool_calls']} ({turn['message'][:50]})")
+    return failures
+
+
+def compare_with_baseline(results, baseline, latency_tolerance=BENCHMARK_LATENCY_TOLERANCE):
+    """List of regressions (strings). Changes that aren't regressions are printed only."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name}: not in baseline")
+            continue
+        current, previous = result["totals"], baseline[name]["totals"]
+        for key in ("llm_calls", "prompt_tokens", "completion_tokens"):
+            if current[key] != previous[key]:
+                change = f"{name}: {key} {previous[key]} -> {current[key]}"
+                (regressions.append if current[key] > previous[key] else print)(change)
+        if current["tool_calls"] != previous["tool_calls"]:
+            regressions.append(f"{name}: tool calls {previous['tool_calls']} -> {current['tool_calls']}")
+        for key in ("latency_seconds", "max_first_token_seconds"):
+            if current[key] > previous[key] * (1 + latency_tolerance):
+                regressions.append(f"{name}: {key} {previous[key]:.3f}s -> {current[key]:.3f}s")
+    return regressions
+
+
+def load_baseline(path=BENCHMARK_BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(results, path=BENCHMARK_BASELINE_PATH):
+    with open(path, "w") as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
+    print(f"Baseline saved to {path}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Regression checks
+# MAGIC
+# MAGIC `check_thread_step_limit` sends one tool-calling message on the same thread until the thread has taken more than `agent_recursion_limit` steps in total. Every turn must still call its tool and answer, as the step limit applies per turn, not per thread. Threads start with 0, 1 or 2 plain turns, so the tool-calling model step lands on different step numbers.
+
+# COMMAND ----------
+
+def check_thread_step_limit(message="Add Expiring Products", turns=10, plain_message="Hi", max_plain_turns=2):
+    """Failures (strings) for turns of long checkpointed threads that didn't call the scripted tools or answered empty."""
+    if conversation_checkpointer is None:
+        print("Conversation memory is off, thread step limit not checked")
+        return []
+    reset_benchmark_state("thread_step_limit")
+    expected = expected_tool_calls(message)
+    failures = []
+    for plain_turns in range(max_plain_turns + 1):
+        thread_id = str(uuid.uuid4())
+        for number, user_message in enumerate([plain_message] * plain_turns + [message] * turns, start=1):
+            metrics = BenchmarkMetrics()
+            answer, _, _ = run_turn({"messages": [{"role": "user", "content": user_message}]},
+                                    {"callbacks": [metrics], "configurable": {"thread_id": thread_id}}, "memory")
+            if user_message == message and (dict(metrics.tool_calls) != expected or not answer.strip()):
+                failures.append(f"thread_step_limit ({plain_turns} plain turns) turn {number}: "
+                                f"tool calls {dict(metrics.tool_calls)}, answer {answer.strip()[:60]!r}")
+    return failures
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC `check_table_watcher_recovery` fails a `TableChangeWatcher` check once, then reports a new version. The watcher must keep polling and still call its `on_change`.
+
+# COMMAND ----------
+
+def check_table_watcher_recovery(timeout_seconds=5):
+    """Failures (strings) if a watcher stops after a failed check or misses the change made during it."""
+    versions = iter([1, ConnectionError("warehouse timed out"), 2])
+    changed = threading.Event()
+
+    def get_version(table_name):
+        version = next(versions, 2)
+        if isinstance(version, Exception):
+            raise version
+        return version
+
+    watcher = TableChangeWatcher("benchmark.recipe", changed.set, check_interval=0.01, get_version=get_version)
+    watcher.start()
+    try:
+        if not changed.wait(timeout_seconds):
+            return [f"table watcher: on_change not called within {timeout_seconds}s of a failed check (version {watcher.version}, thread alive {watcher._thread.is_alive()})"]
+        return []
+    finally:
+        watcher.stop()
+
+# COMMAND ----------
+
+benchmark_results = run_benchmark()
+report_startup_timings("Agent startup")
+
+failures = check_turns(benchmark_results) + check_thread_step_limit() + check_table_watcher_recovery()
+print("\n".join(["Turn check failures:"] + failures) if failures else "Every turn gave its scripted answer and tool calls.")
+
+baseline = load_baseline()
+if BENCHMARK_UPDATE_BASELINE:
+    if failures:
+        print("Baseline not saved: fix the turn check failures first.")
+    else:
+        save_baseline(benchmark_results)
+elif baseline is None:
+    print(f"No baseline at {BENCHMARK_BASELINE_PATH}. Set BENCHMARK_UPDATE_BASELINE = True to create one, and review it before committing.")
+else:
+    regressions = compare_with_baseline(benchmark_results, baseline)
+    print("\n".join(["Regressions against the baseline:"] + regressions) if regressions else "No regressions against the baseline.")
+
+assert not failures, f"{len(failures)} benchmark turn check failures"
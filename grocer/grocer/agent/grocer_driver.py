@@ -31,7 +31,7 @@
 
 # COMMAND ----------
 
-# MAGIC %pip install -U -qqqq databricks-agents mlflow langchain==0.2.16 langgraph-checkpoint==1.0.12  langchain_core langchain-community==0.2.16 langgraph==0.2.16 pydantic databricks-sql-connector databricks-vectorsearch geopy meteostat
+# MAGIC %pip install -U -qqqq databricks-agents mlflow langchain==0.2.16 langgraph-checkpoint==1.0.12  langchain_core langchain-community==0.2.16 langgraph==0.2.23 pydantic databricks-sql-connector databricks-vectorsearch geopy meteostat
 # MAGIC dbutils.library.restartPython()
 
 # COMMAND ----------
@@ -76,12 +76,16 @@ with mlflow.start_run():
             f"langchain==0.2.16",
             f"langchain-community==0.2.16",
             f"langgraph-checkpoint==1.0.12",
-            f"langgraph==0.2.16",
+            f"langgraph==0.2.23",
             f"pydantic",
             f"databricks-sql-connector",
             f"databricks-vectorsearch",
             f"geopy", 
-            f"meteostat"
+            f"meteostat",
+            f"numpy",
+            f"aiohttp",
+            f"jinja2",
+            f"prometheus_client"
         ],
         model_config="config.yml",
         artifact_path='agent',
@@ -165,4 +169,6 @@ help(agents.deploy)
 # COMMAND ----------
 
 # # Deploy the model to the review app and a model serving endpoint
-agents.deploy(UC_MODEL_NAME, uc_registered_model_info.version,scale_to_zero=True)
\ No newline at end of file
+#GROCER_WARM_UP makes the serving container start the metrics endpoint and build the tools and graphs while loading the model, before it takes traffic.
+agents.deploy(UC_MODEL_NAME, uc_registered_model_info.version,scale_to_zero=True,
+              environment_vars={"GROCER_WARM_UP": "true"})
\ No newline at end of file
@@ -38,42 +38,113 @@ llm = ChatDatabricks(endpoint=endpoint,temperature=0)
 
 # COMMAND ----------
 
-def get_table_column_descriptions(schema,catalog_name,schema_name,table_name,llm):
-    import ast
+import ast
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
 
+#Generated descriptions are cached by table name and schema hash, so unchanged tables skip the LLM on the next run.
+#The cache lives in its own schema, so the agent's SQL tools don't see it as a grocery table.
+docs_cache_schema = "metadata"
+docs_cache_table = f"{catalog_name}.{docs_cache_schema}.table_docs_cache"
+#Bump when the prompt changes, so cached descriptions are regenerated.
+docs_prompt_version = "1"
+
+#Tables created in this run, documented together at the end of the notebook.
+table_docs_requests = []
+
+
+def queue_table_description(schema,catalog_name,schema_name,table_name):
+    table_docs_requests.append((schema,catalog_name,schema_name,table_name))
+
+
+def schema_hash(schema):
+    columns = [(field.name, field.dataType.simpleString()) for field in schema.fields]
+    return hashlib.sha256(json.dumps([docs_prompt_version, columns]).encode()).hexdigest()
+
+
+def sql_string(value):
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def parse_table_docs(content):
+    """(table description, {column: description}) from the LLM reply. Parsed once, ignoring any text around the list."""
+    docs = ast.literal_eval(content[content.find("["):content.rfind("]") + 1])
+    return docs[0]['table'], docs[1]
+
+
+def generate_table_docs(schema,llm):
+    #Prompt asking LLM to generate comments for columns and tables
+    input_string=f"""Generate descriptive information on columns. No need to mention datatype of the column in column descriptions. After that, based on generated column descriptions, generate the information on what any table containing these columns can be used for. 
+    {str(schema)}
+    Return should be in the format of list of dictionary like below.
+    [{{"table": "table_description"}}, {{"Column1":"Column Description", "Column2":"Column2 Description"}}]
+    """
+
+    #Asking LLM to generate output.
+    response=llm.invoke(input_string)
+    return parse_table_docs(response.content)
+
+
+def apply_table_docs(catalog_name,schema_name,table_name,table_description,column_descriptions):
+    full_name=f"{catalog_name}.{schema_name}.{table_name}"
+
+    #Adding comments at table level
+    spark.sql(f""" COMMENT ON TABLE {full_name} IS {sql_string(table_description)} """)
+
+    # Register column descriptions in Unity Catalog, all columns in one statement.
+    column_comments=[(column, description) for column, description in column_descriptions.items()]
+    batched=", ".join(f"`{column}` COMMENT {sql_string(description)}" for column, description in column_comments)
     try:
-        #Prompt asking LLM to generate comments for columns and tables
-        input_string=f"""Generate descriptive information on columns. No need to mention datatype of the column in column descriptions. After that, based on generated column descriptions, generate the information on what any table containing these columns can be used for. 
-        {str(schema)}
-        Return should be in the format of list of dictionary like below.
-        [{{"table": "table_description"}}, {{"Column1":"Column Description", "Column2":"Column2 Description"}}]
-        """
-
-        #Asking LLM to generate output.
-        response=llm.invoke(input_string
-        )
-        
-        #Extracting descriptions from output.
-        table_description=ast.literal_eval(response.content)[0]['table']
-        column_descriptions=ast.literal_eval(response.content)[1]
-
-        #Adding comments at table level
-
-        spark.sql(f""" ALTER TABLE {catalog_name}.{schema_name}.{table_name} SET TBLPROPERTIES ('comment' = "{table_description}") """)
-
-        # Register column descriptions in Unity Catalog
-        for column, description in column_descriptions.items():
-            print (column,description)
-            spark.sql(f""" ALTER TABLE {catalog_name}.{schema_name}.{table_name} ALTER COLUMN {column} COMMENT "{description}" """)
-
-        return_value="Comments Added"
+        spark.sql(f""" ALTER TABLE {full_name} ALTER COLUMN {batched} """)
     except Exception as e:
-        print (e)
-        return_value=e 
+        #Runtimes without multi-column ALTER COLUMN.
+        print (f"Batched column comments failed for {full_name}, applying one by one: {e}")
+        for column, description in column_comments:
+            spark.sql(f""" ALTER TABLE {full_name} ALTER COLUMN `{column}` COMMENT {sql_string(description)} """)
 
 
+def load_table_docs_cache():
+    spark.sql(f"CREATE SCHEMA IF NOT EXISTS {catalog_name}.{docs_cache_schema}")
+    spark.sql(f"""CREATE TABLE IF NOT EXISTS {docs_cache_table}
+                  (table_name STRING, schema_hash STRING, table_description STRING, column_descriptions STRING)""")
+    return {(row.table_name, row.schema_hash): (row.table_description, json.loads(row.column_descriptions))
+            for row in spark.table(docs_cache_table).collect()}
 
-    return return_value
+
+def save_table_docs_cache(entries):
+    if entries:
+        rows=[(table_name, hash_value, table_description, json.dumps(column_descriptions))
+              for (table_name, hash_value), (table_description, column_descriptions) in entries.items()]
+        (spark.createDataFrame(rows, "table_name STRING, schema_hash STRING, table_description STRING, column_descriptions STRING")
+              .write.mode("append").saveAsTable(docs_cache_table))
+
+
+def get_table_column_descriptions(schema,catalog_name,schema_name,table_name,llm,cache=None):
+    """Generate (or reuse cached) table and column descriptions and add them as comments. Returns the new cache entry, if any."""
+    cache = {} if cache is None else cache
+    key=(table_name, schema_hash(schema))
+    new_entry={}
+    try:
+        if key in cache:
+            table_description, column_descriptions = cache[key]
+            print (f"{table_name}: schema unchanged, using cached descriptions")
+        else:
+            table_description, column_descriptions = generate_table_docs(schema,llm)
+            new_entry[key]=(table_description, column_descriptions)
+        apply_table_docs(catalog_name,schema_name,table_name,table_description,column_descriptions)
+        print (f"{table_name}: comments added")
+    except Exception as e:
+        print (f"{table_name}: {e}")
+    return new_entry
+
+
+def document_tables(requests,llm,max_workers=8):
+    """Document every queued table concurrently. Only tables whose schema changed since the last run call the LLM."""
+    cache=load_table_docs_cache()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(requests)))) as executor:
+        new_entries=list(executor.map(lambda request: get_table_column_descriptions(*request, llm, cache=cache), requests))
+    save_table_docs_cache({key: value for entry in new_entries for key, value in entry.items()})
 
 # COMMAND ----------
 
@@ -130,7 +201,7 @@ spark.sql(f"DROP TABLE IF EXISTS {catalog_name}.{schema_name}.{table_name}")
 
 users.write.mode("overwrite").saveAsTable(f"{catalog_name}.{schema_name}.{table_name}")
 
-get_table_column_descriptions(schema,catalog_name,schema_name,table_name,llm)
+queue_table_description(schema,catalog_name,schema_name,table_name)
 
 # Display the DataFrame
 display(users)
@@ -177,7 +248,7 @@ spark.sql(f"DROP TABLE IF EXISTS {catalog_name}.{schema_name}.{table_name}")
 products.write.mode("overwrite").saveAsTable(f"{catalog_name}.{schema_name}.{table_name}")
 
 grocery_product_schema=products.schema
-get_table_column_descriptions(grocery_product_schema,catalog_name,schema_name,table_name,llm)
+queue_table_description(grocery_product_schema,catalog_name,schema_name,table_name)
 
 # Display the DataFrame
 display(products)
@@ -248,7 +319,7 @@ spark.sql(f"DROP TABLE IF EXISTS {catalog_name}.{schema_name}.{table_name}")
 transactions.write.mode("overwrite").saveAsTable(f"{catalog_name}.{schema_name}.{table_name}")
 
 transaction_schema=transactions.schema
-get_table_column_descriptions(transaction_schema,catalog_name,schema_name,table_name,llm)
+queue_table_description(transaction_schema,catalog_name,schema_name,table_name)
 
 # Display the DataFrame with price and total price included
 display(transactions)
@@ -301,7 +372,7 @@ spark.sql(f"DROP TABLE IF EXISTS {catalog_name}.{schema_name}.{table_name}")
 recipe.write.mode("overwrite").option("mergeSchema", "true").saveAsTable(f"{catalog_name}.{schema_name}.{table_name}")
 
 recipe_schema=recipe.schema
-get_table_column_descriptions(recipe_schema,catalog_name,schema_name,table_name,llm)
+queue_table_description(recipe_schema,catalog_name,schema_name,table_name)
 
 enableChangeDataFeed(catalog_name,schema_name,table_name)
 # Display the DataFrame
@@ -376,7 +447,18 @@ spark.sql(f"DROP TABLE IF EXISTS {catalog_name}.{schema_name}.{table_name}")
 offers.write.mode("overwrite").saveAsTable(f"{catalog_name}.{schema_name}.{table_name}")
 
 schema=offers.schema
-get_table_column_descriptions(schema,catalog_name,schema_name,table_name,llm)
+queue_table_description(schema,catalog_name,schema_name,table_name)
 
 # Display the DataFrame
-display(offers)
\ No newline at end of file
+display(offers)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Add Table Descriptions
+# MAGIC
+# MAGIC Documents every table created above in one concurrent pass. Descriptions are cached in `table_docs_cache` by schema hash, so only new or changed tables call the LLM.
+
+# COMMAND ----------
+
+document_tables(table_docs_requests,llm)
@@ -0,0 +1,387 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC
+# MAGIC This notebook generates a synthetic grocery database at load-testing scale, with the same tables and columns as `Grocer Dataprep`: `users`, `products`, `transactions`, `offers` and `recipe`.
+# MAGIC
+# MAGIC - Product popularity is Zipfian. A few products make up most purchases and offers.
+# MAGIC - Purchase dates are seasonal, with a yearly peak and a weekend uplift.
+# MAGIC - Users have a home store and a second store they sometimes shop at.
+# MAGIC - Expiry dates follow per-category shelf lives, so the expiring-products queries have realistic hits.
+# MAGIC
+# MAGIC Rows are generated in vectorized NumPy chunks. Each chunk is seeded by `(seed, table, chunk)`, so runs are reproducible and chunks can be generated independently.
+# MAGIC
+# MAGIC - With `output_mode = "spark"`, chunks are generated on the executors through `mapInPandas` and saved as Delta tables.
+# MAGIC - With `output_mode = "local"`, chunks are written as Parquet files under `local_output_dir`, so no cluster is needed. Run the file with plain `python`; it needs `numpy`, `pandas` and `pyarrow`.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Parameters
+# MAGIC
+# MAGIC Tables go to `genai.data_loadtest` by default. Setting `schema_name = "data"` replaces the demo tables the agent reads.
+
+# COMMAND ----------
+
+import os
+from datetime import date, timedelta
+
+#"spark" on a cluster, "local" for Parquet files
+output_mode = os.environ.get("GROCER_SYNTHETIC_OUTPUT", "spark" if "spark" in globals() else "local")
+local_output_dir = os.environ.get("GROCER_SYNTHETIC_DIR", "grocer_synthetic_data")
+
+catalog_name = "genai"
+schema_name = "data_loadtest"
+
+seed = 42
+#Scales the row counts below; stores, products and recipes grow with its square root
+scale = float(os.environ.get("GROCER_SYNTHETIC_SCALE", "1"))
+
+n_users = int(100_000 * scale)
+n_stores = max(1, int(200 * scale ** 0.5))
+#Products are stocked in every store, so the products table has n_products x n_stores rows
+n_products = max(1, int(5_000 * scale ** 0.5))
+n_transactions = int(5_000_000 * scale)
+n_recipes = max(1, int(5_000 * scale ** 0.5))
+offers_per_user = 2
+
+#Rows per generated chunk (one Spark task or one Parquet file)
+chunk_rows = 250_000
+
+end_date = date.today()
+start_date = end_date - timedelta(days=730)
+offer_days = 7
+
+#Zipf exponents for product popularity and store size
+product_zipf_exponent = 1.1
+store_zipf_exponent = 0.6
+#Seasonality: amplitude of the yearly cycle, day of year of its peak, and weekend uplift
+seasonal_amplitude = 0.35
+seasonal_peak_day = 350
+weekend_uplift = 0.25
+#Mean share of a user's purchases made at their second store
+away_store_share = 0.2
+
+#Set to a single address to route every agent email to one inbox, as the demo data does
+user_email = None
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Vocabulary
+
+# COMMAND ----------
+
+import numpy as np
+import pandas as pd
+
+#category: (items, units of measurement, median unit price, shelf life range in days)
+PRODUCT_CATEGORIES = {
+    "Dairy": (["Milk", "Yogurt", "Cheddar Cheese", "Butter", "Cream", "Eggs"], ["Liter", "Pack", "Kg"], 2.5, (7, 21)),
+    "Bakery": (["Bread Loaf", "Bagels", "Croissants", "Tortillas", "Pita Bread", "Flour"], ["Pack", "Kg"], 2.8, (3, 8)),
+    "Produce": (["Apples", "Bananas", "Oranges", "Tomatoes", "Onions", "Spinach", "Avocados", "Lemons", "Potatoes", "Carrots"], ["Kg", "Pack"], 2.2, (4, 15)),
+    "Meat": (["Chicken Breast", "Ground Beef", "Lamb Chops", "Salmon Fillet", "Turkey Slices"], ["Kg", "Pack"], 9.5, (2, 6)),
+    "Pantry": (["Rice", "Pasta", "Sugar", "Olive Oil", "Lentils", "Baking Powder", "Honey", "Oats"], ["Kg", "Pack", "Liter"], 3.5, (180, 720)),
+    "Frozen": (["Frozen Peas", "Ice Cream", "Frozen Pizza", "Ice cubes", "Frozen Berries"], ["Pack", "Kg"], 4.5, (90, 365)),
+    "Beverages": (["Orange Juice", "Coffee", "Green Tea", "Sparkling Water", "Lemonade"], ["Liter", "Pack"], 3.0, (60, 365)),
+    "Snacks": (["Potato Chips", "Chocolate Bar", "Almonds", "Granola Bars", "Popcorn"], ["Pack"], 2.7, (60, 270)),
+}
+BRANDS = np.array(["Fresh Farms", "Golden Valley", "Maple Leaf", "Sunrise", "Green Basket", "Urban Pantry", "Daily Harvest", "Oasis"])
+
+#city, country and street names for store and home addresses
+CITIES = np.array([
+    ("Toronto, Ontario", "Canada"), ("Vancouver, British Columbia", "Canada"), ("Delhi", "India"), ("Mumbai, Maharashtra", "India"),
+    ("Dubai", "United Arab Emirates"), ("Abu Dhabi", "United Arab Emirates"), ("Mexico City", "Mexico"), ("Guadalajara, Jalisco", "Mexico"),
+    ("London", "United Kingdom"), ("Sydney, New South Wales", "Australia"),
+])
+STREETS = np.array(["Carlton St", "Main St", "Park Ave", "Financial Center Rd", "Parliament St", "Market Rd", "Lake Shore Blvd", "Vihar Rd", "Reforma Ave", "King St"])
+
+FIRST_NAMES = np.array(["Aarav", "Maya", "Omar", "Sofia", "Liam", "Priya", "Mateo", "Fatima", "Noah", "Chloe", "Arjun", "Layla", "Diego", "Emma", "Hassan", "Ananya"])
+LAST_NAMES = np.array(["Sharma", "Garcia", "Smith", "Al Mansouri", "Tremblay", "Patel", "Hernandez", "Brown", "Khan", "Martin", "Singh", "Lopez"])
+
+DISHES = np.array(["Salad", "Smoothie", "Stir Fry", "Soup", "Bake", "Curry", "Sandwich", "Bowl", "Pasta", "Tacos"])
+STYLES = np.array(["Quick", "Classic", "Spicy", "Creamy", "Weekday", "Family", "Roasted", "Fresh"])
+STEP_TEMPLATES = np.array(["Wash and prepare the {}.", "Chop the {} into small pieces.", "Cook the {} over medium heat.", "Mix in the {}.", "Season and add the {}."])
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Samplers
+
+# COMMAND ----------
+
+TABLE_CODES = {"users": 1, "products": 2, "transactions": 3, "offers": 4, "recipe": 5}
+
+
+def chunk_rng(table_name, chunk_id):
+    return np.random.default_rng([seed, TABLE_CODES[table_name], chunk_id])
+
+
+def zipf_cdf(n, exponent, rng):
+    """Cumulative Zipf weights over n items, with the ranks shuffled so popular items are spread over the id range."""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    weights = weights[rng.permutation(n)]
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sample_cdf(cdf, size, rng):
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side="right"), len(cdf) - 1)
+
+
+def sample_cdf_distinct(cdf, rows, per_row, rng):
+    """(rows, per_row) draws from cdf without repeats within a row. A draw that repeats an earlier one in its row is drawn again."""
+    if per_row > len(cdf):
+        raise ValueError(f"Cannot draw {per_row} distinct items out of {len(cdf)}")
+    picks = sample_cdf(cdf, rows * per_row, rng).reshape(rows, per_row)
+    for column in range(1, per_row):
+        repeated = (picks[:, :column] == picks[:, [column]]).any(axis=1)
+        while repeated.any():
+            picks[repeated, column] = sample_cdf(cdf, int(repeated.sum()), rng)
+            repeated = (picks[:, :column] == picks[:, [column]]).any(axis=1)
+    return picks
+
+
+def seasonal_day_cdf(start, end):
+    """Cumulative weights of each day in [start, end]: a yearly cosine peaking at seasonal_peak_day plus a weekend uplift."""
+    days = pd.date_range(start, end, freq="D")
+    yearly = 1 + seasonal_amplitude * np.cos(2 * np.pi * (days.dayofyear.to_numpy() - seasonal_peak_day) / 365.25)
+    weekly = np.where(days.dayofweek.to_numpy() >= 5, 1 + weekend_uplift, 1.0)
+    cdf = np.cumsum(yearly * weekly)
+    return cdf / cdf[-1]
+
+
+def padded_ids(prefix, index, width):
+    return prefix + pd.Series(index).astype(str).str.zfill(width)
+
+
+def to_dates(days):
+    return pd.Series(np.asarray(days, dtype="datetime64[D]")).dt.date
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Shared Lookups
+# MAGIC
+# MAGIC Per-store, per-product and per-user arrays that more than one table depends on. They are built once on the driver and shipped to the executors with the chunk generators. At 100k users and 5k products they are a few MB.
+
+# COMMAND ----------
+
+lookup_rng = np.random.default_rng([seed, 0])
+
+#Stores: city, price level and size (share of users who call it home)
+store_city = np.arange(n_stores) % len(CITIES)
+store_cdf = zipf_cdf(n_stores, store_zipf_exponent, lookup_rng)
+store_price_factor = lookup_rng.uniform(0.9, 1.1, n_stores)
+
+#Products: category, item, brand, unit, base price and shelf life
+category_names = list(PRODUCT_CATEGORIES)
+product_category = lookup_rng.integers(0, len(category_names), n_products)
+product_name = np.empty(n_products, dtype=object)
+product_item = np.empty(n_products, dtype=object)
+product_unit = np.empty(n_products, dtype=object)
+product_price = np.empty(n_products)
+product_shelf_min = np.empty(n_products, dtype=np.int32)
+product_shelf_max = np.empty(n_products, dtype=np.int32)
+#Loops over the handful of categories; each assignment is vectorized over that category's products
+for code, category in enumerate(category_names):
+    items, units, median_price, (shelf_min, shelf_max) = PRODUCT_CATEGORIES[category]
+    members = np.flatnonzero(product_category == code)
+    product_item[members] = np.array(items)[lookup_rng.integers(0, len(items), len(members))]
+    product_unit[members] = np.array(units)[lookup_rng.integers(0, len(units), len(members))]
+    product_price[members] = np.round(median_price * lookup_rng.lognormal(0, 0.35, len(members)), 2)
+    product_shelf_min[members], product_shelf_max[members] = shelf_min, shelf_max
+product_name[:] = (pd.Series(BRANDS[lookup_rng.integers(0, len(BRANDS), n_products)]) + " " + pd.Series(product_item)).to_numpy()
+product_id = padded_ids("G", np.arange(1, n_products + 1), 6).to_numpy()
+product_cdf = zipf_cdf(n_products, product_zipf_exponent, lookup_rng)
+
+#Users: home store by store size, a second store, and how often they shop there
+user_home_store = sample_cdf(store_cdf, n_users, lookup_rng).astype(np.int32)
+user_away_store = ((user_home_store + lookup_rng.integers(1, max(n_stores, 2), n_users)) % n_stores).astype(np.int32)
+user_away_share = lookup_rng.beta(2, 2 / away_store_share - 2, n_users) if n_stores > 1 else np.zeros(n_users)
+#Heavy-tailed shopping frequency, so some users have many more transactions than others
+user_activity_cdf = np.cumsum(lookup_rng.lognormal(0, 1, n_users))
+user_activity_cdf /= user_activity_cdf[-1]
+
+purchase_days = np.arange(np.datetime64(start_date), np.datetime64(end_date) + 1)
+purchase_day_cdf = seasonal_day_cdf(start_date, end_date)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Table Generators
+# MAGIC
+# MAGIC Each generator returns the rows `[start, stop)` of its table as a pandas DataFrame, with the columns of the matching `Grocer Dataprep` table.
+
+# COMMAND ----------
+
+USERS_SCHEMA = "LoyaltyID STRING, UserName STRING, UserEmail STRING, UserHomeStoreAddress STRING, StoreID STRING"
+PRODUCTS_SCHEMA = "ProductID STRING, ProductName STRING, Units INT, UnitOfMeasurement STRING, UnitPrice DOUBLE, StoreID STRING, ProductIDStoreId STRING"
+TRANSACTIONS_SCHEMA = ("LoyaltyID STRING, TransactionID STRING, ProductID STRING, ProductName STRING, QuantityPurchased INT, "
+                       "ProductPurchaseDate DATE, ProductExpiryDate DATE, UnitPrice DOUBLE, TotalPrice DOUBLE, StoreID STRING")
+OFFERS_SCHEMA = "LoyaltyID STRING, OfferedProductID STRING, OfferLoyaltyPoints DOUBLE, OfferStartDate DATE, OfferEndDate DATE, ProductName STRING"
+RECIPE_SCHEMA = "RecipieID BIGINT, RecipeName STRING, Ingredients ARRAY<STRING>, Steps ARRAY<STRING>, content STRING"
+
+
+def loyalty_ids(users):
+    return padded_ids("L", users + 1, 8)
+
+
+def store_ids(stores):
+    return pd.Series(stores + 1).astype(str)
+
+
+def generate_users(start, stop, rng):
+    users = np.arange(start, stop)
+    size = len(users)
+    names = pd.Series(FIRST_NAMES[rng.integers(0, len(FIRST_NAMES), size)]) + " " + LAST_NAMES[rng.integers(0, len(LAST_NAMES), size)]
+    emails = pd.Series([user_email] * size) if user_email else "user" + pd.Series(users + 1).astype(str) + "@example.com"
+    home = user_home_store[users]
+    addresses = (pd.Series(rng.integers(1, 999, size)).astype(str) + " " + STREETS[rng.integers(0, len(STREETS), size)]
+                 + ", " + CITIES[store_city[home], 0] + ", " + CITIES[store_city[home], 1])
+    return pd.DataFrame({"LoyaltyID": loyalty_ids(users), "UserName": names, "UserEmail": emails,
+                         "UserHomeStoreAddress": addresses, "StoreID": store_ids(home)})
+
+
+def generate_products(start, stop, rng):
+    #Row r is product r % n_products in store r // n_products
+    rows = np.arange(start, stop)
+    products, stores = rows % n_products, rows // n_products
+    ids, store = pd.Series(product_id[products]), store_ids(stores)
+    return pd.DataFrame({"ProductID": ids, "ProductName": product_name[products],
+                         "Units": rng.choice(np.array([1, 1, 1, 2, 6, 12], dtype=np.int32), len(rows)),
+                         "UnitOfMeasurement": product_unit[products],
+                         "UnitPrice": np.round(product_price[products] * store_price_factor[stores], 2),
+                         "StoreID": store, "ProductIDStoreId": ids + "_" + store})
+
+
+def generate_transactions(start, stop, rng):
+    size = stop - start
+    users = sample_cdf(user_activity_cdf, size, rng)
+    products = sample_cdf(product_cdf, size, rng)
+    stores = np.where(rng.random(size) < user_away_share[users], user_away_store[users], user_home_store[users])
+    purchased = purchase_days[sample_cdf(purchase_day_cdf, size, rng)]
+    shelf_life = rng.integers(product_shelf_min[products], product_shelf_max[products] + 1)
+    quantity = (1 + rng.poisson(0.6, size)).astype(np.int32)
+    unit_price = np.round(product_price[products] * store_price_factor[stores], 2)
+    return pd.DataFrame({"LoyaltyID": loyalty_ids(users), "TransactionID": padded_ids("T", np.arange(start, stop) + 1, 10),
+                         "ProductID": product_id[products], "ProductName": product_name[products],
+                         "QuantityPurchased": quantity, "ProductPurchaseDate": to_dates(purchased),
+                         "ProductExpiryDate": to_dates(purchased + shelf_life), "UnitPrice": unit_price,
+                         "TotalPrice": np.round(quantity * unit_price, 2), "StoreID": store_ids(stores)})
+
+
+def generate_offers(start, stop, rng):
+    #Row r is offer r % offers_per_user for user r // offers_per_user; offered products follow the same popularity as purchases
+    #Chunks hold whole users (see CHUNK_BLOCK_ROWS), so each user's offers are drawn together, without repeating a product
+    rows = np.arange(start, stop)
+    products = sample_cdf_distinct(product_cdf, len(rows) // offers_per_user, offers_per_user, rng).ravel()
+    return pd.DataFrame({"LoyaltyID": loyalty_ids(rows // offers_per_user), "OfferedProductID": product_id[products],
+                         "OfferLoyaltyPoints": np.round(rng.random(len(rows)) * 100 + 100),
+                         "OfferStartDate": to_dates(np.full(len(rows), np.datetime64(end_date))),
+                         "OfferEndDate": to_dates(np.full(len(rows), np.datetime64(end_date + timedelta(days=offer_days)))),
+                         "ProductName": product_name[products]})
+
+
+def generate_recipes(start, stop, rng, max_ingredients=7):
+    size = stop - start
+    #Ingredients are drawn from the product items, so recipe searches lead back to products in stock
+    items = np.unique(product_item.astype(str))
+    counts = rng.integers(3, max_ingredients + 1, size)
+    picks = items[rng.integers(0, len(items), (size, max_ingredients))]
+    steps = STEP_TEMPLATES[rng.integers(0, len(STEP_TEMPLATES), (size, max_ingredients))]
+    names = pd.Series(STYLES[rng.integers(0, len(STYLES), size)]) + " " + picks[:, 0] + " " + DISHES[rng.integers(0, len(DISHES), size)]
+    #Array columns need one list per row
+    ingredients = [list(dict.fromkeys(row[:count])) for row, count in zip(picks.tolist(), counts)]
+    recipe_steps = [[template.format(item) for template, item in zip(templates, row)] + ["Serve and enjoy."]
+                    for templates, row in zip(steps.tolist(), ingredients)]
+    content = ("Recipe: " + names + ". Ingredients: " + pd.Series([", ".join(row) for row in ingredients])
+               + ". Steps: " + pd.Series([" ".join(row) for row in recipe_steps]))
+    return pd.DataFrame({"RecipieID": np.arange(start, stop, dtype=np.int64), "RecipeName": names,
+                         "Ingredients": ingredients, "Steps": recipe_steps, "content": content})
+
+
+#table: (generator, row count, Spark schema)
+SYNTHETIC_TABLES = {
+    "users": (generate_users, n_users, USERS_SCHEMA),
+    "products": (generate_products, n_products * n_stores, PRODUCTS_SCHEMA),
+    "transactions": (generate_transactions, n_transactions, TRANSACTIONS_SCHEMA),
+    "offers": (generate_offers, n_users * offers_per_user, OFFERS_SCHEMA),
+    "recipe": (generate_recipes, n_recipes, RECIPE_SCHEMA),
+}
+
+#Chunk sizes are a multiple of these, so rows of one key (e.g. one user's offers) never span two chunks
+CHUNK_BLOCK_ROWS = {"offers": offers_per_user}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Writers
+
+# COMMAND ----------
+
+import time
+
+
+def table_chunks(table_name, n_rows):
+    block_rows = CHUNK_BLOCK_ROWS.get(table_name, 1)
+    step = max(block_rows, chunk_rows - chunk_rows % block_rows)
+    return [(start, min(start + step, n_rows)) for start in range(0, n_rows, step)]
+
+
+def write_local(table_name, generator, n_rows):
+    table_dir = os.path.join(local_output_dir, table_name)
+    os.makedirs(table_dir, exist_ok=True)
+    for chunk_id, (start, stop) in enumerate(table_chunks(table_name, n_rows)):
+        generator(start, stop, chunk_rng(table_name, chunk_id)).to_parquet(os.path.join(table_dir, f"part-{chunk_id:05d}.parquet"), index=False)
+    return table_dir
+
+
+def write_spark(table_name, generator, n_rows, spark_schema):
+    chunks = table_chunks(table_name, n_rows)
+
+    def generate_partition(batches):
+        for batch in batches:
+            for chunk_id in batch["id"]:
+                start, stop = chunks[chunk_id]
+                yield generator(start, stop, chunk_rng(table_name, int(chunk_id)))
+
+    full_name = f"{catalog_name}.{schema_name}.{table_name}"
+    df = spark.range(len(chunks), numPartitions=max(1, len(chunks))).mapInPandas(generate_partition, schema=spark_schema)
+    spark.sql(f"DROP TABLE IF EXISTS {full_name}")
+    df.write.mode("overwrite").saveAsTable(full_name)
+    return full_name
+
+
+def generate_all(tables=None):
+    if output_mode == "spark":
+        spark.sql(f"CREATE SCHEMA IF NOT EXISTS {catalog_name}.{schema_name}")
+    for table_name in tables or SYNTHETIC_TABLES:
+        generator, n_rows, spark_schema = SYNTHETIC_TABLES[table_name]
+        started = time.perf_counter()
+        if output_mode == "spark":
+            target = write_spark(table_name, generator, n_rows, spark_schema)
+        else:
+            target = write_local(table_name, generator, n_rows)
+        print(f"{table_name}: {n_rows:,} rows -> {target} in {time.perf_counter() - started:.1f}s")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC # Generate
+# MAGIC
+# MAGIC As in `Grocer Dataprep`, Change Data Feed is enabled on `products` and `recipe` so vector indexes can sync from them.
+
+# COMMAND ----------
+
+generate_all()
+
+if output_mode == "spark":
+    for table_name in ["products", "recipe"]:
+        spark.sql(f"ALTER TABLE {catalog_name}.{schema_name}.{table_name} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")